@@ -1,33 +1,112 @@
 from fastapi import FastAPI, Request, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
+from typing import Literal
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
 import os
+import re
 import secrets
 from dotenv import load_dotenv
 
-from services.graph_client import (
-    list_recent_messages,
-    move_message,
-    get_inbox_folder_id,
-)
+from services.graph_client import list_recent_messages
 from services.db import (
     list_quarantine_events,
     get_event_by_id,
-    mark_released,
+    find_events_for_action,
+    iter_events,
+    list_events_since,
     get_dashboard_stats,
+    get_change_token,
+    list_slowest_events,
+    get_detection_latency_stats,
 )
 from services.logging_utils import get_logger
+from services.onboarding import get_onboarding_progress
+from services.release import release_events, requarantine_events
+from services.retention import query_archive
+from services.evidence import Blob
+from services.export import ndjson_chunks, csv_chunks, gzip_chunks
+from services.live import LiveFeed
+from services.tracing import span_breakdown
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
+# Templates only change on deploy: compile each once, no mtime check per render
+templates.env.auto_reload = False
 logger = get_logger(__name__)
 load_dotenv()
 
 security = HTTPBasic()
 
+# Seconds between SSE keep-alive comments, so proxies don't close idle streams
+SSE_KEEPALIVE_SECONDS = 15
+# Rendered dashboard pages / JSON listings kept for the current DB state
+DASHBOARD_CACHE_SIZE = int(os.getenv("DASHBOARD_CACHE_SIZE", "64"))
+
+
+class _PageCache:
+    """
+    Rendered responses for one DB change token (services.db.get_change_token).
+    Everything is dropped as soon as the token moves on, i.e. on any insert,
+    release, re-quarantine or retention run; in between, LRU by key.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.token = None
+        self._data = OrderedDict()
+
+    def get(self, token: str, key: tuple, build) -> bytes:
+        if token != self.token:
+            self._data.clear()
+            self.token = token
+        body = self._data.get(key)
+        if body is None:
+            # The token was read before build() queries the DB, so a body is
+            # never older than the token it is stored under
+            body = self._data[key] = build()
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        else:
+            self._data.move_to_end(key)
+        return body
+
+
+_page_cache = _PageCache(DASHBOARD_CACHE_SIZE)
+
+
+def _etag(token: str, key: tuple) -> str:
+    # Weak: a body may include changes made just after the token was read
+    return f'W/"{token}.{hashlib.sha256(repr(key).encode()).hexdigest()[:16]}"'
+
+
+def _cached_response(request: Request, key: tuple, build, media_type: str) -> Response:
+    """
+    304 when the client's ETag is still current, else the cached (or freshly
+    built) body. The browser keeps the page but revalidates it on every load.
+    """
+    token = get_change_token()
+    headers = {"ETag": _etag(token, key), "Cache-Control": "private, no-cache"}
+    if headers["ETag"] in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(_page_cache.get(token, key, build), media_type=media_type, headers=headers)
+
+
+def render_event_row(event: dict) -> str:
+    return templates.get_template("event_row.html").render(e=event)
+
+
+live_feed = LiveFeed(render=render_event_row)
+
 ADMIN_USER = os.getenv("ADMIN_USERNAME", "admin")
 ADMIN_PASS = os.getenv("ADMIN_PASSWORD", "admin")
+# Upper bound on events touched by one bulk release / re-quarantine
+BULK_ACTION_LIMIT = int(os.getenv("BULK_ACTION_LIMIT", "1000"))
 
 
 def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
@@ -71,11 +150,98 @@ async def test_emails():
 
 
 @app.get("/quarantine")
-async def quarantine_json(limit: int = 50):
+async def quarantine_json(request: Request, limit: int = 50, since_id: int = None):
     """
     JSON API: list recent quarantine events (for debugging / integration).
+    With since_id, returns only events newer than that ID, oldest first;
+    poll again with the returned last_id. Supports If-None-Match.
     """
-    events = list_quarantine_events(limit)
+
+    def build() -> bytes:
+        if since_id is not None:
+            events = list_events_since(since_id, limit)
+            last_id = events[-1]["id"] if events else since_id
+            payload = {"events": events, "last_id": last_id}
+        else:
+            payload = {"events": list_quarantine_events(limit)}
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    return _cached_response(request, ("json", limit, since_id), build, "application/json")
+
+
+@app.get("/admin/export")
+def admin_export(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    created_from: str = None,
+    created_to: str = None,
+    classification: str = None,
+    sender: str = None,
+    user_email: str = None,
+    moved: bool = None,
+    after_id: int = 0,
+    gzip: bool = False,
+    username: str = Depends(get_current_username)
+):
+    """
+    Stream every matching event as NDJSON or CSV, in id order, with constant
+    memory. created_from/created_to are ISO timestamps (from inclusive, to
+    exclusive). To resume an interrupted export, pass the last id received
+    as after_id. gzip=true returns a .gz file.
+    Protected by Basic Auth.
+    """
+    logger.info(
+        "export requested",
+        extra={"format": format, "after_id": after_id, "gzip": gzip, "admin": username},
+    )
+    events = iter_events(
+        after_id=after_id,
+        created_from=created_from,
+        created_to=created_to,
+        classification=classification,
+        sender=sender,
+        user_email=user_email,
+        moved=moved,
+    )
+    if format == "csv":
+        body, media_type = csv_chunks(events), "text/csv"
+    else:
+        body, media_type = ndjson_chunks(events), "application/x-ndjson"
+
+    filename = f"quarantine-events.{format}"
+    if gzip:
+        body, media_type, filename = gzip_chunks(body), "application/gzip", filename + ".gz"
+
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/admin/onboarding")
+async def admin_onboarding(username: str = Depends(get_current_username)):
+    """
+    JSON API: per-mailbox onboarding and backfill progress.
+    Protected by Basic Auth.
+    """
+    return {"mailboxes": get_onboarding_progress()}
+
+
+@app.get("/admin/archive")
+async def admin_archive(
+    sender: str = None,
+    user_email: str = None,
+    classification: str = None,
+    from_month: str = None,
+    to_month: str = None,
+    limit: int = 100,
+    username: str = Depends(get_current_username)
+):
+    """
+    JSON API: search events moved to the monthly archives by retention.
+    Months are YYYY-MM. Protected by Basic Auth.
+    """
+    events = query_archive(from_month, to_month, sender, user_email, classification, limit)
     return {"events": events}
 
 
@@ -89,17 +255,132 @@ async def admin_quarantine(
     username: str = Depends(get_current_username)
 ):
     """
-    HTML dashboard: show quarantine events in a table.
+    HTML dashboard: show quarantine events in a table. Reloads with nothing
+    new since the last one get a 304; otherwise the page is rendered once per
+    DB state and served from memory.
     Protected by Basic Auth.
     """
-    events = list_quarantine_events(limit, q=q)
-    stats = get_dashboard_stats()
+
+    def build() -> bytes:
+        events = list_quarantine_events(limit, q=q)
+        stats = get_dashboard_stats()
+        return templates.get_template("quarantine.html").render(
+            events=events, stats=stats, user=username, q=q
+        ).encode("utf-8")
+
+    return _cached_response(request, ("html", username, limit, q), build, "text/html; charset=utf-8")
+
+
+@app.get("/admin/quarantine/stream")
+async def admin_quarantine_stream(
+    request: Request,
+    username: str = Depends(get_current_username)
+):
+    """
+    Server-Sent Events: new events, released / re-quarantined events and
+    updated counters, as they happen. Each message carries the rendered
+    table rows so the dashboard can apply them in place.
+    Protected by Basic Auth.
+    """
+    queue = live_feed.subscribe()
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while queue in live_feed.subscribers:
+                if await request.is_disconnected():
+                    break
+                try:
+                    update = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {update['last_id']}\ndata: {json.dumps(update)}\n\n"
+        finally:
+            live_feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/admin/latency", response_class=HTMLResponse)
+async def admin_latency(
+    request: Request,
+    limit: int = 50,
+    username: str = Depends(get_current_username)
+):
+    """
+    HTML page: slowest messages by detection latency, with per-span breakdown,
+    and the overall detection-latency distribution.
+    Protected by Basic Auth.
+    """
+    events = list_slowest_events(limit)
+    for e in events:
+        e["spans"] = span_breakdown(e.pop("trace"))
+    stats = get_detection_latency_stats()
     return templates.TemplateResponse(
-        "quarantine.html",
-        {"request": request, "events": events, "stats": stats, "user": username, "q": q},
+        "latency.html",
+        {"request": request, "events": events, "stats": stats, "user": username},
     )
 
 
+def _parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """A single "bytes=a-b" / "bytes=a-" / "bytes=-n" range as [start, end); None = whole body."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), int(last) + 1 if last else size
+    else:
+        start, end = max(0, size - int(last)), size
+    if start >= size or start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size)
+
+
+@app.get("/admin/quarantine/{event_id}/preview")
+def admin_preview(event_id: int, request: Request, username: str = Depends(get_current_username)):
+    """
+    Sanitized text snapshot of a quarantined message (links defanged), from
+    the evidence store. Supports Range requests; snapshots never change, so
+    the hash is a permanent ETag.
+    Protected by Basic Auth.
+    """
+    event = get_event_by_id(event_id)
+    if not event or not event.get("evidence_hash"):
+        raise HTTPException(status_code=404, detail="No preview for this event")
+
+    digest = event["evidence_hash"]
+    headers = {
+        "ETag": f'"{digest}"',
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        blob = Blob(digest)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Preview has expired")
+    with blob:
+        byte_range = _parse_range(request.headers.get("range"), blob.size)
+        if byte_range is None:
+            return Response(blob.read(), media_type="text/plain; charset=utf-8", headers=headers)
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{blob.size}"
+        return Response(
+            blob.read(start, end), status_code=206, media_type="text/plain; charset=utf-8", headers=headers
+        )
+
+
 @app.get("/admin/quarantine/{event_id}/release")
 async def admin_release(
     event_id: int, 
@@ -107,7 +388,7 @@ async def admin_release(
     username: str = Depends(get_current_username)
 ):
     """
-    Release an email from AI-Quarantine back to Inbox.
+    Release an email from AI-Quarantine back to its owner's Inbox.
     Protected by Basic Auth.
     """
     logger.info("release requested", extra={"event_id": event_id, "admin": username})
@@ -118,26 +399,50 @@ async def admin_release(
         logger.warning("event not found", extra={"event_id": event_id})
         return RedirectResponse(url="/admin/quarantine", status_code=303)
 
-    message_id = event["message_id"]
-    logger.info(
-        "loaded event",
-        extra={"event_id": event_id, "message_id": message_id},
-    )
+    if event["moved"] and not event["released"] and event["user_email"]:
+        result = await release_events([event])
+        if result["failed"]:
+            logger.warning("release failed", extra={"event_id": event_id})
 
-    # Get Inbox folder ID from Graph
-    inbox_folder_id = await get_inbox_folder_id()
-    logger.info("resolved inbox folder", extra={"folder_id": inbox_folder_id})
+    # Redirect back to dashboard
+    return RedirectResponse(url="/admin/quarantine", status_code=303)
 
-    # Move message back to Inbox
-    await move_message(message_id, inbox_folder_id)
-    logger.info(
-        "released message",
-        extra={"event_id": event_id, "message_id": message_id},
-    )
 
-    # Mark as released in DB
-    mark_released(event_id)
-    logger.info("marked event as released", extra={"event_id": event_id})
+class BulkAction(BaseModel):
+    action: Literal["release", "requarantine"]
+    # Any combination; at least one is required
+    event_ids: list[int] = []
+    q: str | None = None
+    sender: str | None = None
 
-    # Redirect back to dashboard
-    return RedirectResponse(url="/admin/quarantine", status_code=303)
\ No newline at end of file
+
+@app.post("/admin/quarantine/bulk")
+async def admin_bulk_action(
+    body: BulkAction,
+    username: str = Depends(get_current_username)
+):
+    """
+    JSON API: release or re-quarantine many events at once, selected by ID,
+    by the dashboard search and/or by sender. Moves are batched per mailbox
+    and the DB is updated once.
+    Protected by Basic Auth.
+    """
+    if not (body.event_ids or body.q or body.sender):
+        raise HTTPException(status_code=400, detail="Select events by event_ids, q or sender")
+    if len(body.event_ids) > BULK_ACTION_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_ACTION_LIMIT} event_ids per request")
+
+    events = find_events_for_action(
+        body.action,
+        event_ids=body.event_ids,
+        q=body.q,
+        sender=body.sender,
+        limit=BULK_ACTION_LIMIT,
+    )
+    logger.info(
+        "bulk action requested",
+        extra={"action": body.action, "events": len(events), "admin": username},
+    )
+    if body.action == "release":
+        return await release_events(events)
+    return await requarantine_events(events)
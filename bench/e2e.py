@@ -0,0 +1,248 @@
+"""
+End-to-end throughput benchmark for the poller.
+
+Starts the fake Graph (bench/fake_graph.py), the fake Ollama
+(bench/fake_ollama.py) and the real llm-api as local uvicorn subprocesses,
+then runs real services.poller cycles against them in this process.
+
+Reports messages/sec, p50/p95/p99 per-message latency (from the message
+being handed to process_single_message to its decision being logged) and
+the poller's peak RSS.
+
+Usage:
+    python -m bench.e2e --scenario smoke
+    python -m bench.e2e --scenario many-mailboxes      # 1k mailboxes x 10 messages
+    python -m bench.e2e --scenario initial-sync        # 1 mailbox x 50k messages
+    python -m bench.e2e --mailboxes 50 --messages 200 --graph-latency-ms 80 --throttle-rate 0.01
+    python -m bench.e2e --scenario smoke --delta-body-mode lazy   # compare graph message_bytes
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "smoke": {"mailboxes": 10, "messages": 10},
+    "many-mailboxes": {"mailboxes": 1000, "messages": 10},
+    "initial-sync": {"mailboxes": 1, "messages": 50000},
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(app: str, port: int, env: dict, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", app,
+            "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=REPO_ROOT,
+        env={**os.environ, **env},
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not come up: {url}")
+
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def _run_poller(cycles: int) -> dict:
+    # Imported here so the environment set up by main() is what the modules read
+    from services import poller
+    from services.db import init_db
+
+    latencies = []
+    original = poller.process_single_message
+
+    async def timed_process_single_message(user_email, m, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original(user_email, m, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    poller.process_single_message = timed_process_single_message
+
+    init_db()
+    cycle_seconds = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        await poller.run_cycle()
+        cycle_seconds.append(time.perf_counter() - start)
+
+    return {"latencies": latencies, "cycle_seconds": cycle_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="smoke")
+    parser.add_argument("--mailboxes", type=int, help="override the scenario's mailbox count")
+    parser.add_argument("--messages", type=int, help="override the scenario's messages per mailbox")
+    parser.add_argument("--cycles", type=int, default=2, help="poll cycles (first is the initial sync)")
+    parser.add_argument("--graph-latency-ms", type=float, default=20)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of Graph calls answered 429")
+    parser.add_argument("--body-bytes", type=int, default=4000)
+    parser.add_argument("--delta-body-mode", choices=("full", "lazy"), default="full", help="DELTA_BODY_MODE for the poller")
+    parser.add_argument("--tokens-per-sec", type=float, default=2000, help="fake Ollama generation speed")
+    parser.add_argument("--ollama-parallel", type=int, default=4)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    scenario = dict(SCENARIOS[args.scenario])
+    if args.mailboxes:
+        scenario["mailboxes"] = args.mailboxes
+    if args.messages:
+        scenario["messages"] = args.messages
+
+    workdir = tempfile.mkdtemp(prefix="eos-bench-")
+    graph_port, ollama_port, llm_port = _free_port(), _free_port(), _free_port()
+
+    servers = [
+        _start_server(
+            "bench.fake_graph:app",
+            graph_port,
+            {
+                "FAKE_GRAPH_USERS": str(scenario["mailboxes"]),
+                "FAKE_GRAPH_MESSAGES": str(scenario["messages"]),
+                "FAKE_GRAPH_BODY_BYTES": str(args.body_bytes),
+                "FAKE_GRAPH_LATENCY_MS": str(args.graph_latency_ms),
+                "FAKE_GRAPH_THROTTLE_RATE": str(args.throttle_rate),
+            },
+            os.path.join(workdir, "fake_graph.log"),
+        ),
+        _start_server(
+            "bench.fake_ollama:app",
+            ollama_port,
+            {
+                "FAKE_OLLAMA_TPS": str(args.tokens_per_sec),
+                "FAKE_OLLAMA_PARALLEL": str(args.ollama_parallel),
+            },
+            os.path.join(workdir, "fake_ollama.log"),
+        ),
+        _start_server(
+            "llm-api.api.main:app",
+            llm_port,
+            {
+                "OLLAMA_URL": f"http://127.0.0.1:{ollama_port}/api/generate",
+                "OLLAMA_CONCURRENCY": str(args.ollama_parallel),
+            },
+            os.path.join(workdir, "llm_api.log"),
+        ),
+    ]
+
+    try:
+        _wait_ready(f"http://127.0.0.1:{graph_port}/_stats")
+        _wait_ready(f"http://127.0.0.1:{ollama_port}/_stats")
+        _wait_ready(f"http://127.0.0.1:{llm_port}/health")
+
+        db_path = os.path.join(workdir, "quarantine.db")
+        os.environ.update(
+            {
+                "GRAPH_BASE_URL": f"http://127.0.0.1:{graph_port}/v1.0",
+                "GRAPH_TOKEN_URL": f"http://127.0.0.1:{graph_port}/token",
+                "LLM_API_URL": f"http://127.0.0.1:{llm_port}/classify",
+                "LLM_API_URLS": "",
+                "QUARANTINE_DB_PATH": db_path,
+                "STATE_FILE": os.path.join(workdir, "state.json"),
+                "ENABLE_TENANT_DISCOVERY": "true",
+                "ORG_DOMAIN": "bench.example",
+                "ONBOARDING_WINDOW_DAYS": "0",
+                "BACKFILL_ENABLED": "false",
+                "SHARDING_ENABLED": "false",
+                "METRICS_PORT": "0",
+                "DELTA_BODY_MODE": args.delta_body_mode,
+                "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+            }
+        )
+
+        wall_start = time.perf_counter()
+        result = asyncio.run(_run_poller(args.cycles))
+        wall = time.perf_counter() - wall_start
+
+        conn = sqlite3.connect(db_path)
+        logged, moved = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(moved), 0) FROM quarantine_events"
+        ).fetchone()
+        conn.close()
+
+        graph_stats = _get_json(f"http://127.0.0.1:{graph_port}/_stats")
+        ollama_stats = _get_json(f"http://127.0.0.1:{ollama_port}/_stats")
+    finally:
+        for proc in servers:
+            proc.terminate()
+        for proc in servers:
+            proc.wait(timeout=10)
+
+    latencies = sorted(result["latencies"])
+    initial_sync = result["cycle_seconds"][0]
+    expected = scenario["mailboxes"] * scenario["messages"]
+    report = {
+        "scenario": args.scenario,
+        "mailboxes": scenario["mailboxes"],
+        "messages_per_mailbox": scenario["messages"],
+        "messages_expected": expected,
+        "messages_processed": len(latencies),
+        "messages_logged": logged,
+        "messages_moved": moved,
+        "errors": len(latencies) - logged,
+        "initial_sync_seconds": round(initial_sync, 3),
+        "steady_cycle_seconds": [round(c, 3) for c in result["cycle_seconds"][1:]],
+        "wall_seconds": round(wall, 3),
+        "messages_per_sec": round(logged / initial_sync, 2) if initial_sync else 0,
+        "latency_p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "graph": graph_stats,
+        "ollama": ollama_stats,
+        "workdir": workdir,
+    }
+
+    width = max(len(k) for k in report)
+    for key, value in report.items():
+        print(f"{key:<{width}}  {value}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Local stand-in for the parts of Microsoft Graph the poller uses.
+
+Serves the token endpoint, /users, Inbox delta pages, mailFolders, move and
+$batch from a deterministic synthetic tenant. Honours $select on delta
+(body only when selected) and Prefer: outlook.body-content-type="text" on
+message GETs. Run under uvicorn; configured
+through environment variables so bench/e2e.py can start it as a subprocess:
+
+  FAKE_GRAPH_USERS          number of mailboxes (default 10)
+  FAKE_GRAPH_MESSAGES       Inbox messages per mailbox (default 10)
+  FAKE_GRAPH_PAGE_SIZE      messages per delta page (default 50)
+  FAKE_GRAPH_BODY_BYTES     approximate HTML body size (default 4000)
+  FAKE_GRAPH_LATENCY_MS     added latency per request (default 20)
+  FAKE_GRAPH_THROTTLE_RATE  fraction of requests answered with 429 (default 0)
+"""
+import asyncio
+import json
+import os
+import random
+import re
+from datetime import datetime, timedelta, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+USERS = int(os.getenv("FAKE_GRAPH_USERS", "10"))
+MESSAGES = int(os.getenv("FAKE_GRAPH_MESSAGES", "10"))
+PAGE_SIZE = int(os.getenv("FAKE_GRAPH_PAGE_SIZE", "50"))
+BODY_BYTES = int(os.getenv("FAKE_GRAPH_BODY_BYTES", "4000"))
+LATENCY_MS = float(os.getenv("FAKE_GRAPH_LATENCY_MS", "20"))
+THROTTLE_RATE = float(os.getenv("FAKE_GRAPH_THROTTLE_RATE", "0"))
+
+DOMAIN = "bench.example"
+_START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+app = FastAPI()
+
+_stats = {
+    "requests": 0, "throttled": 0, "moves": 0, "batches": 0, "messages_served": 0,
+    "bodies_served": 0, "message_bytes": 0,
+}
+# (user, message_id) -> new id after a move
+_moved = {}
+_folders = {}
+
+_PHISH_URLS = [
+    "http://192.168.14.2/login.php",
+    "https://secure-update.xyz/verify",
+    "https://microsoft-support.top/reset?user=",
+]
+_SAFE_URLS = [
+    "https://www.bench.example/news",
+    "https://docs.bench.example/handbook",
+]
+
+
+def _user(i: int) -> str:
+    return f"user{i:05d}@{DOMAIN}"
+
+
+def _message(user: str, i: int) -> dict:
+    """Deterministic synthetic message number i in a mailbox."""
+    rng = random.Random(f"{user}:{i}")
+    phishy = rng.random() < 0.2
+    external = phishy or rng.random() < 0.5
+    if external:
+        sender = f"alerts@{'phish-' if phishy else ''}vendor{rng.randint(1, 50)}.com"
+    else:
+        sender = f"colleague{rng.randint(1, 99)}@{DOMAIN}"
+    urls = rng.sample(_PHISH_URLS if phishy else _SAFE_URLS, 2)
+    subject = "Urgent: verify your account password" if phishy else f"Weekly update #{i}"
+    paragraph = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit. </p>"
+    filler = paragraph * max(1, BODY_BYTES // len(paragraph))
+    links = "".join(f'<a href="{u}">{u}</a><br>' for u in urls)
+    content = f"<html><body><p>Hello,</p>{filler}{links}</body></html>"
+    received = _START + timedelta(minutes=i)
+    return {
+        "id": f"{user}-msg-{i}",
+        "subject": subject,
+        "from": {"emailAddress": {"address": sender, "name": sender.split("@")[0]}},
+        "receivedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "bodyPreview": content[:255],
+        "hasAttachments": False,
+        "body": {"contentType": "html", "content": content},
+    }
+
+
+def _select(message: dict, select: str | None) -> dict:
+    if not select:
+        return message
+    fields = set(select.split(","))
+    return {k: v for k, v in message.items() if k in fields or k == "id"}
+
+
+def _as_text(message: dict) -> dict:
+    # Roughly what Graph's HTML-to-text conversion does: tags gone, links kept as <url>
+    html = message["body"]["content"]
+    text = re.sub(r'<a href="([^"]+)">[^<]*</a>', r"<\1>", html)
+    text = re.sub(r"<[^>]+>", " ", text)
+    return dict(message, body={"contentType": "text", "content": re.sub(r"\s+", " ", text).strip()})
+
+
+def _count(messages: list):
+    _stats["message_bytes"] += len(json.dumps(messages))
+
+
+def _base(request: Request) -> str:
+    return str(request.base_url).rstrip("/") + "/v1.0"
+
+
+@app.middleware("http")
+async def latency_and_throttling(request: Request, call_next):
+    _stats["requests"] += 1
+    if LATENCY_MS:
+        await asyncio.sleep(LATENCY_MS / 1000)
+    if request.url.path.startswith("/v1.0") and THROTTLE_RATE and random.random() < THROTTLE_RATE:
+        _stats["throttled"] += 1
+        return JSONResponse(
+            {"error": {"code": "TooManyRequests", "message": "Throttled by fake Graph"}},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+    return await call_next(request)
+
+
+@app.post("/token")
+async def token():
+    return {"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600}
+
+
+@app.get("/_stats")
+async def stats():
+    return _stats
+
+
+@app.get("/v1.0/users")
+async def users(request: Request):
+    skip = int(request.query_params.get("$skiptoken", "0"))
+    top = 50
+    value = [
+        {"id": f"id-{i}", "userPrincipalName": _user(i), "mail": _user(i)}
+        for i in range(skip, min(skip + top, USERS))
+    ]
+    data = {"value": value}
+    if skip + top < USERS:
+        data["@odata.nextLink"] = f"{_base(request)}/users?$skiptoken={skip + top}"
+    return data
+
+
+@app.get("/v1.0/users/{user}/mailFolders/inbox/messages/delta")
+async def delta(user: str, request: Request):
+    url = f"{_base(request)}/users/{user}/mailFolders/inbox/messages/delta"
+    if "$deltatoken" in request.query_params:
+        # Steady state: nothing new since the initial sync
+        return {"value": [], "@odata.deltaLink": f"{url}?$deltatoken=latest"}
+
+    skip = int(request.query_params.get("$skiptoken", "0"))
+    select = request.query_params.get("$select")
+    end = min(skip + PAGE_SIZE, MESSAGES)
+    value = [_select(_message(user, i), select) for i in range(skip, end)]
+    _stats["messages_served"] += len(value)
+    _count(value)
+    data = {"value": value}
+    if end < MESSAGES:
+        # Graph keeps the original $select in its links
+        data["@odata.nextLink"] = f"{url}?$skiptoken={end}" + (f"&$select={select}" if select else "")
+    else:
+        data["@odata.deltaLink"] = f"{url}?$deltatoken=latest"
+    return data
+
+
+@app.get("/v1.0/users/{user}/mailFolders/inbox")
+async def inbox(user: str):
+    return {"id": f"inbox-{user}", "displayName": "Inbox"}
+
+
+@app.get("/v1.0/users/{user}/mailFolders")
+async def list_folders(user: str):
+    folder = _folders.get(user)
+    return {"value": [folder] if folder else []}
+
+
+@app.post("/v1.0/users/{user}/mailFolders")
+async def create_folder(user: str, request: Request):
+    body = await request.json()
+    if user in _folders:
+        return JSONResponse({"error": {"code": "ErrorFolderExists"}}, status_code=409)
+    _folders[user] = {"id": f"folder-{user}", "displayName": body.get("displayName")}
+    return _folders[user]
+
+
+def _move(user: str, message_id: str, body: dict) -> tuple[int, dict]:
+    _stats["moves"] += 1
+    new_id = f"{message_id}-moved-{len(_moved)}"
+    _moved[(user, message_id)] = new_id
+    return 201, {"id": new_id, "parentFolderId": body.get("destinationId")}
+
+
+def _get_message(user: str, message_id: str, select: str | None = None, text: bool = False) -> tuple[int, dict]:
+    try:
+        i = int(message_id.rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        return 404, {"error": {"code": "ErrorItemNotFound"}}
+    message = _message(user, i)
+    if text:
+        message = _as_text(message)
+    message = _select(message, select)
+    if "body" in message:
+        _stats["bodies_served"] += 1
+    _count([message])
+    return 200, message
+
+
+def _wants_text(headers: dict) -> bool:
+    prefer = {k.lower(): v for k, v in (headers or {}).items()}.get("prefer", "")
+    return 'outlook.body-content-type="text"' in prefer
+
+
+@app.post("/v1.0/users/{user}/messages/{message_id}/move")
+async def move(user: str, message_id: str, request: Request):
+    status, body = _move(user, message_id, await request.json())
+    return JSONResponse(body, status_code=status)
+
+
+@app.get("/v1.0/users/{user}/messages/{message_id}")
+async def get_message(user: str, message_id: str, request: Request):
+    status, body = _get_message(
+        user, message_id, request.query_params.get("$select"), _wants_text(dict(request.headers))
+    )
+    return JSONResponse(body, status_code=status)
+
+
+@app.post("/v1.0/$batch")
+async def batch(request: Request):
+    _stats["batches"] += 1
+    payload = await request.json()
+    responses = []
+    for sub in payload.get("requests", []):
+        path, _, query = sub["url"].partition("?")
+        parts = path.strip("/").split("/")
+        select = dict(p.split("=", 1) for p in query.split("&") if "=" in p).get("$select")
+        status, body = 400, {"error": {"code": "BadRequest"}}
+        if len(parts) >= 4 and parts[0] == "users" and parts[2] == "messages":
+            user, message_id = parts[1], parts[3]
+            if sub["method"] == "POST" and parts[-1] == "move":
+                status, body = _move(user, message_id, sub.get("body") or {})
+            elif sub["method"] == "GET" and len(parts) == 4:
+                status, body = _get_message(user, message_id, select, _wants_text(sub.get("headers")))
+        responses.append({"id": sub["id"], "status": status, "body": body})
+    return {"responses": responses}
@@ -0,0 +1,88 @@
+"""
+Local stand-in for Ollama's /api/generate, with a configurable speed.
+
+Mimics CPU inference: each request takes prompt_tokens / FAKE_OLLAMA_PROMPT_TPS
+plus FAKE_OLLAMA_EVAL_TOKENS / FAKE_OLLAMA_TPS seconds, and at most
+FAKE_OLLAMA_PARALLEL requests run at once (like OLLAMA_NUM_PARALLEL).
+
+  FAKE_OLLAMA_TPS          generated tokens per second (default 200)
+  FAKE_OLLAMA_PROMPT_TPS   prompt tokens per second (default 2000)
+  FAKE_OLLAMA_EVAL_TOKENS  tokens generated per answer (default 60)
+  FAKE_OLLAMA_PARALLEL     concurrent generations (default 2)
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+
+TPS = float(os.getenv("FAKE_OLLAMA_TPS", "200"))
+PROMPT_TPS = float(os.getenv("FAKE_OLLAMA_PROMPT_TPS", "2000"))
+EVAL_TOKENS = int(os.getenv("FAKE_OLLAMA_EVAL_TOKENS", "60"))
+PARALLEL = int(os.getenv("FAKE_OLLAMA_PARALLEL", "2"))
+
+app = FastAPI()
+
+_slots = None
+_stats = {"requests": 0, "queued_peak": 0}
+_waiting = 0
+
+
+def _verdict(prompt: str) -> dict:
+    lowered = prompt.lower()
+    if "critical:" in lowered or "verify your account" in lowered:
+        return {
+            "risk_score": random.randint(75, 95),
+            "classification": "phishing",
+            "reasons": ["Credential harvesting language", "Suspicious link"],
+        }
+    return {
+        "risk_score": random.randint(5, 25),
+        "classification": "safe",
+        "reasons": ["Routine internal or newsletter content"],
+    }
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": "phi3:mini"}]}
+
+
+@app.get("/_stats")
+async def stats():
+    return _stats
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    global _slots, _waiting
+    if _slots is None:
+        _slots = asyncio.Semaphore(PARALLEL)
+
+    payload = await request.json()
+    prompt = payload.get("prompt", "")
+    prompt_tokens = max(1, len(prompt) // 4)
+
+    _stats["requests"] += 1
+    _waiting += 1
+    _stats["queued_peak"] = max(_stats["queued_peak"], _waiting)
+    async with _slots:
+        _waiting -= 1
+        started = time.perf_counter()
+        prompt_seconds = prompt_tokens / PROMPT_TPS
+        eval_seconds = EVAL_TOKENS / TPS
+        await asyncio.sleep(prompt_seconds + eval_seconds)
+        total = time.perf_counter() - started
+
+    return {
+        "model": payload.get("model"),
+        "response": json.dumps(_verdict(prompt)),
+        "done": True,
+        "total_duration": int(total * 1e9),
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": int(prompt_seconds * 1e9),
+        "eval_count": EVAL_TOKENS,
+        "eval_duration": int(eval_seconds * 1e9),
+    }
@@ -0,0 +1,155 @@
+"""
+Realistic, deterministic inputs for the microbenchmarks in bench/micro.py.
+"""
+import json
+import logging
+import random
+
+_rng = random.Random(1337)
+
+_WORDS = (
+    "account invoice meeting update security review quarterly team please "
+    "attached report schedule customer product launch offer exclusive member"
+).split()
+
+
+def _sentence(n: int = 12) -> str:
+    return " ".join(_rng.choice(_WORDS) for _ in range(n)).capitalize() + "."
+
+
+def newsletter_html(sections: int = 120, links_per_section: int = 3) -> str:
+    """A ~200 KB marketing newsletter: nested tables, inline styles, tracking links."""
+    parts = ['<html><head><style>td{font-family:Arial;color:#333}</style></head><body><table width="600">']
+    for s in range(sections):
+        links = "".join(
+            f'<a href="https://click.news-mailer.com/track/{s}/{i}?utm_source=newsletter&amp;'
+            f'utm_campaign=weekly&amp;uid=8f3a{s:04d}{i:02d}" style="color:#06c">Read more</a> '
+            for i in range(links_per_section)
+        )
+        parts.append(
+            f'<tr><td style="padding:12px"><h2>{_sentence(5)}</h2>'
+            f"<p>{_sentence(40)}</p><p>{_sentence(30)}</p>{links}"
+            f'<img src="https://cdn.news-mailer.com/img/{s}.png" width="560"></td></tr>'
+        )
+    parts.append(
+        '<tr><td><a href="https://news-mailer.com/unsubscribe?u=123">Unsubscribe</a></td></tr>'
+        "</table></body></html>"
+    )
+    return "".join(parts)
+
+
+def phishing_text(urls: int = 60) -> str:
+    """URL-heavy credential phish: IP hosts, suspicious TLDs, lookalike domains."""
+    hosts = [
+        "185.220.101.{n}",
+        "login-microsoftonline-{n}.xyz",
+        "secure-docs-{n}.top",
+        "www.paypa1-verify-{n}.click",
+        "sharepoint-{n}.zip",
+        "office365.{n}.link",
+    ]
+    lines = [
+        "Dear user,",
+        "Your mailbox storage is full. Verify your account immediately or it will be suspended.",
+    ]
+    for i in range(urls):
+        host = hosts[i % len(hosts)].format(n=i)
+        scheme = "http" if i % 2 else "https"
+        lines.append(f"Step {i}: visit {scheme}://{host}/auth/login.php?session={i:08x}&next=%2Finbox).")
+    lines.append("Regards, IT Helpdesk")
+    return "\n".join(lines)
+
+
+# Raw model outputs as seen from phi3/llama in production logs
+MODEL_OUTPUTS = {
+    "clean": '{"risk_score": 85, "classification": "phishing", "reasons": ["Credential request", "IP URL"]}',
+    "markdown_fenced": (
+        "Here is my analysis:\n```json\n"
+        '{\n  "risk_score": 72,\n  "classification": "Phishing",\n'
+        '  "reasons": ["Urgent tone", "Lookalike domain"]\n}\n```\nLet me know if you need more.'
+    ),
+    "chatty_prefix": (
+        "Sure! Based on the sender and links, the result is "
+        '{"risk_score": 15, "classification": "safe", "reasons": ["Known newsletter"]} '
+        "I hope this helps."
+    ),
+    "missing_score": '{"classification": "spam", "reasons": ["Bulk marketing"]}',
+    "truncated": '{"risk_score": 90, "classification": "malicious", "reasons": ["Macro attach',
+}
+
+
+def classify_payload(body: str, urls: list, warnings: list) -> dict:
+    return {
+        "sender": "it-helpdesk@login-microsoftonline-3.xyz",
+        "subject": "ACTION REQUIRED: Mailbox quota exceeded",
+        "body": body[:2000] + "\n...[TRUNCATED]...",
+        "urls": urls,
+        "url_warnings": warnings,
+    }
+
+
+def log_record() -> logging.LogRecord:
+    record = logging.LogRecord(
+        name="services.poller",
+        level=logging.WARNING,
+        pathname=__file__,
+        lineno=1,
+        msg="moved message to AI-Quarantine",
+        args=(),
+        exc_info=None,
+    )
+    for key, value in {
+        "user_email": "user00042@bench.example",
+        "message_id": "AAMkAGI2TG93AAA=",
+        "risk_score": 88,
+        "classification": "phishing",
+        "is_external": True,
+        "rule": "phishing & risk>=50",
+    }.items():
+        setattr(record, key, value)
+    return record
+
+
+def policy_config(domains: int = 2000, senders: int = 2000, mailboxes: int = 500) -> dict:
+    """A large policy file: shared block/allow lists, a strict group and per-mailbox overrides."""
+    return {
+        "defaults": {
+            "internal_domains": ["bench.example"],
+            "deny_domains": [f"blocked-{i}.example" for i in range(domains)],
+            "allow_domains": [f"partner-{i}.example" for i in range(domains)],
+            "deny_senders": [f"spammer{i}@freemail.example" for i in range(senders)],
+        },
+        "groups": {
+            "executives": {
+                "members": [f"exec{i}@bench.example" for i in range(20)],
+                "phishing_threshold": 30,
+                "deny_domains": [f"lookalike-{i}.example" for i in range(100)],
+            },
+        },
+        "mailboxes": {
+            f"user{i:05d}@bench.example": {"spam_threshold": 90, "allow_senders": [f"vendor{i}@supplier.example"]}
+            for i in range(mailboxes)
+        },
+    }
+
+
+def quarantine_row(i: int) -> tuple:
+    """A quarantine_events row in _EVENT_COLUMNS order."""
+    moved = i % 5 == 0
+    reasons = json.dumps(["Suspicious link", "Urgent tone"]) if moved else "[]"
+    return (
+        i,
+        f"AAMkAGI2-{i:08d}",
+        f"sender{i % 300}@vendor{i % 40}.com",
+        f"Weekly update #{i}",
+        "2025-11-20T10:00:00Z",
+        85 if moved else 10,
+        "phishing" if moved else "safe",
+        reasons,
+        int(moved),
+        "2025-11-20T10:00:05Z",
+        0,
+        None,
+        f"user{i % 200:05d}@bench.example",
+        None,
+    )
@@ -0,0 +1,262 @@
+"""
+Microbenchmarks for the CPU-bound per-message hot paths.
+
+Covers URL extraction and reputation checks, llm-api prompt building and
+model-output JSON scraping, the JSON log formatter, policy evaluation, and
+quarantine_events row-to-dict conversion. Timings are per call, using the min and median of
+several repeats (like pytest-benchmark).
+
+Usage:
+    python -m bench.micro                          # run and print
+    python -m bench.micro --save                   # store as the baseline
+    python -m bench.micro --compare                # fail (exit 1) on regressions
+    python -m bench.micro --compare --tolerance 0.3 -k url
+
+Baselines are machine-specific: record them on the machine that runs the
+gate (e.g. CI, from main) and compare branches there.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from bench import fixtures
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CASES = {}
+
+
+def case(name: str):
+    """Register a benchmark. The function does its setup and returns the callable to time."""
+    def register(fn):
+        CASES[name] = fn
+        return fn
+    return register
+
+
+# ---------- URL analysis ----------
+
+@case("url.extract_urls.newsletter")
+def _extract_newsletter():
+    from services.url_analysis import extract_urls
+    html = fixtures.newsletter_html()
+    return lambda: extract_urls(html)
+
+
+@case("url.extract_urls.phishing")
+def _extract_phishing():
+    from services.url_analysis import extract_urls
+    text = fixtures.phishing_text()
+    return lambda: extract_urls(text)
+
+
+@case("url.analyze_url_reputation.phishing")
+def _reputation_phishing():
+    from services.url_analysis import extract_urls, analyze_url_reputation
+    urls = extract_urls(fixtures.phishing_text())
+    return lambda: analyze_url_reputation(urls)
+
+
+@case("url.analyze_url_reputation.newsletter")
+def _reputation_newsletter():
+    from services.url_analysis import extract_urls, analyze_url_reputation
+    urls = extract_urls(fixtures.newsletter_html())
+    return lambda: analyze_url_reputation(urls)
+
+
+# ---------- llm-api ----------
+
+def _llm_api():
+    return importlib.import_module("llm-api.api.main")
+
+
+@case("llm_api.build_prompt")
+def _build_prompt():
+    from services.url_analysis import extract_urls, analyze_url_reputation
+    api = _llm_api()
+    text = fixtures.phishing_text()
+    urls = extract_urls(text)
+    payload = fixtures.classify_payload(text, urls, analyze_url_reputation(urls))
+    return lambda: api.build_prompt(payload)
+
+
+def _parse_case(variant: str):
+    def setup():
+        api = _llm_api()
+        content = fixtures.MODEL_OUTPUTS[variant]
+
+        def run():
+            try:
+                api.parse_model_output(content)
+            except ValueError:
+                pass
+        return run
+    return setup
+
+
+for _variant in fixtures.MODEL_OUTPUTS:
+    case(f"llm_api.parse_model_output.{_variant}")(_parse_case(_variant))
+
+
+# ---------- logging ----------
+
+@case("logging.json_formatter")
+def _json_formatter():
+    from services.logging_utils import JsonFormatter, DATE_FORMAT
+    formatter = JsonFormatter(datefmt=DATE_FORMAT)
+    record = fixtures.log_record()
+    return lambda: formatter.format(record)
+
+
+# ---------- policy ----------
+
+def _policy_case(sender: str):
+    def setup():
+        from services.policy import PolicySet
+        policies = PolicySet(fixtures.policy_config())
+        mailbox = "exec1@bench.example"
+        return lambda: policies.for_mailbox(mailbox).check_sender(sender)
+    return setup
+
+
+# Per-message evaluation cost: a miss walks every list, a hit stops early
+case("policy.evaluate.miss")(_policy_case("someone@mail.unlisted-sender.example"))
+case("policy.evaluate.deny_subdomain")(_policy_case("billing@eu.mail.blocked-7.example"))
+
+
+# ---------- database ----------
+
+@case("db.row_to_event.x500")
+def _row_to_event():
+    from services.db import _row_to_event
+    rows = [fixtures.quarantine_row(i) for i in range(500)]
+    return lambda: [_row_to_event(r) for r in rows]
+
+
+@case("db.list_quarantine_events.limit200")
+def _list_events():
+    from services import db
+    db.init_db()
+    conn = db._connect()
+    conn.executemany(
+        """
+        INSERT INTO quarantine_events
+            (id, message_id, sender, subject, received_datetime, risk_score,
+             classification, reasons, moved, created_at, released, released_at, user_email)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [fixtures.quarantine_row(i) for i in range(1, 5001)],
+    )
+    conn.commit()
+    conn.close()
+    return lambda: db.list_quarantine_events(200)
+
+
+# ---------- runner ----------
+
+def measure(fn, min_time: float, repeats: int) -> dict:
+    # Calibrate so each repeat runs for at least min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    per_call = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - start) / number)
+
+    return {
+        "min_us": min(per_call) * 1e6,
+        "median_us": statistics.median(per_call) * 1e6,
+        "rounds": repeats,
+        "iterations": number,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, stat: str) -> list:
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        ratio = current[stat] / base[stat] if base[stat] else 1.0
+        current["vs_baseline"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append((name, base[stat], current[stat], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="filter", help="only run cases whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.05, help="seconds per round")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 if any case regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--stat", choices=["min_us", "median_us"], default="median_us")
+    args = parser.parse_args()
+
+    # Keep the DB case away from data/quarantine.db
+    workdir = tempfile.mkdtemp(prefix="eos-micro-")
+    os.environ["QUARANTINE_DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    results = {}
+    for name, setup in CASES.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(setup(), args.min_time, args.rounds)
+
+    regressions = []
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"no baseline at {args.baseline}; run with --save first", file=sys.stderr)
+            sys.exit(2)
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.stat)
+
+    width = max(len(n) for n in results) if results else 0
+    print(f"{'case':<{width}}  {'min µs':>10}  {'median µs':>10}  {'vs base':>8}")
+    for name, r in results.items():
+        vs = f"{r['vs_baseline']:.2f}x" if "vs_baseline" in r else "-"
+        print(f"{name:<{width}}  {r['min_us']:>10.2f}  {r['median_us']:>10.2f}  {vs:>8}")
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "machine": platform.node(),
+                    "python": platform.python_version(),
+                    "saved_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"baseline written to {args.baseline}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:", file=sys.stderr)
+        for name, base, current, ratio in regressions:
+            print(f"  {name}: {base:.2f} -> {current:.2f} µs ({ratio:.2f}x)", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Admission control in front of Ollama.
+
+At most OLLAMA_CONCURRENCY generations run at once; further requests wait in
+a FIFO queue of at most LLM_QUEUE_LIMIT entries, and anything beyond that is
+turned away immediately (503 + Retry-After) instead of piling up until its
+caller times out. Every request carries a deadline (X-Request-Timeout, capped
+by LLM_REQUEST_TIMEOUT): a queued request whose callers have all given up is
+dropped before it reaches Ollama, and a running one is cancelled.
+
+Requests with an identical prompt share one queue entry and one Ollama call,
+e.g. the same campaign mail landing in many mailboxes at once.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from .metrics import Counter, Gauge, Histogram
+
+# Generations sent to Ollama at once; match OLLAMA_NUM_PARALLEL
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "2"))
+# Requests allowed to wait for a slot before new ones get a 503
+LLM_QUEUE_LIMIT = int(os.getenv("LLM_QUEUE_LIMIT", "32"))
+# Deadline for requests without X-Request-Timeout, and the cap for those with one
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "300"))
+
+# Assumed generation time until real ones have been observed
+_DEFAULT_SERVICE_SECONDS = 10.0
+
+QUEUE_DEPTH = Gauge("llm_api_queue_depth", "Requests waiting for an Ollama slot", ())
+QUEUE_WAIT_SECONDS = Histogram(
+    "llm_api_queue_wait_seconds", "Time from admission until Ollama was called", ()
+)
+REJECTED = Counter(
+    "llm_api_rejected_total", "Requests refused or dropped (queue_full, deadline)", ("reason",)
+)
+COALESCED = Counter(
+    "llm_api_coalesced_total", "Requests answered by an identical in-flight prompt", ()
+)
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _Flight:
+    """One queued or running Ollama call and the callers waiting for it."""
+
+    __slots__ = ("key", "work", "deadline", "callers", "queued_at", "future", "task")
+
+    def __init__(self, key: str, work, deadline: float):
+        self.key = key
+        self.work = work
+        self.deadline = deadline
+        self.callers = 0
+        self.queued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        # Nobody may be left to read a failure; don't warn about it
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.task = None
+
+
+class AdmissionQueue:
+    def __init__(self, concurrency: int = OLLAMA_CONCURRENCY, limit: int = LLM_QUEUE_LIMIT):
+        self.concurrency = max(1, concurrency)
+        self.limit = limit
+        self.running = 0
+        self._queue: deque[_Flight] = deque()
+        self._flights: dict[str, _Flight] = {}
+        self._service = deque(maxlen=64)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up, from recent generation times."""
+        avg = sum(self._service) / len(self._service) if self._service else _DEFAULT_SERVICE_SECONDS
+        ahead = len(self._queue) + self.running
+        return max(1, math.ceil(avg * ahead / self.concurrency))
+
+    async def submit(self, key: str, work, timeout: float | None = None):
+        """
+        Run `work()` (a coroutine function) once a slot is free and return its
+        result. Raises QueueFull or DeadlineExceeded.
+        """
+        timeout = min(timeout, LLM_REQUEST_TIMEOUT) if timeout else LLM_REQUEST_TIMEOUT
+        deadline = time.monotonic() + timeout
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            COALESCED.inc()
+            flight.deadline = max(flight.deadline, deadline)
+        else:
+            if self.running >= self.concurrency:
+                self._drop_expired()
+                if len(self._queue) >= self.limit:
+                    REJECTED.inc(reason="queue_full")
+                    raise QueueFull(self.retry_after())
+            flight = _Flight(key, work, deadline)
+            self._flights[key] = flight
+            self._queue.append(flight)
+            self._dispatch()
+
+        flight.callers += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.future), timeout)
+        except asyncio.TimeoutError:
+            REJECTED.inc(reason="deadline")
+            raise DeadlineExceeded(f"no answer within {timeout:g}s") from None
+        except DeadlineExceeded:
+            REJECTED.inc(reason="deadline")
+            raise
+        finally:
+            flight.callers -= 1
+            if not flight.callers and not flight.future.done():
+                self._abandon(flight)
+
+    def _abandon(self, flight: _Flight):
+        # Every caller has gone: don't spend Ollama time on the answer
+        if flight.task is not None:
+            flight.task.cancel()
+        else:
+            self._queue.remove(flight)
+            self._forget(flight)
+            flight.future.cancel()
+            QUEUE_DEPTH.set(len(self._queue))
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for flight in [f for f in self._queue if f.deadline <= now]:
+            self._queue.remove(flight)
+            self._forget(flight)
+            flight.future.set_exception(DeadlineExceeded("expired while queued"))
+
+    def _forget(self, flight: _Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self._queue:
+            flight = self._queue.popleft()
+            now = time.monotonic()
+            if flight.deadline <= now:
+                self._forget(flight)
+                flight.future.set_exception(DeadlineExceeded("expired while queued"))
+                continue
+            QUEUE_WAIT_SECONDS.observe(now - flight.queued_at)
+            self.running += 1
+            flight.task = asyncio.create_task(self._run(flight))
+        QUEUE_DEPTH.set(len(self._queue))
+
+    async def _run(self, flight: _Flight):
+        started = time.monotonic()
+        try:
+            result = await flight.work()
+        except asyncio.CancelledError:
+            flight.future.cancel()
+        except Exception as exc:
+            flight.future.set_exception(exc)
+        else:
+            self._service.append(time.monotonic() - started)
+            flight.future.set_result(result)
+        finally:
+            self.running -= 1
+            self._forget(flight)
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": len(self._queue),
+            "concurrency": self.concurrency,
+            "queue_limit": self.limit,
+        }
@@ -1,8 +1,25 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
+import hashlib
 import httpx
 import json
+import os
+import time
 
-OLLAMA_URL = "http://127.0.0.1:11434/api/generate"
+from .admission import AdmissionQueue, DeadlineExceeded, QueueFull
+from .metrics import Counter, Gauge, Histogram, render_metrics
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434/api/generate")
+# Model cascade: FAST_MODEL answers everything; uncertain verdicts are re-run
+# on SLOW_MODEL (unset = no cascade)
+FAST_MODEL = os.getenv("FAST_MODEL", "phi3:mini")
+SLOW_MODEL = os.getenv("SLOW_MODEL", "")
+# Fast-model risk scores in this range (inclusive) are escalated
+ESCALATE_RISK_MIN = int(os.getenv("ESCALATE_RISK_MIN", "40"))
+ESCALATE_RISK_MAX = int(os.getenv("ESCALATE_RISK_MAX", "70"))
+# Phishing/malicious verdicts below RISK_THRESHOLD + this margin are escalated
+ESCALATE_MARGIN = int(os.getenv("ESCALATE_MARGIN", "20"))
+RISK_THRESHOLD = int(os.getenv("RISK_THRESHOLD", "60"))
 
 EMAIL_CLASSIFIER_PROMPT = """
 You are an AI email threat classifier.
@@ -26,11 +43,13 @@ Consider:
 - Subject urgency and pressure language.
 - Requests for credentials, payments, wire transfers, gift cards, etc.
 - ANY links or URLs (domains, paths, suspicious TLDs, IP-based URLs).
+- Attachment names and types (executables, macros, double extensions).
 - Consistency between sender and content.
 
 Email Metadata:
 From: {sender}
 Subject: {subject}
+Sender history: {sender_history}
 
 System Detected Warnings (heuristic analysis):
 {warnings_section}
@@ -41,6 +60,9 @@ Body Preview:
 Links found in the email body:
 {urls_section}
 
+Attachments:
+{attachments_section}
+
 Task:
 1. Evaluate overall threat level (safe/spam/phishing/malicious).
 2. Assign a numeric risk_score (0-100) where:
@@ -56,100 +78,264 @@ Return ONLY the JSON object. No markdown, no comments, no extra text.
 
 app = FastAPI()
 
+REQUEST_SECONDS = Histogram(
+    "llm_api_request_seconds", "Total /classify handling time", ("model",)
+)
+OLLAMA_SECONDS = Histogram(
+    "llm_api_ollama_seconds", "Ollama /api/generate round trip", ("model",)
+)
+OLLAMA_PROMPT_EVAL_SECONDS = Histogram(
+    "llm_api_ollama_prompt_eval_seconds", "Ollama prompt evaluation time", ("model",)
+)
+OLLAMA_EVAL_SECONDS = Histogram(
+    "llm_api_ollama_eval_seconds", "Ollama token generation time", ("model",)
+)
+OLLAMA_TOKENS = Counter(
+    "llm_api_ollama_tokens_total", "Tokens processed by Ollama", ("model", "kind")
+)
+CLASSIFICATIONS = Counter(
+    "llm_api_classifications_total", "Verdicts returned", ("model", "classification")
+)
+PARSE_FAILURES = Counter(
+    "llm_api_parse_failures_total", "Model outputs that were not valid JSON", ("model",)
+)
+IN_FLIGHT = Gauge("llm_api_in_flight", "Requests currently being classified", ())
+ESCALATIONS = Counter(
+    "llm_api_escalations_total",
+    "Fast-model verdicts re-run on the slow model (band, near_threshold, parse_failure)",
+    ("reason",),
+)
+ESCALATION_SECONDS = Histogram(
+    "llm_api_escalation_seconds", "Latency added by slow-model escalations", ()
+)
+ESCALATION_FAILURES = Counter(
+    "llm_api_escalation_failures_total", "Escalations that failed; the fast verdict was kept", ()
+)
+
+admission = AdmissionQueue()
+
+
+@app.get("/health")
+async def health():
+    """
+    Health probe used by the poller's backend pool.
+    Reports unhealthy (503) when Ollama itself is unreachable.
+    """
+    try:
+        async with httpx.AsyncClient(timeout=3.0) as client:
+            r = await client.get(OLLAMA_URL.replace("/api/generate", "/api/tags"))
+            r.raise_for_status()
+    except Exception:
+        return JSONResponse({"status": "ollama unreachable"}, status_code=503)
+    return {"status": "ok", **admission.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def _observe_ollama_timings(model: str, data: dict):
+    # Ollama reports durations in nanoseconds
+    if data.get("prompt_eval_duration"):
+        OLLAMA_PROMPT_EVAL_SECONDS.observe(data["prompt_eval_duration"] / 1e9, model=model)
+    if data.get("eval_duration"):
+        OLLAMA_EVAL_SECONDS.observe(data["eval_duration"] / 1e9, model=model)
+    OLLAMA_TOKENS.inc(data.get("prompt_eval_count") or 0, model=model, kind="prompt")
+    OLLAMA_TOKENS.inc(data.get("eval_count") or 0, model=model, kind="eval")
+
 
 @app.post("/classify")
-async def classify_email(email: dict):
+async def classify_email(email: dict, x_request_timeout: float | None = Header(None)):
+    """
+    Classify one email. X-Request-Timeout (seconds) is how long the caller
+    will wait; the request is dropped (504) once that has passed. 503 with
+    Retry-After means the queue is full and another backend should be tried.
+    """
+    IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        result = await _classify(email, x_request_timeout)
+    except QueueFull as exc:
+        return JSONResponse(
+            {"detail": str(exc)}, status_code=503, headers={"Retry-After": str(exc.retry_after)}
+        )
+    except DeadlineExceeded as exc:
+        return JSONResponse({"detail": str(exc)}, status_code=504)
+    finally:
+        IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(time.perf_counter() - started, model=result.get("model", ""))
+    CLASSIFICATIONS.inc(model=result.get("model", ""), classification=result.get("classification"))
+    return result
+
+
+def build_prompt(email: dict) -> str:
+    """Render the classifier prompt for a /classify payload."""
     sender = email.get("sender", "")
     subject = email.get("subject", "")
     body = email.get("body", "")
     urls = email.get("urls", []) or []
-    warnings = email.get("url_warnings", []) or []
+    warnings = (email.get("url_warnings", []) or []) + (email.get("attachment_warnings", []) or [])
+    attachments = email.get("attachments", []) or []
 
     if urls:
         urls_section = "\n".join(f"- {u}" for u in urls)
     else:
         urls_section = "No links detected."
 
+    if attachments:
+        attachments_section = "\n".join(f"- {a}" for a in attachments)
+    else:
+        attachments_section = "None."
+
     if warnings:
         warnings_section = "\n".join(f"CRITICAL: {w}" for w in warnings)
     else:
         warnings_section = "None."
 
-    prompt = EMAIL_CLASSIFIER_PROMPT.format(
+    return EMAIL_CLASSIFIER_PROMPT.format(
         sender=sender,
         subject=subject,
+        sender_history=email.get("sender_history") or "No previous mail from this sender.",
         body=body,
         urls_section=urls_section,
+        attachments_section=attachments_section,
         warnings_section=warnings_section,
     )
 
+
+def parse_model_output(content: str) -> dict:
+    """
+    Extract and normalize the verdict JSON from raw model output.
+    Raises if no valid JSON object can be recovered.
+    """
+    # 1. Strip markdown code blocks if present
+    clean_content = content.strip()
+    if "```json" in clean_content:
+        clean_content = clean_content.split("```json")[1].split("```")[0]
+    elif "```" in clean_content:
+        clean_content = clean_content.split("```")[1].split("```")[0]
+
+    # 2. Find the first '{' and last '}' to isolate the JSON object
+    start = clean_content.find("{")
+    end = clean_content.rfind("}")
+
+    if start != -1 and end != -1:
+        clean_content = clean_content[start : end + 1]
+
+    result = json.loads(clean_content)
+
+    # Basic sanity normalization
+    classification = (result.get("classification") or "spam").lower()
+    risk_score = result.get("risk_score")
+
+    if risk_score is None:
+        # Default by classification if missing
+        if classification == "safe":
+            risk_score = 10
+        elif classification == "spam":
+            risk_score = 40
+        elif classification in {"phishing", "malicious"}:
+            risk_score = 80
+        else:
+            risk_score = 50
+
+    # Clamp range 0-100
+    risk_score = max(0, min(int(risk_score), 100))
+
+    # Calibrate risk to match classification
+    if classification == "safe" and risk_score > 30:
+        risk_score = 20  # safe should be low
+    elif classification == "spam" and risk_score < 20:
+        risk_score = 35
+    elif classification in {"phishing", "malicious"} and risk_score < 60:
+        risk_score = 75
+
+    result["classification"] = classification
+    result["risk_score"] = risk_score
+
+    if "reasons" not in result:
+        result["reasons"] = ["Model did not provide reasons"]
+
+    return result
+
+
+async def _classify(email: dict, timeout: float | None = None) -> dict:
+    prompt = build_prompt(email)
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return await admission.submit(key, lambda: _cascade(prompt), timeout)
+
+
+def escalation_reason(result: dict, parsed: bool) -> str | None:
+    """Why a fast-model verdict should be re-run on SLOW_MODEL, or None to keep it."""
+    if not SLOW_MODEL or SLOW_MODEL == FAST_MODEL:
+        return None
+    if not parsed:
+        return "parse_failure"
+    risk = result["risk_score"]
+    if ESCALATE_RISK_MIN <= risk <= ESCALATE_RISK_MAX:
+        return "band"
+    if result["classification"] in {"phishing", "malicious"} and risk < RISK_THRESHOLD + ESCALATE_MARGIN:
+        return "near_threshold"
+    return None
+
+
+async def _cascade(prompt: str) -> dict:
+    """
+    FAST_MODEL first; uncertain verdicts go to SLOW_MODEL. "model" in the
+    result is the model that decided, "escalated" the reason it was re-run.
+    """
+    result, parsed = await _generate(FAST_MODEL, prompt)
+    reason = escalation_reason(result, parsed)
+    if reason is None:
+        return result
+
+    ESCALATIONS.inc(reason=reason)
+    started = time.perf_counter()
+    try:
+        final, final_parsed = await _generate(SLOW_MODEL, prompt)
+    except Exception:
+        # Slow model unavailable: the fast verdict still stands
+        ESCALATION_FAILURES.inc()
+        return result
+    if not final_parsed:
+        # Its fail-closed fallback must not replace a real fast verdict
+        ESCALATION_FAILURES.inc()
+        return result
+    ESCALATION_SECONDS.observe(time.perf_counter() - started)
+    final["escalated"] = reason
+    final["fast_verdict"] = {
+        "model": FAST_MODEL,
+        "classification": result["classification"],
+        "risk_score": result["risk_score"],
+    }
+    return final
+
+
+async def _generate(model: str, prompt: str) -> tuple[dict, bool]:
+    """One Ollama call. Returns (verdict, whether the output parsed)."""
     payload = {
-        "model": "phi3:mini",
+        "model": model,
         "prompt": prompt,
         "temperature": 0.1,
         "num_predict": 128,
         "stream": False,
     }
 
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        r = await client.post(OLLAMA_URL, json=payload)
-        r.raise_for_status()
-        data = r.json()
-        content = data.get("response", "")
+    with OLLAMA_SECONDS.time(model=model):
+        async with httpx.AsyncClient(timeout=300.0) as client:
+            r = await client.post(OLLAMA_URL, json=payload)
+            r.raise_for_status()
+            data = r.json()
+            content = data.get("response", "")
+    _observe_ollama_timings(model, data)
 
     # Try to parse JSON from the response
     try:
-        # 1. Strip markdown code blocks if present
-        clean_content = content.strip()
-        if "```json" in clean_content:
-            clean_content = clean_content.split("```json")[1].split("```")[0]
-        elif "```" in clean_content:
-            clean_content = clean_content.split("```")[1].split("```")[0]
-        
-        # 2. Find the first '{' and last '}' to isolate the JSON object
-        start = clean_content.find("{")
-        end = clean_content.rfind("}")
-        
-        if start != -1 and end != -1:
-            clean_content = clean_content[start : end + 1]
-            
-        result = json.loads(clean_content)
-
-        # Basic sanity normalization
-        classification = (result.get("classification") or "spam").lower()
-        risk_score = result.get("risk_score")
-
-        if risk_score is None:
-            # Default by classification if missing
-            if classification == "safe":
-                risk_score = 10
-            elif classification == "spam":
-                risk_score = 40
-            elif classification in {"phishing", "malicious"}:
-                risk_score = 80
-            else:
-                risk_score = 50
-
-        # Clamp range 0-100
-        risk_score = max(0, min(int(risk_score), 100))
-
-        # Calibrate risk to match classification
-        if classification == "safe" and risk_score > 30:
-            risk_score = 20  # safe should be low
-        elif classification == "spam" and risk_score < 20:
-            risk_score = 35
-        elif classification in {"phishing", "malicious"} and risk_score < 60:
-            risk_score = 75
-
-        result["classification"] = classification
-        result["risk_score"] = risk_score
-
-        if "reasons" not in result:
-            result["reasons"] = ["Model did not provide reasons"]
-
-        return result
-
+        result = parse_model_output(content)
     except Exception:
+        PARSE_FAILURES.inc(model=model)
         # Fallback: treat as high risk if we can't parse JSON
         return {
             "risk_score": 90,
@@ -157,4 +343,8 @@ async def classify_email(email: dict):
             "reasons": [
                 "Model returned invalid JSON. Failing closed as phishing."
             ],
-        }
\ No newline at end of file
+            "model": model,
+        }, False
+
+    result["model"] = model
+    return result, True
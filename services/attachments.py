@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import zipfile
+
+from services.db import get_attachment_verdict, save_attachment_verdict
+from services.graph_client import iter_attachment_content, list_attachments
+from services.logging_utils import get_logger
+from services.metrics import Counter
+
+ATTACHMENT_INSPECTION_ENABLED = os.getenv("ATTACHMENT_INSPECTION_ENABLED", "true").lower() == "true"
+# Larger attachments are flagged as uninspectable instead of downloaded
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(25 * 1024 * 1024)))
+ATTACHMENT_MAX_ARCHIVE_ENTRIES = int(os.getenv("ATTACHMENT_MAX_ARCHIVE_ENTRIES", "1000"))
+# Where attachment content is spooled for deep inspection (default: system temp)
+ATTACHMENT_TMP_DIR = os.getenv("ATTACHMENT_TMP_DIR") or None
+
+# Executable or script content that mail has no business delivering
+RISKY_EXTENSIONS = {
+    "exe", "scr", "com", "pif", "bat", "cmd", "msi", "msp", "dll", "cpl", "jar",
+    "js", "jse", "vbs", "vbe", "wsf", "wsh", "ps1", "psm1", "hta", "lnk", "reg",
+    "iso", "img", "vhd", "vhdx", "one", "xll", "chm", "appx", "msix",
+}
+MACRO_EXTENSIONS = {"docm", "dotm", "xlsm", "xltm", "xlsb", "xlam", "pptm", "potm", "ppam", "ppsm", "sldm"}
+# Harmless-looking types used as the decoy in names like "invoice.pdf.exe"
+DECOY_EXTENSIONS = {
+    "pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "txt", "rtf", "csv",
+    "jpg", "jpeg", "png", "gif", "htm", "html", "mp3", "mp4",
+}
+OOXML_EXTENSIONS = {"docx", "dotx", "xlsx", "xltx", "pptx", "potx", "ppsx"} | MACRO_EXTENSIONS
+OLE_EXTENSIONS = {"doc", "dot", "xls", "xlt", "ppt", "pps"}
+# Archives we can't open with the standard library
+OPAQUE_ARCHIVE_EXTENSIONS = {"rar", "7z", "ace", "arj", "cab", "gz", "tgz", "bz2", "xz", "tar"}
+
+# Types whose content gets downloaded and opened
+DEEP_INSPECTION_EXTENSIONS = {"zip", "pdf"} | OOXML_EXTENSIONS | OLE_EXTENSIONS
+DEEP_INSPECTION_CONTENT_TYPES = {
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/pdf",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "application/octet-stream",
+}
+
+_OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+_OLE_MARKERS = {"_VBA_PROJECT".encode("utf-16-le"): "Office document contains VBA macros"}
+_PDF_MARKERS = {
+    b"/JavaScript": "PDF contains JavaScript",
+    b"/Launch": "PDF can launch external programs",
+    b"/EmbeddedFile": "PDF carries embedded files",
+}
+
+ATTACHMENT_INSPECTIONS = Counter(
+    "attachment_inspections_total",
+    "Attachment content checks by outcome (inspected, cached, too_large, error).",
+    ("result",),
+)
+
+logger = get_logger(__name__)
+
+# sha256 -> inspection task, so concurrent copies of one payload are opened once
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _extensions(name: str) -> list[str]:
+    return [e for e in name.lower().rstrip(" .").split(".")[1:] if e]
+
+
+def check_filename(name: str) -> list[str]:
+    """Warnings from the file name alone: risky types, double extensions, disguises."""
+    warnings = []
+    if "\u202e" in name:
+        warnings.append(f"Attachment name uses a right-to-left override to hide its extension: {name!r}")
+    exts = _extensions(name)
+    if not exts:
+        return warnings
+    ext = exts[-1]
+    if ext in RISKY_EXTENSIONS:
+        warnings.append(f"Risky attachment type .{ext}: {name}")
+        if len(exts) >= 2 and exts[-2] in DECOY_EXTENSIONS:
+            warnings.append(f"Double extension disguises .{ext} as .{exts[-2]}: {name}")
+    elif ext in MACRO_EXTENSIONS:
+        warnings.append(f"Macro-enabled Office document: {name}")
+    elif ext in OPAQUE_ARCHIVE_EXTENSIONS:
+        warnings.append(f"Archive type .{ext} cannot be inspected: {name}")
+    if "   ." in name:
+        warnings.append(f"Attachment name pads spaces before its extension: {name!r}")
+    return warnings
+
+
+def needs_deep_inspection(attachment: dict) -> bool:
+    exts = _extensions(attachment.get("name") or "")
+    if exts and exts[-1] in DEEP_INSPECTION_EXTENSIONS:
+        return True
+    return (attachment.get("contentType") or "").lower() in DEEP_INSPECTION_CONTENT_TYPES
+
+
+def _wants_content(attachment: dict) -> bool:
+    # Only file attachments have content; attached emails / links are named only
+    if attachment.get("@odata.type", "#microsoft.graph.fileAttachment") != "#microsoft.graph.fileAttachment":
+        return False
+    if attachment.get("isInline") and (attachment.get("contentType") or "").startswith("image/"):
+        return False
+    return needs_deep_inspection(attachment)
+
+
+def _scan_markers(path: str, markers: dict) -> list[str]:
+    """Stream a file looking for byte markers (chunk overlap catches split matches)."""
+    found = []
+    overlap = max(len(m) for m in markers) - 1
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            window = tail + chunk
+            for marker, warning in markers.items():
+                if warning not in found and marker in window:
+                    found.append(warning)
+            tail = window[-overlap:]
+    return found
+
+
+def _inspect_zip(fileobj, depth: int = 0) -> list[str]:
+    warnings = []
+    with zipfile.ZipFile(fileobj) as zf:
+        infos = zf.infolist()
+        if len(infos) > ATTACHMENT_MAX_ARCHIVE_ENTRIES:
+            warnings.append(f"Archive has {len(infos)} entries; only the first {ATTACHMENT_MAX_ARCHIVE_ENTRIES} were checked")
+            infos = infos[:ATTACHMENT_MAX_ARCHIVE_ENTRIES]
+        names = {i.filename.lower() for i in infos}
+
+        if "[content_types].xml" in names:
+            # Office Open XML document
+            if any(n.endswith("vbaproject.bin") for n in names):
+                warnings.append("Office document contains VBA macros")
+            if any("/activex/" in n for n in names):
+                warnings.append("Office document contains ActiveX controls")
+            if any("/embeddings/" in n for n in names):
+                warnings.append("Office document embeds other files or OLE objects")
+            for info in infos:
+                if info.filename.lower().endswith(".rels") and info.file_size < 1024 * 1024:
+                    rels = zf.read(info)
+                    if b'TargetMode="External"' in rels and (b"attachedTemplate" in rels or b"oleObject" in rels):
+                        warnings.append("Office document loads a remote template or object")
+                        break
+            return warnings
+
+        for info in infos:
+            if info.flag_bits & 0x1:
+                if "Password-protected archive; contents cannot be scanned" not in warnings:
+                    warnings.append("Password-protected archive; contents cannot be scanned")
+                continue
+            warnings.extend(f"In archive: {w}" for w in check_filename(info.filename))
+            if info.compress_size and info.file_size > 100 * 1024 * 1024 and info.file_size / info.compress_size > 100:
+                warnings.append(f"Archive entry expands {info.file_size // info.compress_size}x (possible zip bomb): {info.filename}")
+                continue
+            exts = _extensions(info.filename)
+            if depth < 1 and exts and exts[-1] in {"zip"} | OOXML_EXTENSIONS and info.file_size <= ATTACHMENT_MAX_BYTES:
+                try:
+                    with zf.open(info) as inner:
+                        warnings.extend(f"In {info.filename}: {w}" for w in _inspect_zip(inner, depth + 1))
+                except zipfile.BadZipFile:
+                    warnings.append(f"Archive entry is not the archive it claims to be: {info.filename}")
+    return warnings
+
+
+def _looks_like(head: bytes) -> str | None:
+    """Container type from magic bytes."""
+    if head.startswith(b"MZ"):
+        return "exe"
+    if head.startswith(b"PK\x03\x04") or head.startswith(b"PK\x05\x06"):
+        return "zip"
+    if head.startswith(_OLE_MAGIC):
+        return "ole"
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    return None
+
+
+def check_content_type(head: bytes, name: str) -> list[str]:
+    """Warnings when the first bytes don't match what the name claims."""
+    exts = _extensions(name)
+    ext = exts[-1] if exts else ""
+    kind = _looks_like(head)
+    if kind == "exe" and ext not in RISKY_EXTENSIONS:
+        return [f"Windows executable disguised as .{ext or '(no extension)'}"]
+    expected = {"zip": "zip", "pdf": "pdf"}.get(ext) or (
+        "zip" if ext in OOXML_EXTENSIONS else "ole" if ext in OLE_EXTENSIONS else None
+    )
+    if expected and kind != expected:
+        return [f"Content does not match its .{ext} extension"]
+    return []
+
+
+def inspect_file(path: str) -> list[str]:
+    """
+    Open a spooled attachment by its real type (magic bytes, not the name):
+    ZIP/OOXML containers, legacy OLE Office files and PDFs. Depends only on
+    the content, so the result can be cached by SHA-256.
+    """
+    with open(path, "rb") as f:
+        kind = _looks_like(f.read(8))
+
+    if kind == "exe":
+        return ["Attachment is a Windows executable"]
+    if kind == "zip":
+        try:
+            return _inspect_zip(path)
+        except zipfile.BadZipFile:
+            return ["Corrupt or malformed archive"]
+    if kind == "ole":
+        return _scan_markers(path, _OLE_MARKERS)
+    if kind == "pdf":
+        return _scan_markers(path, _PDF_MARKERS)
+    return []
+
+
+def _inspect_and_store(path: str, sha256: str, size: int) -> list[str]:
+    """Runs in a thread that owns the spool file: it is deleted here, not by the caller."""
+    try:
+        warnings = inspect_file(path)
+    finally:
+        os.unlink(path)
+    save_attachment_verdict(sha256, size, warnings)
+    ATTACHMENT_INSPECTIONS.inc(result="inspected")
+    return warnings
+
+
+async def _deep_inspect(user_email: str, message_id: str, attachment: dict) -> list[str]:
+    """Spool one attachment to disk while hashing it, then inspect (or reuse the verdict)."""
+    fd, path = tempfile.mkstemp(prefix="eos-att-", dir=ATTACHMENT_TMP_DIR)
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in iter_attachment_content(user_email, message_id, attachment["id"]):
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_BYTES:
+                    ATTACHMENT_INSPECTIONS.inc(result="too_large")
+                    return ["Attachment too large to inspect"]
+                if len(head) < 8:
+                    head += chunk[:8 - len(head)]
+                digest.update(chunk)
+                f.write(chunk)
+        sha256 = digest.hexdigest()
+        # Name-dependent, so checked per copy rather than cached
+        mismatch = check_content_type(head, attachment.get("name") or "")
+
+        cached = await asyncio.to_thread(get_attachment_verdict, sha256)
+        if cached is not None:
+            ATTACHMENT_INSPECTIONS.inc(result="cached")
+            return mismatch + cached
+
+        task = _inflight.get(sha256)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(_inspect_and_store, path, sha256, size))
+            # The shared task reads and deletes the file, even if this caller is cancelled
+            path = None
+            _inflight[sha256] = task
+            task.add_done_callback(lambda _: _inflight.pop(sha256, None))
+        else:
+            ATTACHMENT_INSPECTIONS.inc(result="cached")
+        return mismatch + await asyncio.shield(task)
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+
+async def inspect_message_attachments(user_email: str, message: dict) -> dict:
+    """
+    Attachment stage for a message with hasAttachments. Metadata is always
+    checked; content is only downloaded for archive, Office and PDF types.
+    Returns {"attachments": [{name, contentType, size}], "warnings": [...]}.
+    """
+    try:
+        attachments = await list_attachments(user_email, message["id"])
+    except Exception:
+        logger.exception(
+            "could not list attachments",
+            extra={"user_email": user_email, "message_id": message.get("id")},
+        )
+        return {"attachments": [], "warnings": ["Attachments could not be inspected"]}
+
+    summary, warnings = [], []
+    for a in attachments:
+        name = a.get("name") or "(unnamed)"
+        summary.append({"name": name, "contentType": a.get("contentType"), "size": a.get("size")})
+        warnings.extend(check_filename(name))
+
+        if not _wants_content(a):
+            continue
+        if (a.get("size") or 0) > ATTACHMENT_MAX_BYTES:
+            ATTACHMENT_INSPECTIONS.inc(result="too_large")
+            warnings.append(f"{name}: Attachment too large to inspect")
+            continue
+        try:
+            deep = await _deep_inspect(user_email, message["id"], a)
+        except Exception:
+            ATTACHMENT_INSPECTIONS.inc(result="error")
+            logger.exception(
+                "attachment inspection failed",
+                extra={"user_email": user_email, "message_id": message.get("id"), "attachment": name},
+            )
+            deep = ["Attachment could not be inspected"]
+        warnings.extend(f"{name}: {w}" for w in deep)
+
+    # De-duplicate while preserving order
+    return {"attachments": summary, "warnings": list(dict.fromkeys(warnings))}
+
+
+def inspect_local_attachments(attachments: list[dict]) -> dict:
+    """
+    Same checks as inspect_message_attachments for attachments already in
+    hand (offline corpora): Graph-shaped dicts plus a "content" bytes key.
+    Synchronous and uncached, for worker processes.
+    """
+    summary, warnings = [], []
+    for a in attachments:
+        name = a.get("name") or "(unnamed)"
+        summary.append({"name": name, "contentType": a.get("contentType"), "size": a.get("size")})
+        warnings.extend(check_filename(name))
+        if not _wants_content(a):
+            continue
+        content = a.get("content") or b""
+        if len(content) > ATTACHMENT_MAX_BYTES:
+            warnings.append(f"{name}: Attachment too large to inspect")
+            continue
+
+        fd, path = tempfile.mkstemp(prefix="eos-att-", dir=ATTACHMENT_TMP_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            deep = check_content_type(content[:8], name) + inspect_file(path)
+        except Exception:
+            logger.exception("attachment inspection failed", extra={"attachment": name})
+            deep = ["Attachment could not be inspected"]
+        finally:
+            os.unlink(path)
+        warnings.extend(f"{name}: {w}" for w in deep)
+
+    return {"attachments": summary, "warnings": list(dict.fromkeys(warnings))}
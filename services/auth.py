@@ -9,7 +9,10 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 GRAPH_SCOPE = os.getenv("GRAPH_SCOPE", "https://graph.microsoft.com/.default")
 
-TOKEN_ENDPOINT = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+TOKEN_ENDPOINT = os.getenv(
+    "GRAPH_TOKEN_URL",
+    f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token",
+)
 
 async def get_token() -> str:
     data = {
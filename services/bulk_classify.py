@@ -0,0 +1,534 @@
+"""
+Classify offline mail corpora without Graph, e.g. for incident response or
+threshold tuning.
+
+Sources are .eml files (or directories of them, recursively), mbox files and
+JSON dumps of Graph messages (a list, {"value": [...]}, or one per line in
+.ndjson/.jsonl). Every source is streamed, so corpus size doesn't matter. MIME parsing, attachment checks and URL analysis run in a
+process pool; payloads are built by the same build_payload() the poller uses
+and sent to the llm-api pool concurrently. Verdicts go to a separate SQLite
+(.db) or NDJSON file, never to quarantine.db. Re-running with the same output
+skips messages already classified, so an interrupted run resumes.
+
+Usage:
+    python -m services.bulk_classify ./incident-42/ export.mbox --out verdicts.db
+    python -m services.bulk_classify dump.ndjson --out verdicts.ndjson --mailbox ceo@contoso.com
+"""
+import argparse
+import asyncio
+import base64
+import email
+import email.policy
+import email.utils
+import html
+import json
+import mailbox
+import os
+import re
+import sqlite3
+import time
+from collections import Counter as Tally
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from services import policy
+from services.attachments import ATTACHMENT_INSPECTION_ENABLED, inspect_local_attachments
+from services.llama_classifier import build_payload
+from services.llm_pool import pool
+from services.logging_utils import get_logger
+
+# llm-api requests in flight; size it to the backends' combined parallelism
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+# Messages per process-pool task
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "32"))
+# Rows written between commits / flushes (the most a crash can lose)
+BULK_COMMIT_EVERY = 100
+# Characters read at a time from .json dumps
+_JSON_CHUNK = 1 << 20
+
+EML_EXTENSIONS = (".eml",)
+MBOX_EXTENSIONS = (".mbox", ".mbx")
+JSON_EXTENSIONS = (".json",)
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+logger = get_logger(__name__)
+
+
+# ---------- sources ----------
+
+def _iter_file(path: str, explicit: bool):
+    """(source_id, kind, raw) for every message in one file."""
+    lower = path.lower()
+    if lower.endswith(EML_EXTENSIONS):
+        # Read in the worker, not here
+        yield path, "eml", path
+    elif lower.endswith(MBOX_EXTENSIONS) or (explicit and _looks_like_mbox(path)):
+        box = mailbox.mbox(path, create=False)
+        for i, key in enumerate(box.iterkeys()):
+            yield f"{path}#{i}", "mime", box.get_bytes(key)
+    elif lower.endswith(NDJSON_EXTENSIONS):
+        with open(path) as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    m = json.loads(line)
+                    yield f"{path}#{m.get('id') or i}", "graph", m
+    elif lower.endswith(JSON_EXTENSIONS):
+        with open(path) as f:
+            for i, m in enumerate(_JsonArrayReader(f).messages()):
+                yield f"{path}#{m.get('id') or i}", "graph", m
+    elif explicit:
+        yield path, "eml", path
+
+
+class _JsonArrayReader:
+    """
+    Messages of a JSON dump (a list, or {"value": [...]}) one at a time. The
+    outer structure is scanned by hand and each element parsed with
+    raw_decode, so only about one element is in memory, not the whole file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        # Grow at least geometrically, so a huge element isn't re-parsed per chunk
+        chunk = self.f.read(max(_JSON_CHUNK, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def _peek(self) -> str:
+        """Next non-whitespace character ("" at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"malformed JSON dump: expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._peek() == "]":
+                self.pos += 1
+                return
+            self._expect(",")
+
+    def messages(self):
+        first = self._peek()
+        if first == "[":
+            yield from self._array()
+        elif first == "{":
+            self.pos += 1
+            while self._peek() not in ("}", ""):
+                key = self._value()
+                self._expect(":")
+                if key == "value" and self._peek() == "[":
+                    yield from self._array()
+                else:
+                    self._value()
+                if self._peek() == ",":
+                    self.pos += 1
+        elif first:
+            raise ValueError('malformed JSON dump: expected a list or {"value": [...]}')
+
+
+def _looks_like_mbox(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(5) == b"From "
+
+
+def iter_sources(paths: list[str]):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield from _iter_file(os.path.join(root, name), explicit=False)
+        else:
+            yield from _iter_file(path, explicit=True)
+
+
+# ---------- parsing (worker processes) ----------
+
+_SCRIPT_STYLE_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.I | re.S)
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+
+def _preview(content: str, is_html: bool) -> str:
+    """Roughly what Graph puts in bodyPreview: the first 255 chars of text."""
+    if is_html:
+        content = html.unescape(_TAG_RE.sub(" ", _SCRIPT_STYLE_RE.sub(" ", content)))
+    return _WS_RE.sub(" ", content).strip()[:255]
+
+
+def mime_to_graph(raw: bytes) -> tuple[dict, list[dict]]:
+    """
+    A MIME message as the Graph message dict the poller sees (HTML body
+    preferred, as Graph returns it), plus attachments with their content.
+    """
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    body_part = msg.get_body(preferencelist=("html", "plain"))
+    content = body_part.get_content() if body_part is not None else ""
+    is_html = body_part is not None and body_part.get_content_subtype() == "html"
+
+    received = None
+    try:
+        received = email.utils.parsedate_to_datetime(msg["date"]).isoformat()
+    except (TypeError, ValueError):
+        pass
+
+    attachments = []
+    for part in msg.iter_attachments():
+        is_item = part.get_content_type() == "message/rfc822"
+        data = b"" if is_item else (part.get_payload(decode=True) or b"")
+        attachments.append({
+            "@odata.type": "#microsoft.graph.itemAttachment" if is_item else "#microsoft.graph.fileAttachment",
+            "name": part.get_filename() or ("attached message" if is_item else None),
+            "contentType": part.get_content_type(),
+            "size": len(data),
+            "isInline": part.get_content_disposition() == "inline",
+            "content": data,
+        })
+
+    message = {
+        "id": str(msg["message-id"] or ""),
+        "subject": str(msg["subject"] or ""),
+        "from": {"emailAddress": {"address": email.utils.parseaddr(str(msg["from"] or ""))[1]}},
+        "receivedDateTime": received,
+        "body": {"contentType": "html" if is_html else "text", "content": content},
+        "bodyPreview": _preview(content, is_html),
+        "hasAttachments": bool(attachments),
+    }
+    return message, attachments
+
+
+def _graph_attachments(message: dict) -> list[dict]:
+    # Dumps taken with $expand=attachments carry contentBytes
+    attachments = []
+    for a in message.get("attachments") or []:
+        data = base64.b64decode(a["contentBytes"]) if a.get("contentBytes") else b""
+        attachments.append(dict(a, content=data))
+    return attachments
+
+
+def _prepare(kind: str, raw) -> tuple[dict, dict]:
+    if kind == "eml":
+        with open(raw, "rb") as f:
+            raw, kind = f.read(), "mime"
+    if kind == "mime":
+        message, attachments = mime_to_graph(raw)
+    else:
+        message, attachments = raw, _graph_attachments(raw)
+
+    report = None
+    if attachments and ATTACHMENT_INSPECTION_ENABLED:
+        report = inspect_local_attachments(attachments)
+    # Offline there is no reputation history, so sender_history stays empty
+    return message, build_payload(message, report)
+
+
+def prepare_batch(items: list) -> list[tuple]:
+    """(source_id, message, payload, error) per item; runs in a worker process."""
+    results = []
+    for source_id, kind, raw in items:
+        try:
+            message, payload = _prepare(kind, raw)
+            message = {k: message.get(k) for k in ("id", "subject", "from", "receivedDateTime")}
+            results.append((source_id, message, payload, None))
+        except Exception as exc:
+            results.append((source_id, None, None, repr(exc)))
+    return results
+
+
+# ---------- outputs ----------
+
+class SqliteOutput:
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bulk_verdicts (
+                source_id TEXT PRIMARY KEY,
+                message_id TEXT,
+                sender TEXT,
+                subject TEXT,
+                received_datetime TEXT,
+                risk_score INTEGER,
+                classification TEXT,
+                reasons TEXT,
+                urls TEXT,
+                url_warnings TEXT,
+                attachment_warnings TEXT,
+                would_quarantine INTEGER,
+                classified_at TEXT
+            )
+            """
+        )
+        self.pending = 0
+
+    def done_ids(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT source_id FROM bulk_verdicts")}
+
+    def write(self, row: dict):
+        row = dict(row, **{k: json.dumps(row[k]) for k in ("reasons", "urls", "url_warnings", "attachment_warnings")})
+        row["would_quarantine"] = int(row["would_quarantine"])
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO bulk_verdicts ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+            list(row.values()),
+        )
+        self.pending += 1
+        if self.pending >= BULK_COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class NdjsonOutput:
+    def __init__(self, path: str):
+        self.path = path
+        self._drop_partial_line()
+        self.file = open(path, "a")
+        self.pending = 0
+
+    def _drop_partial_line(self):
+        """Cut a line a crash left unfinished, so appended rows start on a fresh line."""
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(0, pos - 65536)
+                f.seek(start)
+                block = f.read(pos - start)
+                if pos == end and block.endswith(b"\n"):
+                    return
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    pos = start + newline + 1
+                    break
+                pos = start
+            if pos < end:
+                f.truncate(pos)
+                logger.warning("dropped a partial last line from the output", extra={"path": self.path, "bytes": end - pos})
+
+    def done_ids(self) -> set:
+        done = set()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["source_id"])
+                except (ValueError, KeyError):
+                    # A line cut short by a crash; that message is redone
+                    continue
+        return done
+
+    def write(self, row: dict):
+        self.file.write(json.dumps(row, separators=(",", ":")) + "\n")
+        self.pending += 1
+        if self.pending >= BULK_COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def open_output(path: str):
+    if path.lower().endswith(NDJSON_EXTENSIONS):
+        return NdjsonOutput(path)
+    return SqliteOutput(path)
+
+
+# ---------- pipeline ----------
+
+def _verdict_row(source_id: str, message: dict, payload: dict, score: dict, mailbox_policy) -> dict:
+    """Output row, with the quarantine decision the poller would have made."""
+    sender = payload["sender"]
+    risk = score.get("risk_score", 0) or 0
+    classification = (score.get("classification") or "unknown").lower()
+    if classification not in {"safe", "spam", "phishing", "malicious"}:
+        classification = "spam"
+
+    action, _ = mailbox_policy.check_sender(sender)
+    if action:
+        quarantine = action == "deny"
+    else:
+        quarantine, _ = mailbox_policy.decide(classification, risk, mailbox_policy.is_external(sender))
+
+    return {
+        "source_id": source_id,
+        "message_id": message.get("id"),
+        "sender": sender,
+        "subject": payload["subject"],
+        "received_datetime": message.get("receivedDateTime"),
+        "risk_score": risk,
+        "classification": classification,
+        "reasons": score.get("reasons", []),
+        "urls": payload["urls"],
+        "url_warnings": payload["url_warnings"],
+        "attachment_warnings": payload.get("attachment_warnings", []),
+        "would_quarantine": quarantine,
+        "classified_at": datetime.utcnow().isoformat() + "Z",
+    }
+
+
+def _batches(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def run(
+    paths: list[str],
+    out_path: str,
+    workers: int | None = None,
+    concurrency: int = BULK_CONCURRENCY,
+    batch_size: int = BULK_BATCH_SIZE,
+    mailbox_address: str | None = None,
+    limit: int | None = None,
+) -> dict:
+    out = open_output(out_path)
+    done = out.done_ids()
+    mailbox_policy = policy.get_policy().for_mailbox(mailbox_address)
+    workers = workers or os.cpu_count() or 1
+    stats = Tally()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+
+    def todo():
+        taken = 0
+        for item in iter_sources(paths):
+            if item[0] in done:
+                stats["resumed"] += 1
+                continue
+            if limit is not None and taken >= limit:
+                return
+            taken += 1
+            yield item
+
+    async def produce(executor):
+        # At most two batches per worker in flight, so memory stays flat on huge corpora
+        pending = set()
+        # Walking directories and reading mbox/JSON files blocks; do it off the loop
+        batches = _batches(todo(), batch_size)
+        try:
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                while len(pending) >= workers * 2:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        for result in task.result():
+                            await queue.put(result)
+                pending.add(loop.run_in_executor(executor, prepare_batch, batch))
+            for task in asyncio.as_completed(pending):
+                for result in await task:
+                    await queue.put(result)
+        finally:
+            # Stop the consumers even if a source could not be read
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            source_id, message, payload, error = item
+            if error is None:
+                try:
+                    score = await pool.classify(payload)
+                except Exception as exc:
+                    error = repr(exc)
+            if error is not None:
+                stats["errors"] += 1
+                logger.warning("bulk classification failed", extra={"source_id": source_id, "error": error})
+                continue
+            row = _verdict_row(source_id, message, payload, score, mailbox_policy)
+            out.write(row)
+            stats["classified"] += 1
+            stats[f"classification:{row['classification']}"] += 1
+            stats["would_quarantine"] += int(row["would_quarantine"])
+            if stats["classified"] % 1000 == 0:
+                logger.info(
+                    "bulk progress",
+                    extra={"classified": stats["classified"], "per_sec": round(stats["classified"] / (time.monotonic() - started), 1)},
+                )
+
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            await asyncio.gather(produce(executor), *(consume() for _ in range(concurrency)))
+    finally:
+        out.close()
+
+    elapsed = time.monotonic() - started
+    return {
+        **dict(stats),
+        "seconds": round(elapsed, 1),
+        "per_sec": round(stats["classified"] / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+", help=".eml files or directories, mbox files, JSON/NDJSON dumps")
+    parser.add_argument("--out", required=True, help="verdicts file: .db (SQLite) or .ndjson")
+    parser.add_argument("--workers", type=int, help="parsing processes (default: CPU count)")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY, help="llm-api requests in flight")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument("--mailbox", help="apply this mailbox's policy for the would_quarantine column")
+    parser.add_argument("--limit", type=int, help="stop after this many new messages")
+    args = parser.parse_args()
+
+    summary = asyncio.run(
+        run(args.sources, args.out, args.workers, args.concurrency, args.batch_size, args.mailbox, args.limit)
+    )
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
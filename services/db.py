@@ -1,22 +1,43 @@
 import os
 import sqlite3
+import time
 from datetime import datetime
 from threading import Lock
 import json
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
-DB_DIR = os.path.join(BASE_DIR, "data")
-DB_PATH = os.path.join(DB_DIR, "quarantine.db")
+# Point several poller workers (or hosts) at the same file via QUARANTINE_DB_PATH
+DB_PATH = os.getenv("QUARANTINE_DB_PATH") or os.path.join(BASE_DIR, "data", "quarantine.db")
+DB_DIR = os.path.dirname(DB_PATH)
+# Seconds a connection waits on another process's write lock before failing
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+# Optional journal mode, e.g. "wal" for several workers on one host.
+# Leave unset when the file lives on a network share (WAL needs shared memory).
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "")
 
+# Half-life of the decayed good/bad reputation scores (see _bump_reputation)
+REPUTATION_HALF_LIFE_DAYS = float(os.getenv("REPUTATION_HALF_LIFE_DAYS", "30"))
+
+# Only serializes threads in this process; other processes are handled by
+# SQLite's own file locking plus DB_BUSY_TIMEOUT.
 _db_lock = Lock()
 
 
+def _connect() -> sqlite3.Connection:
+    return sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+
+
 def init_db():
     """Create the SQLite database and table if they don't exist."""
     os.makedirs(DB_DIR, exist_ok=True)
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
+        # Only takes effect on a new, empty file; existing databases are
+        # converted once with `python -m services.retention vacuum --full`.
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if DB_JOURNAL_MODE:
+            cur.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS quarantine_events (
@@ -36,14 +57,186 @@ def init_db():
             )
             """
         )
+        _ensure_columns(
+            cur,
+            "quarantine_events",
+            {
+                # Per-message span timings (see services/tracing.py)
+                "trace": "TEXT",
+                "detection_ms": "INTEGER",
+                "processing_ms": "INTEGER",
+                # Last release / re-quarantine, for the dashboard's live feed
+                "status_changed_at": "TEXT",
+                # Graph's ~255-char bodyPreview, a training feature for services/triage.py
+                "body_preview": "TEXT",
+                # What decided the verdict: llm, triage, policy, reputation (NULL = llm)
+                "verdict_source": "TEXT",
+                # Content fingerprint (see services/dedupe.py)
+                "fingerprint": "TEXT",
+                # Model that decided an llm verdict (llm-api FAST_MODEL / SLOW_MODEL)
+                "model": "TEXT",
+                # Text snapshot of a quarantined message (see services/evidence.py)
+                "evidence_hash": "TEXT",
+            },
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quarantine_events_evidence_hash "
+            "ON quarantine_events (evidence_hash) WHERE evidence_hash IS NOT NULL"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quarantine_events_detection_ms "
+            "ON quarantine_events (detection_ms)"
+        )
+        # Retention scans and the dashboard's newest-first listing
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quarantine_events_created_at "
+            "ON quarantine_events (created_at)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quarantine_events_released_at "
+            "ON quarantine_events (released_at)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quarantine_events_status_changed_at "
+            "ON quarantine_events (status_changed_at)"
+        )
+        # Per-day totals of events moved out by retention, so stats survive purges
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT NOT NULL,
+                classification TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                quarantined INTEGER NOT NULL DEFAULT 0,
+                released INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, classification)
+            )
+            """
+        )
+        # Per-sender and per-domain history (see services/reputation.py)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sender_reputation (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                safe INTEGER NOT NULL DEFAULT 0,
+                spam INTEGER NOT NULL DEFAULT 0,
+                phishing INTEGER NOT NULL DEFAULT 0,
+                malicious INTEGER NOT NULL DEFAULT 0,
+                quarantined INTEGER NOT NULL DEFAULT 0,
+                released INTEGER NOT NULL DEFAULT 0,
+                first_seen TEXT,
+                last_seen TEXT,
+                bad_score REAL NOT NULL DEFAULT 0,
+                good_score REAL NOT NULL DEFAULT 0,
+                scored_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        # Deep-inspection results per attachment payload (see services/attachments.py)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attachment_verdicts (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER,
+                warnings TEXT NOT NULL,
+                inspected_at TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # Messages already classified, so delta re-entries (read flag, categories,
+        # moves back by a release) are skipped (see services/dedupe.py).
+        # Pinned rows belong to released messages and are never pruned.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                mailbox TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                event_id INTEGER,
+                processed_at REAL NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (mailbox, message_id)
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_messages_fingerprint "
+            "ON processed_messages (mailbox, fingerprint)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_messages_processed_at "
+            "ON processed_messages (processed_at)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_messages_event_id "
+            "ON processed_messages (event_id)"
+        )
+        # Poller worker registry and mailbox ownership (see services/sharding.py)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS poller_workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL,
+                started_at REAL NOT NULL
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mailbox_leases (
+                mailbox TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_mailbox_leases_worker ON mailbox_leases (worker_id)"
+        )
+        # Bumped by every change to existing events (release, re-quarantine,
+        # retention); with MAX(id) it tells readers whether anything changed
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS change_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
         conn.commit()
         conn.close()
 
 
-def log_quarantine_event(user_email: str, email: dict, score: dict, moved: bool):
-    """Insert a record for a processed email (quarantined or not)."""
+def _ensure_columns(cur, table: str, columns: dict):
+    """Add columns introduced after a database was first created."""
+    cur.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cur.fetchall()}
+    for name, decl in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def log_quarantine_event(
+    user_email: str,
+    email: dict,
+    score: dict,
+    moved: bool,
+    trace: dict | None = None,
+    fingerprint: str | None = None,
+    evidence_hash: str | None = None,
+):
+    """
+    Insert a record for a processed email (quarantined or not).
+    trace holds the span columns from MessageTrace.to_record(), if traced.
+    fingerprint (services/dedupe.py) also marks the message processed, in the
+    same transaction. evidence_hash names its services/evidence.py snapshot.
+    """
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
 
         message_id = email["id"]
@@ -53,18 +246,22 @@ def log_quarantine_event(user_email: str, email: dict, score: dict, moved: bool)
             .get("address")
         )
         subject = email.get("subject")
+        body_preview = email.get("bodyPreview")
         received = email.get("receivedDateTime")
         risk_score = score.get("risk_score")
         classification = score.get("classification")
         reasons = json.dumps(score.get("reasons", []))
         created_at = datetime.utcnow().isoformat() + "Z"
+        trace = trace or {}
 
         cur.execute(
             """
             INSERT INTO quarantine_events
                 (message_id, sender, subject, received_datetime, risk_score,
-                 classification, reasons, moved, created_at, released, user_email)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+                 classification, reasons, moved, created_at, released, user_email,
+                 trace, detection_ms, processing_ms, body_preview, verdict_source, fingerprint,
+                 model, evidence_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
                 message_id,
@@ -77,25 +274,246 @@ def log_quarantine_event(user_email: str, email: dict, score: dict, moved: bool)
                 int(moved),
                 created_at,
                 user_email,
+                trace.get("trace"),
+                trace.get("detection_ms"),
+                trace.get("processing_ms"),
+                body_preview,
+                score.get("source", "llm"),
+                fingerprint,
+                score.get("model"),
+                evidence_hash,
             ),
         )
+        if fingerprint:
+            cur.execute(
+                """
+                INSERT OR REPLACE INTO processed_messages
+                    (mailbox, message_id, fingerprint, event_id, processed_at, pinned)
+                VALUES (?, ?, ?, ?, ?, 0)
+                """,
+                (user_email, message_id, fingerprint, cur.lastrowid, time.time()),
+            )
+
+        if score.get("source", "llm") in _REPUTATION_SOURCES:
+            _bump_reputation(
+                cur, sender, created_at, classification=classification, moved=moved
+            )
+
+        conn.commit()
+        conn.close()
+
+
+def _iso_to_epoch(value: str | None) -> float:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return time.time()
+
+
+def _decay(score: float, since: float, now: float) -> float:
+    if not score or now <= since:
+        return score
+    return score * 0.5 ** ((now - since) / (REPUTATION_HALF_LIFE_DAYS * 86400))
+
+
+# Verdicts that feed sender reputation. Policy and reputation verdicts are
+# left out: a sender must not earn (or lose) standing from its own skips or
+# escalations. Admin releases always count.
+_REPUTATION_SOURCES = ("llm", "triage")
+
+
+def _reputation_keys(sender: str | None) -> list[tuple[str, str]]:
+    if not sender or "@" not in sender:
+        return []
+    sender = sender.strip().lower()
+    return [("sender", sender), ("domain", sender.rsplit("@", 1)[1])]
+
+
+def _bump_reputation(
+    cur,
+    sender: str | None,
+    when: str,
+    classification: str | None = None,
+    moved: bool = False,
+    released: bool | None = None,
+):
+    """
+    Fold one event into the sender's and domain's reputation rows.
+    A processed message bumps the counts; quarantines and phishing/malicious
+    verdicts add to bad_score, safe verdicts to good_score. An admin release
+    (released=True) is a confirmed false positive and adds 2 to good_score,
+    a re-quarantine (released=False) adds 2 to bad_score. Both scores halve
+    every REPUTATION_HALF_LIFE_DAYS.
+    """
+    now = _iso_to_epoch(when)
+    counts = dict.fromkeys(("total", "safe", "spam", "phishing", "malicious", "quarantined", "released"), 0)
+    bad = good = 0.0
+    if released is None:
+        counts["total"] = 1
+        if classification in ("safe", "spam", "phishing", "malicious"):
+            counts[classification] = 1
+        counts["quarantined"] = int(bool(moved))
+        if moved or classification in ("phishing", "malicious"):
+            bad = 1.0
+        elif classification == "safe":
+            good = 1.0
+    elif released:
+        counts["released"] = 1
+        good = 2.0
+    else:
+        counts["released"] = -1
+        bad = 2.0
+
+    for kind, key in _reputation_keys(sender):
+        cur.execute(
+            "SELECT bad_score, good_score, scored_at FROM sender_reputation WHERE kind = ? AND key = ?",
+            (kind, key),
+        )
+        row = cur.fetchone()
+        old_bad, old_good, scored_at = row if row else (0.0, 0.0, now)
+        cur.execute(
+            """
+            INSERT INTO sender_reputation
+                (kind, key, total, safe, spam, phishing, malicious, quarantined, released,
+                 first_seen, last_seen, bad_score, good_score, scored_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, MAX(?, 0), ?, ?, ?, ?, ?)
+            ON CONFLICT(kind, key) DO UPDATE SET
+                total = total + excluded.total,
+                safe = safe + excluded.safe,
+                spam = spam + excluded.spam,
+                phishing = phishing + excluded.phishing,
+                malicious = malicious + excluded.malicious,
+                quarantined = quarantined + excluded.quarantined,
+                released = MAX(released + ?, 0),
+                last_seen = MAX(COALESCE(last_seen, ''), excluded.last_seen),
+                bad_score = excluded.bad_score,
+                good_score = excluded.good_score,
+                scored_at = excluded.scored_at
+            """,
+            (
+                kind,
+                key,
+                *counts.values(),
+                when,
+                when,
+                _decay(old_bad, scored_at, now) + bad,
+                _decay(old_good, scored_at, now) + good,
+                max(now, scored_at),
+                counts["released"],
+            ),
+        )
+
 
+def get_reputation(sender: str) -> dict:
+    """
+    Reputation rows for a sender address and its domain, with scores decayed
+    to now. Returns {"sender": dict | None, "domain": dict | None}.
+    """
+    result = {"sender": None, "domain": None}
+    keys = _reputation_keys(sender)
+    if not keys:
+        return result
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        for kind, key in keys:
+            cur.execute(
+                """
+                SELECT total, safe, spam, phishing, malicious, quarantined, released,
+                       first_seen, last_seen, bad_score, good_score, scored_at
+                FROM sender_reputation WHERE kind = ? AND key = ?
+                """,
+                (kind, key),
+            )
+            row = cur.fetchone()
+            if row:
+                result[kind] = {
+                    "key": key,
+                    "total": row[0],
+                    "safe": row[1],
+                    "spam": row[2],
+                    "phishing": row[3],
+                    "malicious": row[4],
+                    "quarantined": row[5],
+                    "released": row[6],
+                    "first_seen": row[7],
+                    "last_seen": row[8],
+                    "bad_score": _decay(row[9], row[11], now),
+                    "good_score": _decay(row[10], row[11], now),
+                }
+        conn.close()
+    return result
+
+
+def rebuild_reputation() -> int:
+    """
+    Recompute sender_reputation from quarantine_events (live rows only;
+    archived events are summarized without senders), feeding the same
+    verdicts and releases as live logging does. Returns events replayed.
+    """
+    replayed = 0
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM sender_reputation")
+        rows = conn.execute(
+            """
+            SELECT sender, classification, moved, created_at, released, released_at, verdict_source
+            FROM quarantine_events ORDER BY id
+            """
+        )
+        for sender, classification, moved, created_at, released, released_at, source in rows:
+            if (source or "llm") in _REPUTATION_SOURCES:
+                _bump_reputation(cur, sender, created_at, classification=classification, moved=bool(moved))
+            if released:
+                _bump_reputation(cur, sender, released_at or created_at, released=True)
+            replayed += 1
         conn.commit()
         conn.close()
+    return replayed
+
+
+_EVENT_COLUMNS = (
+    "id, message_id, sender, subject, received_datetime, risk_score, "
+    "classification, reasons, moved, created_at, released, released_at, user_email, "
+    "evidence_hash"
+)
+
+
+def _row_to_event(row) -> dict:
+    """Convert a quarantine_events row (selected with _EVENT_COLUMNS) to a dict."""
+    reasons = row[7]
+    return {
+        "id": row[0],
+        "message_id": row[1],
+        "sender": row[2],
+        "subject": row[3],
+        "received_datetime": row[4],
+        "risk_score": row[5],
+        "classification": row[6],
+        # Skip the JSON parser for the common empty list
+        "reasons": json.loads(reasons) if reasons and reasons != "[]" else [],
+        "moved": bool(row[8]),
+        "created_at": row[9],
+        "released": bool(row[10]),
+        "released_at": row[11],
+        "user_email": row[12],
+        "evidence_hash": row[13],
+    }
 
 
 def list_quarantine_events(limit: int = 100, q: str | None = None):
     """Return recent quarantine events as a list of dicts."""
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
         
         if q:
             search_term = f"%{q}%"
             cur.execute(
-                """
-                SELECT id, message_id, sender, subject, received_datetime, risk_score,
-                       classification, reasons, moved, created_at, released, released_at, user_email
+                f"""
+                SELECT {_EVENT_COLUMNS}
                 FROM quarantine_events
                 WHERE sender LIKE ? OR subject LIKE ?
                 ORDER BY created_at DESC
@@ -105,9 +523,8 @@ def list_quarantine_events(limit: int = 100, q: str | None = None):
             )
         else:
             cur.execute(
-                """
-                SELECT id, message_id, sender, subject, received_datetime, risk_score,
-                       classification, reasons, moved, created_at, released, released_at, user_email
+                f"""
+                SELECT {_EVENT_COLUMNS}
                 FROM quarantine_events
                 ORDER BY created_at DESC
                 LIMIT ?
@@ -117,37 +534,216 @@ def list_quarantine_events(limit: int = 100, q: str | None = None):
         rows = cur.fetchall()
         conn.close()
 
-    events = []
-    for row in rows:
-        events.append(
-            {
-                "id": row[0],
-                "message_id": row[1],
-                "sender": row[2],
-                "subject": row[3],
-                "received_datetime": row[4],
-                "risk_score": row[5],
-                "classification": row[6],
-                "reasons": json.loads(row[7] or "[]"),
-                "moved": bool(row[8]),
-                "created_at": row[9],
-                "released": bool(row[10]),
-                "released_at": row[11],
-                "user_email": row[12],
-            }
-        )
-    return events
+    return [_row_to_event(row) for row in rows]
+
+
+def list_events_since(since_id: int, limit: int = 200):
+    """Events newer than since_id, oldest first (for incremental fetch)."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {_EVENT_COLUMNS}
+            FROM quarantine_events
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (since_id, limit),
+        )
+        rows = cur.fetchall()
+        conn.close()
+
+    return [_row_to_event(row) for row in rows]
+
+
+def list_events_changed_since(changed_after: str, after_id: int = 0, limit: int = 200):
+    """
+    Events released or re-quarantined after the cursor (status_changed_at,
+    id). A bulk action stamps every row with the same time, so the id is
+    needed to page through them.
+    """
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {_EVENT_COLUMNS}, status_changed_at
+            FROM quarantine_events
+            WHERE (status_changed_at, id) > (?, ?)
+            ORDER BY status_changed_at, id
+            LIMIT ?
+            """,
+            (changed_after, after_id, limit),
+        )
+        rows = cur.fetchall()
+        conn.close()
+
+    return [dict(_row_to_event(row), status_changed_at=row[-1]) for row in rows]
+
+
+def _bump_generation(cur):
+    cur.execute(
+        """
+        INSERT INTO change_counters (name, value) VALUES ('events', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+        """
+    )
+
+
+def get_change_token() -> str:
+    """
+    "<max id>-<generation>": changes whenever an event is added, released,
+    re-quarantined or archived. Two index lookups, so cheap to check per request.
+    """
+    with _db_lock:
+        conn = _connect()
+        max_id, generation = conn.execute(
+            """
+            SELECT (SELECT MAX(id) FROM quarantine_events),
+                   (SELECT value FROM change_counters WHERE name = 'events')
+            """
+        ).fetchone()
+        conn.close()
+    return f"{max_id or 0}-{generation or 0}"
+
+
+def get_max_event_id() -> int:
+    with _db_lock:
+        conn = _connect()
+        row = conn.execute("SELECT MAX(id) FROM quarantine_events").fetchone()
+        conn.close()
+    return row[0] or 0
+
+
+def iter_events(
+    after_id: int = 0,
+    created_from: str | None = None,
+    created_to: str | None = None,
+    classification: str | None = None,
+    sender: str | None = None,
+    user_email: str | None = None,
+    moved: bool | None = None,
+    batch_size: int = 1000,
+):
+    """
+    Yield events in id order, batch_size rows per query (keyset pagination on
+    id). The connection and lock are released between batches, so a long
+    export never blocks the poller's writes. created_from is inclusive,
+    created_to exclusive.
+    """
+    clauses, params = ["id > ?"], []
+    if created_from:
+        clauses.append("created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        clauses.append("created_at < ?")
+        params.append(created_to)
+    if classification:
+        clauses.append("classification = ? COLLATE NOCASE")
+        params.append(classification)
+    if sender:
+        clauses.append("sender = ? COLLATE NOCASE")
+        params.append(sender)
+    if user_email:
+        clauses.append("user_email = ? COLLATE NOCASE")
+        params.append(user_email)
+    if moved is not None:
+        clauses.append("moved = ?")
+        params.append(int(moved))
+    query = f"""
+        SELECT {_EVENT_COLUMNS}
+        FROM quarantine_events
+        WHERE {" AND ".join(clauses)}
+        ORDER BY id
+        LIMIT ?
+    """
+
+    last_id = after_id
+    while True:
+        with _db_lock:
+            conn = _connect()
+            rows = conn.execute(query, (last_id, *params, batch_size)).fetchall()
+            conn.close()
+        for row in rows:
+            yield _row_to_event(row)
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
+def iter_training_rows(after_id: int = 0, batch_size: int = 5000):
+    """
+    Yield (id, sender, subject, body_preview, label, released) for the local
+    model, in id order. The label is the LLM's classification, or "safe" for
+    anything an admin released. Verdicts from the local model itself, policy lists and
+    reputation (skips and escalations) are left out unless released, so the model never trains
+    on its own output.
+    """
+    query = """
+        SELECT id, sender, subject, body_preview, lower(classification), released
+        FROM quarantine_events
+        WHERE id > ?
+          AND classification IS NOT NULL
+          AND (released = 1 OR verdict_source IS NULL OR verdict_source = 'llm')
+        ORDER BY id
+        LIMIT ?
+    """
+    last_id = after_id
+    while True:
+        with _db_lock:
+            conn = _connect()
+            rows = conn.execute(query, (last_id, batch_size)).fetchall()
+            conn.close()
+        for event_id, sender, subject, body_preview, classification, released in rows:
+            yield event_id, sender, subject, body_preview, "safe" if released else classification, bool(released)
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
+def find_processed(mailbox: str, message_ids: list[str], fingerprints: list[str]) -> list[tuple]:
+    """(message_id, fingerprint, pinned) rows matching either a message ID or a fingerprint."""
+    rows = []
+    with _db_lock:
+        conn = _connect()
+        for start in range(0, max(len(message_ids), len(fingerprints)), 400):
+            ids = message_ids[start:start + 400]
+            fps = fingerprints[start:start + 400]
+            rows.extend(conn.execute(
+                f"""
+                SELECT message_id, fingerprint, pinned FROM processed_messages
+                WHERE mailbox = ?
+                  AND (message_id IN ({','.join('?' * len(ids))})
+                       OR fingerprint IN ({','.join('?' * len(fps))}))
+                """,
+                (mailbox, *ids, *fps),
+            ).fetchall())
+        conn.close()
+    return rows
+
+
+def prune_processed(older_than: float) -> int:
+    """Forget unpinned processed_messages entries older than the given epoch time."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.execute(
+            "DELETE FROM processed_messages WHERE processed_at < ? AND pinned = 0", (older_than,)
+        )
+        conn.commit()
+        conn.close()
+    return cur.rowcount
 
 
 def get_event_by_id(event_id: int):
     """Fetch a single quarantine event by numeric ID."""
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
         cur.execute(
-            """
-            SELECT id, message_id, sender, subject, received_datetime, risk_score,
-                   classification, reasons, moved, created_at, released, released_at, user_email
+            f"""
+            SELECT {_EVENT_COLUMNS}
             FROM quarantine_events
             WHERE id = ?
             """,
@@ -159,37 +755,140 @@ def get_event_by_id(event_id: int):
     if not row:
         return None
 
-    return {
-        "id": row[0],
-        "message_id": row[1],
-        "sender": row[2],
-        "subject": row[3],
-        "received_datetime": row[4],
-        "risk_score": row[5],
-        "classification": row[6],
-        "reasons": json.loads(row[7] or "[]"),
-        "moved": bool(row[8]),
-        "created_at": row[9],
-        "released": bool(row[10]),
-        "released_at": row[11],
-        "user_email": row[12],
-    }
+    return _row_to_event(row)
+
+
+def list_evidence_hashes() -> set:
+    """Evidence blobs still referenced by a live event."""
+    with _db_lock:
+        conn = _connect()
+        rows = conn.execute(
+            "SELECT DISTINCT evidence_hash FROM quarantine_events WHERE evidence_hash IS NOT NULL"
+        ).fetchall()
+        conn.close()
+    return {r[0] for r in rows}
+
+
+def count_evidence_references() -> int:
+    with _db_lock:
+        conn = _connect()
+        (n,) = conn.execute(
+            "SELECT COUNT(*) FROM quarantine_events WHERE evidence_hash IS NOT NULL"
+        ).fetchone()
+        conn.close()
+    return n
 
 
 def mark_released(event_id: int):
     """Mark an event as released in the DB."""
+    set_release_state({event_id: None}, released=True)
+
+
+def find_events_for_action(
+    action: str,
+    event_ids: list[int] | None = None,
+    q: str | None = None,
+    sender: str | None = None,
+    limit: int = 1000,
+):
+    """
+    Events a bulk action applies to, selected by ID, by the dashboard search
+    (q) and/or by exact sender. "release" picks quarantined events that are
+    still in AI-Quarantine; "requarantine" picks released ones.
+    """
+    if action == "release":
+        clauses = ["moved = 1", "released = 0"]
+    elif action == "requarantine":
+        clauses = ["released = 1"]
+    else:
+        raise ValueError(f"unknown action: {action}")
+    clauses.append("user_email IS NOT NULL")
+    params = []
+
+    if q:
+        clauses.append("(sender LIKE ? OR subject LIKE ?)")
+        params.extend([f"%{q}%", f"%{q}%"])
+    if sender:
+        clauses.append("sender = ? COLLATE NOCASE")
+        params.append(sender)
+
+    # IDs in chunks, to stay under SQLite's bound-variable limit
+    id_chunks = [event_ids[i:i + 400] for i in range(0, len(event_ids), 400)] if event_ids else [[]]
+    rows = []
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
-        now = datetime.utcnow().isoformat() + "Z"
-        cur.execute(
+        for ids in id_chunks:
+            where = clauses + ([f"id IN ({','.join('?' * len(ids))})"] if ids else [])
+            cur.execute(
+                f"""
+                SELECT {_EVENT_COLUMNS}
+                FROM quarantine_events
+                WHERE {" AND ".join(where)}
+                ORDER BY id
+                LIMIT ?
+                """,
+                (*params, *ids, limit),
+            )
+            rows.extend(cur.fetchall())
+        conn.close()
+
+    rows.sort(key=lambda row: row[0])
+    return [_row_to_event(row) for row in rows[:limit]]
+
+
+def set_release_state(updates: dict, released: bool):
+    """
+    Mark many events released (or back in quarantine) in one transaction.
+    updates maps event_id -> the message's new Graph ID after the move
+    (Graph assigns one on every move), or None to keep the stored ID.
+    """
+    now = datetime.utcnow().isoformat() + "Z"
+    released_at = now if released else None
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.executemany(
             """
             UPDATE quarantine_events
-            SET released = 1, released_at = ?
+            SET released = ?, released_at = ?, status_changed_at = ?,
+                message_id = COALESCE(?, message_id)
             WHERE id = ?
             """,
-            (now, event_id),
+            [
+                (int(released), released_at, now, new_message_id, event_id)
+                for event_id, new_message_id in updates.items()
+            ],
         )
+        # A released message re-enters the Inbox under its new ID; pin it so the
+        # poller never classifies (and re-quarantines) it again
+        if released:
+            cur.executemany(
+                """
+                INSERT OR REPLACE INTO processed_messages
+                    (mailbox, message_id, fingerprint, event_id, processed_at, pinned)
+                SELECT user_email, message_id, fingerprint, id, ?, 1
+                FROM quarantine_events
+                WHERE id = ? AND fingerprint IS NOT NULL AND user_email IS NOT NULL
+                """,
+                [(time.time(), event_id) for event_id in updates],
+            )
+        else:
+            cur.executemany(
+                "UPDATE processed_messages SET pinned = 0 WHERE event_id = ?",
+                [(event_id,) for event_id in updates],
+            )
+        # Releases are confirmed false positives; feed them back into reputation
+        ids = list(updates)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cur.execute(
+                f"SELECT sender FROM quarantine_events WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for (sender,) in cur.fetchall():
+                _bump_reputation(cur, sender, now, released=released)
+        _bump_generation(cur)
         conn.commit()
         conn.close()
 
@@ -202,7 +901,7 @@ def get_dashboard_stats():
     - Released
     """
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _connect()
         cur = conn.cursor()
         
         cur.execute(
@@ -215,11 +914,16 @@ def get_dashboard_stats():
             """
         )
         row = cur.fetchone()
+        # Events already moved to the archive by retention
+        cur.execute(
+            "SELECT SUM(total), SUM(quarantined), SUM(released) FROM daily_stats"
+        )
+        archived = cur.fetchone()
         conn.close()
 
-    total = row[0] or 0
-    quarantined = row[1] or 0
-    released = row[2] or 0
+    total = (row[0] or 0) + (archived[0] or 0)
+    quarantined = (row[1] or 0) + (archived[1] or 0)
+    released = (row[2] or 0) + (archived[2] or 0)
     
     # Calculate "Allowed" (safe)
     allowed = total - quarantined
@@ -230,3 +934,349 @@ def get_dashboard_stats():
         "released": released,
         "allowed": allowed
     }
+
+
+
+def list_slowest_events(limit: int = 50):
+    """Events with the longest received -> logged detection latency."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, user_email, sender, subject, received_datetime, classification,
+                   moved, detection_ms, processing_ms, trace
+            FROM quarantine_events
+            WHERE detection_ms IS NOT NULL
+            ORDER BY detection_ms DESC
+            LIMIT ?
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
+        conn.close()
+
+    return [
+        {
+            "id": row[0],
+            "user_email": row[1],
+            "sender": row[2],
+            "subject": row[3],
+            "received_datetime": row[4],
+            "classification": row[5],
+            "moved": bool(row[6]),
+            "detection_ms": row[7],
+            "processing_ms": row[8],
+            "trace": row[9],
+        }
+        for row in rows
+    ]
+
+
+# Upper bounds (ms) of the detection-latency histogram on the latency page
+LATENCY_BUCKETS_MS = (10_000, 30_000, 60_000, 120_000, 300_000, 600_000, 1_800_000)
+
+
+def get_detection_latency_stats():
+    """
+    Detection latency distribution: percentiles plus histogram bucket counts.
+    Percentiles are read straight off the detection_ms index.
+    """
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM quarantine_events WHERE detection_ms IS NOT NULL")
+        count = cur.fetchone()[0]
+
+        percentiles = {}
+        for pct in (50, 90, 95, 99):
+            if not count:
+                percentiles[pct] = None
+                continue
+            cur.execute(
+                """
+                SELECT detection_ms FROM quarantine_events
+                WHERE detection_ms IS NOT NULL
+                ORDER BY detection_ms
+                LIMIT 1 OFFSET ?
+                """,
+                (min(count - 1, int(count * pct / 100)),),
+            )
+            percentiles[pct] = cur.fetchone()[0]
+
+        buckets = []
+        lower = 0
+        for upper in LATENCY_BUCKETS_MS + (None,):
+            if upper is None:
+                cur.execute(
+                    "SELECT COUNT(*) FROM quarantine_events WHERE detection_ms >= ?",
+                    (lower,),
+                )
+            else:
+                cur.execute(
+                    "SELECT COUNT(*) FROM quarantine_events WHERE detection_ms >= ? AND detection_ms < ?",
+                    (lower, upper),
+                )
+            buckets.append({"lower_ms": lower, "upper_ms": upper, "count": cur.fetchone()[0]})
+            lower = upper
+        conn.close()
+
+    return {"count": count, "percentiles": percentiles, "buckets": buckets}
+
+
+# ---------- Attachment verdicts ----------
+
+def get_attachment_verdict(sha256: str) -> list[str] | None:
+    """Cached inspection warnings for an attachment payload, or None if unseen."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute("SELECT warnings FROM attachment_verdicts WHERE sha256 = ?", (sha256,))
+        row = cur.fetchone()
+        if row:
+            cur.execute("UPDATE attachment_verdicts SET hits = hits + 1 WHERE sha256 = ?", (sha256,))
+            conn.commit()
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def save_attachment_verdict(sha256: str, size: int, warnings: list[str]):
+    with _db_lock:
+        conn = _connect()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO attachment_verdicts (sha256, size, warnings, inspected_at, hits)
+            VALUES (?, ?, ?, ?, 0)
+            """,
+            (sha256, size, json.dumps(warnings), datetime.utcnow().isoformat() + "Z"),
+        )
+        conn.commit()
+        conn.close()
+
+
+# ---------- Retention ----------
+
+def take_expired_events(cutoffs: dict, default_cutoff: str, limit: int, archive) -> int:
+    """
+    Remove up to `limit` events older than their classification's cutoff
+    (ISO timestamps; "" keeps that class forever) in one short write transaction.
+    archive(rows) receives the full rows as dicts and must persist them before
+    they are deleted; per-day totals are folded into daily_stats, and release
+    pins on their processed_messages entries are lifted.
+    Returns how many events were removed.
+    """
+    bounds = [c for c in list(cutoffs.values()) + [default_cutoff] if c]
+    if not bounds:
+        return 0
+
+    # Per-class cutoff, falling back to the default; CASE needs at least one WHEN
+    if cutoffs:
+        cutoff_expr = f"CASE lower(classification) {' '.join('WHEN ? THEN ?' for _ in cutoffs)} ELSE ? END"
+    else:
+        cutoff_expr = "?"
+    params = [item for pair in cutoffs.items() for item in pair]
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        # Take the write lock up front so concurrent workers don't archive the same rows
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute(
+                f"""
+                SELECT * FROM quarantine_events
+                WHERE created_at < ?
+                  AND created_at < {cutoff_expr}
+                ORDER BY created_at
+                LIMIT ?
+                """,
+                (max(bounds), *params, default_cutoff, limit),
+            )
+            columns = [d[0] for d in cur.description]
+            rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+            if not rows:
+                conn.rollback()
+                return 0
+
+            archive(rows)
+
+            cur.executemany(
+                """
+                INSERT INTO daily_stats (day, classification, total, quarantined, released)
+                VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(day, classification) DO UPDATE SET
+                    total = total + 1,
+                    quarantined = quarantined + excluded.quarantined,
+                    released = released + excluded.released
+                """,
+                [
+                    (
+                        (r["created_at"] or "")[:10],
+                        r["classification"] or "unknown",
+                        int(bool(r["moved"])),
+                        int(bool(r["released"])),
+                    )
+                    for r in rows
+                ],
+            )
+            cur.executemany(
+                "DELETE FROM quarantine_events WHERE id = ?",
+                [(r["id"],) for r in rows],
+            )
+            # Release pins end with their event; prune_processed drops them after PROCESSED_TTL_DAYS
+            cur.executemany(
+                "UPDATE processed_messages SET pinned = 0 WHERE event_id = ? AND pinned = 1",
+                [(r["id"],) for r in rows],
+            )
+            _bump_generation(cur)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    return len(rows)
+
+
+def incremental_vacuum(pages: int) -> int:
+    """Return up to `pages` free pages to the OS. Returns the free pages left."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        cur.fetchall()
+        cur.execute("PRAGMA freelist_count")
+        remaining = cur.fetchone()[0]
+        conn.close()
+    return remaining
+
+
+def get_auto_vacuum_mode() -> int:
+    """0 = none, 1 = full, 2 = incremental."""
+    with _db_lock:
+        conn = _connect()
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        conn.close()
+    return mode
+
+
+def convert_to_incremental_vacuum():
+    """One-off full VACUUM that switches an existing database to incremental auto_vacuum."""
+    with _db_lock:
+        conn = _connect()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.close()
+
+
+# ---------- Poller worker leases ----------
+
+def heartbeat_worker(worker_id: str, ttl: float) -> list[str]:
+    """
+    Record a heartbeat for this worker, extend the leases it holds and
+    forget workers that missed their heartbeats.
+    Returns the sorted IDs of all live workers (including this one).
+    """
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO poller_workers (worker_id, heartbeat_at, started_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+            """,
+            (worker_id, now, now),
+        )
+        cur.execute(
+            "UPDATE mailbox_leases SET expires_at = ? WHERE worker_id = ?",
+            (now + ttl, worker_id),
+        )
+        cur.execute("DELETE FROM poller_workers WHERE heartbeat_at < ?", (now - ttl,))
+        cur.execute("SELECT worker_id FROM poller_workers ORDER BY worker_id")
+        rows = cur.fetchall()
+        conn.commit()
+        conn.close()
+
+    return [row[0] for row in rows]
+
+
+def sync_leases(worker_id: str, wanted: list[str], unwanted: list[str], ttl: float) -> list[str]:
+    """
+    In one transaction: take (or renew) leases on `wanted` mailboxes that are
+    free, expired or already ours, and give up any we hold in `unwanted`.
+    Returns the wanted mailboxes this worker now owns.
+    """
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        for mailbox in wanted:
+            cur.execute(
+                """
+                INSERT INTO mailbox_leases (mailbox, worker_id, expires_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(mailbox) DO UPDATE SET
+                    worker_id = excluded.worker_id,
+                    expires_at = excluded.expires_at
+                WHERE mailbox_leases.worker_id = excluded.worker_id
+                   OR mailbox_leases.expires_at < ?
+                """,
+                (mailbox, worker_id, now + ttl, now),
+            )
+        cur.executemany(
+            "DELETE FROM mailbox_leases WHERE mailbox = ? AND worker_id = ?",
+            [(mailbox, worker_id) for mailbox in unwanted],
+        )
+        cur.execute(
+            "SELECT mailbox FROM mailbox_leases WHERE worker_id = ? AND expires_at >= ?",
+            (worker_id, now),
+        )
+        owned = {row[0] for row in cur.fetchall()}
+        conn.commit()
+        conn.close()
+
+    return [mailbox for mailbox in wanted if mailbox in owned]
+
+
+def holds_lease(worker_id: str, mailbox: str) -> bool:
+    """Check that this worker still owns an unexpired lease on a mailbox."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM mailbox_leases WHERE mailbox = ? AND worker_id = ? AND expires_at >= ?",
+            (mailbox, worker_id, time.time()),
+        )
+        row = cur.fetchone()
+        conn.close()
+    return row is not None
+
+
+def retire_worker(worker_id: str):
+    """Drop a worker and all of its leases (clean shutdown)."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM mailbox_leases WHERE worker_id = ?", (worker_id,))
+        cur.execute("DELETE FROM poller_workers WHERE worker_id = ?", (worker_id,))
+        conn.commit()
+        conn.close()
+
+
+def list_leases():
+    """Return current mailbox ownership, for operators."""
+    with _db_lock:
+        conn = _connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT mailbox, worker_id, expires_at FROM mailbox_leases ORDER BY worker_id, mailbox"
+        )
+        rows = cur.fetchall()
+        conn.close()
+
+    return [
+        {"mailbox": row[0], "worker_id": row[1], "expires_at": row[2]}
+        for row in rows
+    ]
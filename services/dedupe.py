@@ -0,0 +1,99 @@
+"""
+Skip delta re-entries of messages that were already classified.
+
+Graph delta returns a message again whenever anything about it changes (read
+flag, categories, flags) and returns a message moved back to the Inbox under
+a new ID. processed_messages records (mailbox, message_id, fingerprint) for
+every classified message. A message is skipped when the same ID comes back
+with the same content, when the same content comes back under a new ID, or
+when it was released by an admin (pinned). Unpinned entries are forgotten
+after PROCESSED_TTL_DAYS.
+"""
+import asyncio
+import hashlib
+import os
+import time
+
+from services.db import find_processed, prune_processed
+from services.logging_utils import get_logger
+from services.metrics import Counter
+
+DEDUPE_ENABLED = os.getenv("DEDUPE_ENABLED", "true").lower() == "true"
+# How long a processed message is remembered (released ones are kept)
+PROCESSED_TTL_DAYS = float(os.getenv("PROCESSED_TTL_DAYS", "30"))
+# Seconds between prune runs
+PROCESSED_PRUNE_INTERVAL = 3600
+
+logger = get_logger(__name__)
+
+DUPLICATES_SKIPPED = Counter(
+    "poller_duplicates_skipped_total",
+    "Delta messages skipped as already processed (unchanged, moved, released)",
+    ("mailbox", "reason"),
+)
+
+_last_prune = 0.0
+
+
+def fingerprint(message: dict) -> str:
+    """Hash of the fields classification depends on; read state, flags and categories are left out."""
+    sender = ((message.get("from") or {}).get("emailAddress") or {}).get("address") or ""
+    body = (message.get("body") or {}).get("content") or message.get("bodyPreview") or ""
+    digest = hashlib.sha256()
+    for part in (sender.lower(), message.get("subject") or "", message.get("receivedDateTime") or "", body):
+        digest.update(part.encode("utf-8", "replace"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def filter_new(mailbox: str, messages: list[dict]) -> list[tuple[dict, str]]:
+    """
+    (message, fingerprint) for the messages that still need classifying, in
+    order. Duplicates within the page itself are dropped too.
+    """
+    fps = [fingerprint(m) for m in messages]
+    if not DEDUPE_ENABLED:
+        return list(zip(messages, fps))
+
+    known_ids, known_fps = {}, {}
+    for message_id, fp, pinned in find_processed(mailbox, [m["id"] for m in messages], fps):
+        known_ids[message_id] = (fp, pinned)
+        known_fps[fp] = known_fps.get(fp, 0) or pinned
+
+    fresh, seen = [], set()
+    for m, fp in zip(messages, fps):
+        by_id = known_ids.get(m["id"])
+        if by_id is not None and by_id[0] == fp:
+            reason = "released" if by_id[1] else "unchanged"
+        elif fp in known_fps:
+            # Same content under another ID: moved out of the Inbox and back
+            reason = "released" if known_fps[fp] else "moved"
+        elif fp in seen:
+            reason = "unchanged"
+        else:
+            seen.add(fp)
+            fresh.append((m, fp))
+            continue
+        DUPLICATES_SKIPPED.inc(mailbox=mailbox, reason=reason)
+
+    if len(fresh) < len(messages):
+        logger.info(
+            "skipped already processed messages",
+            extra={"user_email": mailbox, "skipped": len(messages) - len(fresh), "new": len(fresh)},
+        )
+    return fresh
+
+
+async def maybe_prune():
+    """Drop expired entries, at most once per PROCESSED_PRUNE_INTERVAL."""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PROCESSED_PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    try:
+        removed = await asyncio.to_thread(prune_processed, now - PROCESSED_TTL_DAYS * 86400)
+        if removed:
+            logger.info("pruned processed message index", extra={"removed": removed})
+    except Exception:
+        logger.exception("processed message prune failed")
@@ -0,0 +1,272 @@
+"""
+Content-addressed store of quarantined messages' text, for dashboard previews.
+
+For every quarantined message the poller saves a sanitized plain-text
+snapshot: the body with HTML, scripts and styles stripped, followed by the
+list of links. Links are defanged (hxxp://, [.]) so nothing in a preview is
+clickable. The blob is named after the SHA-256 of its text, so all recipients
+of one campaign share a single file.
+
+Blob layout (data/evidence/ab/<hash>.ev): a header, then the text cut into
+EVIDENCE_CHUNK_SIZE pieces that are compressed one by one (zstd when the
+zstandard package is installed, zlib otherwise). A range read decompresses
+only the chunks it touches.
+
+Blobs go away with their events. After each retention run, gc() deletes blobs
+that no live quarantine_events row references.
+
+Usage:
+    python -m services.evidence stats
+    python -m services.evidence gc
+"""
+import argparse
+import hashlib
+import html
+import json
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+
+from services import db
+from services.logging_utils import get_logger
+from services.metrics import Counter
+from services.url_analysis import extract_urls
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EVIDENCE_ENABLED = os.getenv("EVIDENCE_ENABLED", "true").lower() == "true"
+EVIDENCE_DIR = os.getenv("EVIDENCE_DIR") or os.path.join(db.DB_DIR, "evidence")
+# Uncompressed bytes per independently compressed chunk
+EVIDENCE_CHUNK_SIZE = int(os.getenv("EVIDENCE_CHUNK_SIZE", str(64 * 1024)))
+# Longest snapshot kept; the rest of a huge body is cut off
+EVIDENCE_MAX_BYTES = int(os.getenv("EVIDENCE_MAX_BYTES", str(1024 * 1024)))
+# Unreferenced blobs younger than this survive gc (their event may not be logged yet)
+EVIDENCE_GC_GRACE_SECONDS = 3600
+
+_MAGIC = b"EVB1"
+# magic, codec, chunk size, text length, chunk count
+_HEADER = struct.Struct("<4scIQI")
+_CODEC_ZLIB = b"z"
+_CODEC_ZSTD = b"s"
+
+_SCRIPT_RE = re.compile(r"<(script|style|head)\b.*?</\1\s*>", re.I | re.S)
+_BREAK_RE = re.compile(r"<\s*(br|/p|/div|/tr|/li|/h\d)\b[^>]*>", re.I)
+_TAG_RE = re.compile(r"<[^>]+>")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n+")
+_SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+_SCHEME_RE = re.compile(r"\b(http|ftp)(s?)://", re.I)
+_DEFANGED_HOST_RE = re.compile(r"(hxxps?://|fxps?://)([^/\s]+)")
+
+logger = get_logger(__name__)
+
+EVIDENCE_WRITES = Counter(
+    "poller_evidence_writes_total", "Evidence snapshots saved (new blob) or shared (dedup)", ("result",)
+)
+EVIDENCE_BYTES = Counter(
+    "poller_evidence_bytes_total", "Bytes of new evidence blobs, as text (raw) and on disk (stored)", ("kind",)
+)
+
+
+def defang(text: str) -> str:
+    """hxxps://evil[.]com - readable, but no viewer turns it into a link."""
+    out = _SCHEME_RE.sub(lambda m: ("hxxp" if m.group(1).lower() == "http" else "fxp") + m.group(2) + "://", text)
+    return _DEFANGED_HOST_RE.sub(lambda m: m.group(1) + m.group(2).replace(".", "[.]"), out)
+
+
+def html_to_text(content: str) -> str:
+    text = _SCRIPT_RE.sub("", content)
+    text = _BREAK_RE.sub("\n", text)
+    text = html.unescape(_TAG_RE.sub(" ", text))
+    text = "\n".join(_SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def snapshot(message: dict) -> str:
+    """Sanitized text of a Graph message: body, then its links."""
+    body = message.get("body") or {}
+    content = body.get("content") or message.get("bodyPreview") or ""
+    if (body.get("contentType") or "").lower() == "html":
+        text = html_to_text(content)
+    else:
+        text = content.replace("\r\n", "\n").strip()
+    urls = extract_urls(content)
+
+    parts = [defang(text)]
+    if urls:
+        parts.append("--- Links ---\n" + "\n".join(defang(u) for u in urls))
+    return "\n\n".join(parts)
+
+
+def _path(digest: str) -> str:
+    return os.path.join(EVIDENCE_DIR, digest[:2], digest + ".ev")
+
+
+def _encode(data: bytes) -> bytes:
+    if zstandard is not None:
+        codec, compress = _CODEC_ZSTD, zstandard.ZstdCompressor(level=10).compress
+    else:
+        codec, compress = _CODEC_ZLIB, lambda chunk: zlib.compress(chunk, 9)
+    chunks = [
+        compress(data[i:i + EVIDENCE_CHUNK_SIZE]) for i in range(0, len(data), EVIDENCE_CHUNK_SIZE)
+    ]
+    header = _HEADER.pack(_MAGIC, codec, EVIDENCE_CHUNK_SIZE, len(data), len(chunks))
+    lengths = struct.pack(f"<{len(chunks)}I", *(len(c) for c in chunks))
+    return header + lengths + b"".join(chunks)
+
+
+def store(text: str) -> str:
+    """Save a snapshot unless an identical one exists. Returns its hash."""
+    data = text.encode("utf-8")
+    if len(data) > EVIDENCE_MAX_BYTES:
+        # Cut on a character boundary
+        data = data[:EVIDENCE_MAX_BYTES].decode("utf-8", "ignore").encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _path(digest)
+    if os.path.exists(path):
+        # Refresh the mtime so gc's grace period covers this new reference
+        os.utime(path)
+        EVIDENCE_WRITES.inc(result="dedup")
+        return digest
+
+    blob = _encode(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, path)
+    EVIDENCE_WRITES.inc(result="new")
+    EVIDENCE_BYTES.inc(len(data), kind="raw")
+    EVIDENCE_BYTES.inc(len(blob), kind="stored")
+    return digest
+
+
+def save_message(message: dict) -> str | None:
+    """Snapshot a quarantined message; None when disabled or on failure (never blocks a verdict)."""
+    if not EVIDENCE_ENABLED:
+        return None
+    try:
+        return store(snapshot(message))
+    except Exception:
+        logger.exception("evidence snapshot failed", extra={"message_id": message.get("id")})
+        return None
+
+
+class Blob:
+    """An open evidence blob; read(start, end) decompresses only the chunks needed."""
+
+    def __init__(self, digest: str):
+        if not re.fullmatch(r"[0-9a-f]{64}", digest or ""):
+            raise FileNotFoundError(digest)
+        self.file = open(_path(digest), "rb")
+        magic, codec, self.chunk_size, self.size, count = _HEADER.unpack(self.file.read(_HEADER.size))
+        if magic != _MAGIC:
+            self.file.close()
+            raise ValueError(f"not an evidence blob: {digest}")
+        if codec == _CODEC_ZSTD:
+            if zstandard is None:
+                self.file.close()
+                raise RuntimeError("blob is zstd-compressed but zstandard is not installed")
+            self._decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            self._decompress = zlib.decompress
+        lengths = struct.unpack(f"<{count}I", self.file.read(4 * count))
+        self.offsets = [_HEADER.size + 4 * count]
+        for n in lengths:
+            self.offsets.append(self.offsets[-1] + n)
+
+    def read(self, start: int = 0, end: int | None = None) -> bytes:
+        """Bytes [start, end) of the text."""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return b""
+        first, last = start // self.chunk_size, (end - 1) // self.chunk_size
+        self.file.seek(self.offsets[first])
+        raw = self.file.read(self.offsets[last + 1] - self.offsets[first])
+        out, pos = [], 0
+        for i in range(first, last + 1):
+            n = self.offsets[i + 1] - self.offsets[i]
+            out.append(self._decompress(raw[pos:pos + n]))
+            pos += n
+        data = b"".join(out)
+        skip = first * self.chunk_size
+        return data[start - skip:end - skip]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _iter_blobs():
+    if not os.path.isdir(EVIDENCE_DIR):
+        return
+    for entry in os.scandir(EVIDENCE_DIR):
+        if entry.is_dir():
+            for blob in os.scandir(entry.path):
+                if blob.name.endswith(".ev"):
+                    yield blob
+
+
+def gc() -> dict:
+    """Delete blobs no live event references (older than the grace period)."""
+    referenced = db.list_evidence_hashes()
+    cutoff = time.time() - EVIDENCE_GC_GRACE_SECONDS
+    removed = freed = kept = 0
+    for blob in _iter_blobs():
+        stat = blob.stat()
+        if blob.name[:-3] in referenced or stat.st_mtime > cutoff:
+            kept += 1
+            continue
+        try:
+            os.remove(blob.path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += stat.st_size
+    if removed:
+        logger.info("evidence gc", extra={"removed": removed, "freed_bytes": freed, "kept": kept})
+    return {"removed": removed, "freed_bytes": freed, "kept": kept}
+
+
+def stats() -> dict:
+    blobs = stored = raw = 0
+    for blob in _iter_blobs():
+        blobs += 1
+        stored += blob.stat().st_size
+        with open(blob.path, "rb") as f:
+            raw += _HEADER.unpack(f.read(_HEADER.size))[3]
+    return {
+        "dir": EVIDENCE_DIR,
+        "codec": "zstd" if zstandard is not None else "zlib",
+        "blobs": blobs,
+        "referencing_events": db.count_evidence_references(),
+        "raw_bytes": raw,
+        "stored_bytes": stored,
+        "ratio": round(raw / stored, 2) if stored else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evidence blob store maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="blob count, sizes and compression ratio")
+    sub.add_parser("gc", help="delete blobs no live event references")
+    args = parser.parse_args()
+
+    db.init_db()
+    result = stats() if args.command == "stats" else gc()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
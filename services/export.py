@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+import zlib
+
+EXPORT_COLUMNS = (
+    "id", "created_at", "received_datetime", "user_email", "message_id", "sender",
+    "subject", "risk_score", "classification", "reasons", "moved", "released", "released_at",
+)
+
+# Bytes buffered before a chunk is handed to the response
+CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_chunks(events):
+    """One JSON object per line, CHUNK_SIZE at a time."""
+    buf = []
+    size = 0
+    for e in events:
+        line = json.dumps({c: e[c] for c in EXPORT_COLUMNS}, separators=(",", ":")) + "\n"
+        buf.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(buf).encode()
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf).encode()
+
+
+def csv_chunks(events):
+    """CSV with a header row; reasons are joined with "; ", booleans written as 0/1."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    for e in events:
+        row = dict(e, reasons="; ".join(e["reasons"]), moved=int(e["moved"]), released=int(e["released"]))
+        writer.writerow([row[c] for c in EXPORT_COLUMNS])
+        if out.tell() >= CHUNK_SIZE:
+            yield out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
+
+
+def gzip_chunks(chunks):
+    """Stream-compress into a single gzip member."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
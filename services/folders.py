@@ -1,12 +1,14 @@
+import os
 import httpx
 from dotenv import load_dotenv
 
 from services.auth import get_token
-from services.state import load_state, save_state
+from services.state import get_user_state, update_user_state
 
 load_dotenv()
 
-GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+# Overridable so the benchmark harness can point at a local stand-in
+GRAPH_BASE = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0")
 
 
 async def ensure_quarantine_folder(user_id: str, folder_name: str = "AI-Quarantine") -> str:
@@ -15,9 +17,7 @@ async def ensure_quarantine_folder(user_id: str, folder_name: str = "AI-Quaranti
     Returns the folder ID, creating it if necessary.
     Cached in state.json per user.
     """
-    state = load_state()
-    users_state = state.get("users", {})
-    user_state = users_state.get(user_id, {})
+    user_state = get_user_state(user_id)
 
     if "quarantine_folder_id" in user_state:
         return user_state["quarantine_folder_id"]
@@ -48,10 +48,7 @@ async def ensure_quarantine_folder(user_id: str, folder_name: str = "AI-Quaranti
                 # Surface original error if lookup somehow fails
                 raise
 
-    user_state["quarantine_folder_id"] = folder_id
-    users_state[user_id] = user_state
-    state["users"] = users_state
-    save_state(state)
+    update_user_state(user_id, {"quarantine_folder_id": folder_id})
 
     return folder_id
 
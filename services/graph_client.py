@@ -1,19 +1,41 @@
+import asyncio
 import os
 import httpx
 from dotenv import load_dotenv
 
 from services.auth import get_token
-from services.state import load_state, save_state
+from services.state import get_user_state, update_user_state
 from services.logging_utils import get_logger
+from services.metrics import Counter
 
 load_dotenv()
 
-GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+# Overridable so the benchmark harness can point at a local stand-in
+GRAPH_BASE = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0")
+# "full": delta pages carry every message's body. "lazy": delta carries headers
+# and bodyPreview only; the poller fetches text bodies with get_message_bodies()
+# for the messages that need them. Existing deltaLinks keep the $select they
+# were created with, so a change applies to mailboxes as they resync.
+DELTA_BODY_MODE = os.getenv("DELTA_BODY_MODE", "full").lower()
+# Fields requested for every message we classify
+MESSAGE_SELECT = "id,subject,from,receivedDateTime,bodyPreview,body,hasAttachments"
+MESSAGE_SELECT_LIGHT = "id,subject,from,receivedDateTime,bodyPreview,hasAttachments"
+# Graph accepts at most 20 requests per $batch
+BATCH_SIZE = 20
+BATCH_MAX_ATTEMPTS = 4
 # For legacy endpoints in the API that don't specify a user explicitly
 DEFAULT_USER = os.getenv("MONITORED_USER")
 
 logger = get_logger(__name__)
 
+RESPONSE_BYTES = Counter(
+    "poller_graph_response_bytes_total", "Graph response bytes by call (delta, backfill, bodies)", ("kind",)
+)
+
+
+def _message_select() -> str:
+    return MESSAGE_SELECT_LIGHT if DELTA_BODY_MODE == "lazy" else MESSAGE_SELECT
+
 async def get_all_mail_users():
     """
     Return a list of mail-enabled users in the tenant.
@@ -93,24 +115,26 @@ async def get_all_mail_users():
     return []
 
 
-async def get_delta_messages(user_id: str):
+async def get_delta_messages(user_id: str, received_after: str | None = None):
     """
     Use Microsoft Graph delta query to get new/changed messages for a given user.
     Stores and updates a per-user deltaLink in state.json.
     user_id should be something Graph accepts in /users/{user_id}, e.g. UPN or mail.
-    """
-    state = load_state()
-    users_state = state.get("users", {})
-    user_state = users_state.get(user_id, {})
 
-    delta_link = user_state.get("delta_link")
+    received_after (ISO 8601) bounds the initial sync: Graph only returns
+    messages received since then, and the deltaLink it hands back tracks
+    changes from that point on. It is ignored once a deltaLink exists.
+    """
+    delta_link = get_user_state(user_id).get("delta_link")
 
     token = await get_token()
     headers = {"Authorization": f"Bearer {token}"}
 
     if not delta_link:
-        # Request body so we can do full analysis
-        url = f"{GRAPH_BASE}/users/{user_id}/mailFolders/inbox/messages/delta?$select=id,subject,from,receivedDateTime,bodyPreview,body"
+        # Full mode requests the body here; lazy mode fetches it later if needed
+        url = f"{GRAPH_BASE}/users/{user_id}/mailFolders/inbox/messages/delta?$select={_message_select()}"
+        if received_after:
+            url += f"&$filter=receivedDateTime ge {received_after}"
     else:
         url = delta_link
 
@@ -120,6 +144,7 @@ async def get_delta_messages(user_id: str):
         while True:
             resp = await client.get(url, headers=headers)
             resp.raise_for_status()
+            RESPONSE_BYTES.inc(len(resp.content), kind="delta")
             data = resp.json()
 
             page_msgs = data.get("value", [])
@@ -136,16 +161,45 @@ async def get_delta_messages(user_id: str):
                 continue
 
             if new_delta_link:
-                user_state["delta_link"] = new_delta_link
-                users_state[user_id] = user_state
-                state["users"] = users_state
-                save_state(state)
+                update_user_state(user_id, {"delta_link": new_delta_link})
 
             break
 
     return messages
 
 
+async def get_backfill_page(
+    user_id: str,
+    received_before: str,
+    next_link: str | None = None,
+    top: int = 10,
+):
+    """
+    Fetch one page of older Inbox messages (newest first) for onboarding backfill.
+    Returns (messages, next_link); next_link is None when there is nothing left.
+    """
+    token = await get_token()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    if next_link:
+        url = next_link
+    else:
+        url = (
+            f"{GRAPH_BASE}/users/{user_id}/mailFolders/inbox/messages"
+            f"?$select={_message_select()}"
+            f"&$filter=receivedDateTime lt {received_before}"
+            f"&$orderby=receivedDateTime desc&$top={top}"
+        )
+
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(url, headers=headers)
+        resp.raise_for_status()
+        RESPONSE_BYTES.inc(len(resp.content), kind="backfill")
+        data = resp.json()
+
+    return data.get("value", []), data.get("@odata.nextLink")
+
+
 async def move_message(user_id: str, message_id: str, destination_folder_id: str):
     """
     Move a message to a different folder for a specific user.
@@ -168,6 +222,150 @@ async def move_message(user_id: str, message_id: str, destination_folder_id: str
         return resp.json()
 
 
+async def list_attachments(user_id: str, message_id: str) -> list[dict]:
+    """
+    Attachment metadata only (name, type, size); content is fetched separately
+    with iter_attachment_content() when it needs a closer look.
+    """
+    token = await get_token()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(
+            f"{GRAPH_BASE}/users/{user_id}/messages/{message_id}/attachments",
+            headers=headers,
+            params={"$select": "id,name,contentType,size,isInline"},
+        )
+        resp.raise_for_status()
+        return resp.json().get("value", [])
+
+
+async def iter_attachment_content(user_id: str, message_id: str, attachment_id: str, chunk_size: int = 64 * 1024):
+    """Stream a file attachment's raw bytes without holding it in memory."""
+    token = await get_token()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        async with client.stream(
+            "GET",
+            f"{GRAPH_BASE}/users/{user_id}/messages/{message_id}/attachments/{attachment_id}/$value",
+            headers=headers,
+        ) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(chunk_size):
+                yield chunk
+
+
+async def _batch(client: httpx.AsyncClient, headers: dict, keys: list, make_request, kind: str = "") -> dict:
+    """
+    Send one sub-request per key through $batch (BATCH_SIZE per request).
+    make_request(key) returns the sub-request without its "id". Returns
+    {key: (status, body)}. Throttled sub-requests are retried after their
+    Retry-After.
+    """
+    results = {}
+    for start in range(0, len(keys), BATCH_SIZE):
+        pending = list(keys[start:start + BATCH_SIZE])
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            requests = [dict(make_request(key), id=str(i)) for i, key in enumerate(pending)]
+            resp = await client.post(
+                f"{GRAPH_BASE}/$batch",
+                headers=headers,
+                json={"requests": requests},
+            )
+            resp.raise_for_status()
+            if kind:
+                RESPONSE_BYTES.inc(len(resp.content), kind=kind)
+
+            retry, retry_after = [], 0.0
+            for sub in resp.json().get("responses", []):
+                key = pending[int(sub["id"])]
+                status = sub.get("status", 0)
+                if status in (429, 503) and attempt + 1 < BATCH_MAX_ATTEMPTS:
+                    retry.append(key)
+                    sub_headers = sub.get("headers") or {}
+                    retry_after = max(retry_after, float(sub_headers.get("Retry-After", 1)))
+                else:
+                    results[key] = (status, sub.get("body") or {})
+
+            if not retry:
+                break
+            pending = retry
+            await asyncio.sleep(min(retry_after, 30))
+    return results
+
+
+async def move_messages(user_id: str, message_ids: list[str], destination_folder_id: str) -> dict:
+    """
+    Move many of one user's messages with Graph $batch (BATCH_SIZE per request).
+    Returns {old message id: new message id}, or None for moves that failed.
+    Throttled sub-requests are retried after their Retry-After.
+    """
+    token = await get_token()
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+    def move_request(message_id):
+        return {
+            "method": "POST",
+            "url": f"/users/{user_id}/messages/{message_id}/move",
+            "body": {"destinationId": destination_folder_id},
+            "headers": {"Content-Type": "application/json"},
+        }
+
+    async with httpx.AsyncClient() as client:
+        responses = await _batch(client, headers, message_ids, move_request)
+
+    results = {}
+    for message_id, (status, body) in responses.items():
+        if 200 <= status < 300:
+            results[message_id] = body.get("id")
+        else:
+            logger.warning(
+                "batched move failed",
+                extra={"user_email": user_id, "message_id": message_id, "status": status},
+            )
+            results[message_id] = None
+    return results
+
+
+async def get_message_bodies(user_id: str, message_ids: list[str]) -> dict:
+    """
+    Plain-text bodies for some of one user's messages, via $batch. Returns
+    {message id: {"contentType": "text", "content": ...}}; messages that could
+    not be fetched are left out.
+    """
+    token = await get_token()
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+    def body_request(message_id):
+        return {
+            "method": "GET",
+            "url": f"/users/{user_id}/messages/{message_id}?$select=body",
+            # Graph converts HTML to text server-side (links are kept as <url>)
+            "headers": {"Prefer": 'outlook.body-content-type="text"'},
+        }
+
+    async with httpx.AsyncClient() as client:
+        responses = await _batch(client, headers, message_ids, body_request, kind="bodies")
+
+    bodies = {}
+    for message_id, (status, body) in responses.items():
+        if 200 <= status < 300 and body.get("body"):
+            bodies[message_id] = body["body"]
+        else:
+            logger.warning(
+                "batched body fetch failed",
+                extra={"user_email": user_id, "message_id": message_id, "status": status},
+            )
+    return bodies
+
+
 # ---- Legacy helpers used by the API test endpoints ----
 
 async def list_recent_messages(top: int = 10):
@@ -201,11 +399,16 @@ async def get_inbox_folder_id(user_id: str | None = None):
     """
     Get Inbox folder ID for a user.
     If user_id is None, uses DEFAULT_USER (for admin 'release' API).
+    Cached in state.json per user.
     """
     user = user_id or DEFAULT_USER
     if not user:
         raise RuntimeError("No user_id provided and MONITORED_USER not set")
 
+    cached = get_user_state(user).get("inbox_folder_id")
+    if cached:
+        return cached
+
     token = await get_token()
     headers = {"Authorization": f"Bearer {token}"}
 
@@ -215,5 +418,7 @@ async def get_inbox_folder_id(user_id: str | None = None):
             headers=headers,
         )
         resp.raise_for_status()
-        data = resp.json()
-        return data["id"]
\ No newline at end of file
+        folder_id = resp.json()["id"]
+
+    update_user_state(user, {"inbox_folder_id": folder_id})
+    return folder_id
\ No newline at end of file
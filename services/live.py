@@ -0,0 +1,98 @@
+import asyncio
+import os
+from datetime import datetime
+
+from services.db import (
+    get_dashboard_stats,
+    get_max_event_id,
+    list_events_changed_since,
+    list_events_since,
+)
+from services.logging_utils import get_logger
+
+# Seconds between checks for new or released events (one query for all viewers)
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "2"))
+# Updates buffered per viewer; a viewer that falls this far behind is dropped
+# and its EventSource reconnects
+LIVE_QUEUE_SIZE = 100
+
+logger = get_logger(__name__)
+
+
+class LiveFeed:
+    """
+    Fans out dashboard updates to every connected viewer. A single background
+    task checks the DB for new events (id > last seen) and status changes
+    ((status_changed_at, id) > last seen), and only recomputes the counters when
+    something changed. `render` turns an event dict into whatever the page
+    inserts (the row HTML), once per update rather than once per viewer.
+    """
+
+    def __init__(self, render=None, interval: float = LIVE_POLL_INTERVAL):
+        self.render = render
+        self.interval = interval
+        self.subscribers: set[asyncio.Queue] = set()
+        self.last_id = None
+        # (status_changed_at, id) of the last status change sent
+        self.last_change = None
+        self._task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def _payload(self, new_events: list[dict], changed_events: list[dict]) -> dict:
+        def entry(e):
+            return {"id": e["id"], "html": self.render(e) if self.render else None, "event": e}
+
+        return {
+            "last_id": self.last_id,
+            "new": [entry(e) for e in new_events],
+            "changed": [entry(e) for e in changed_events],
+            "stats": get_dashboard_stats(),
+        }
+
+    def _check(self):
+        if self.last_id is None:
+            # Start from "now"; the page was rendered from the DB already
+            self.last_id = get_max_event_id()
+            self.last_change = (datetime.utcnow().isoformat() + "Z", 0)
+            return None
+
+        new_events = list_events_since(self.last_id)
+        changed_events = list_events_changed_since(*self.last_change)
+        if not new_events and not changed_events:
+            return None
+        if new_events:
+            self.last_id = new_events[-1]["id"]
+        if changed_events:
+            self.last_change = (changed_events[-1]["status_changed_at"], changed_events[-1]["id"])
+        return self._payload(new_events, changed_events)
+
+    async def _run(self):
+        while self.subscribers:
+            try:
+                update = await asyncio.to_thread(self._check)
+            except Exception:
+                logger.exception("live feed check failed")
+                update = None
+
+            if update:
+                for queue in list(self.subscribers):
+                    try:
+                        queue.put_nowait(update)
+                    except asyncio.QueueFull:
+                        # Too slow; its stream ends and the browser reconnects fresh
+                        self.subscribers.discard(queue)
+                        logger.warning("dropping slow live viewer")
+
+            await asyncio.sleep(self.interval)
+
+        # Nobody is watching: forget the cursor so the next viewer starts fresh
+        self.last_id = None
@@ -1,24 +1,18 @@
-import os
-import httpx
-from dotenv import load_dotenv
-
 from services.url_analysis import extract_urls, analyze_url_reputation
+from services.llm_pool import pool
 
-load_dotenv()
-
-# URL of your LLM wrapper API (FastAPI on the LLM container)
-LLM_API = os.getenv("LLM_API_URL", "http://192.168.2.125:8081/classify")
+# Backend URLs (LLM_API_URLS / LLM_API_URL), timeouts and routing live in services/llm_pool.py
 
 
-async def classify_with_llama(email: dict) -> dict:
+def build_payload(
+    email: dict,
+    attachments: dict | None = None,
+    sender_history: str | None = None,
+) -> dict:
     """
-    Calls the local Llama 3.1 8B inference API to classify an email.
-    Expects /classify to return JSON:
-    {
-      "risk_score": int,
-      "classification": "safe" | "spam" | "phishing" | "malicious",
-      "reasons": [ ... ]
-    }
+    The /classify request body for a Graph message: URL extraction and
+    reputation, body truncation, attachment and sender history. CPU-only, so
+    the bulk CLI can run it in worker processes.
     """
     sender = (
         (email.get("from", {}) or {})
@@ -53,8 +47,31 @@ async def classify_with_llama(email: dict) -> dict:
         "urls": urls,
         "url_warnings": url_warnings,
     }
+    if sender_history:
+        payload["sender_history"] = sender_history
+    if attachments:
+        payload["attachments"] = [a["name"] for a in attachments["attachments"]]
+        payload["attachment_warnings"] = attachments["warnings"]
+    return payload
+
+
+async def classify_with_llama(
+    email: dict,
+    attachments: dict | None = None,
+    sender_history: str | None = None,
+) -> dict:
+    """
+    Calls the llm-api model cascade (see llm-api/api/main.py) to classify an email.
+    attachments is the report from services.attachments, if the message has any;
+    sender_history is the reputation summary for the sender and its domain.
+    Expects /classify to return JSON:
+    {
+      "risk_score": int,
+      "classification": "safe" | "spam" | "phishing" | "malicious",
+      "reasons": [ ... ]
+    }
+    """
+    payload = build_payload(email, attachments, sender_history)
 
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        resp = await client.post(LLM_API, json=payload)
-        resp.raise_for_status()
-        return resp.json()
\ No newline at end of file
+    # Routed to the least-busy healthy llm-api backend
+    return await pool.classify(payload)
\ No newline at end of file
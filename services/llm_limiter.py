@@ -0,0 +1,150 @@
+"""
+Global limit on LLM classifications in flight, shared by every mailbox.
+
+The limit adapts AIMD-style. A request that finishes within
+LLM_LATENCY_TARGET while the limit was in use adds 1/limit, so the limit
+grows by about one per round trip. An error or a slow answer multiplies the
+limit by LLM_LIMIT_DECREASE. Only one decrease happens per round trip:
+requests started before the last decrease were sent under the old limit and
+don't count again.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+from services.logging_utils import get_logger
+from services.metrics import Counter, Gauge
+
+load_dotenv()
+
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "32"))
+LLM_CONCURRENCY_INITIAL = float(os.getenv("LLM_CONCURRENCY_INITIAL", "4"))
+# Round trips slower than this (seconds, queueing included) count as overload
+LLM_LATENCY_TARGET = float(os.getenv("LLM_LATENCY_TARGET", "30"))
+# Factor applied to the limit on an error or a slow round trip
+LLM_LIMIT_DECREASE = float(os.getenv("LLM_LIMIT_DECREASE", "0.7"))
+
+logger = get_logger(__name__)
+
+LIMIT = Gauge("poller_llm_concurrency_limit", "Current adaptive limit on LLM requests in flight", ())
+IN_FLIGHT = Gauge("poller_llm_in_flight", "LLM requests in flight across all mailboxes", ())
+WAITING = Gauge("poller_llm_waiting", "Messages waiting for an LLM slot", ())
+DECISIONS = Counter(
+    "poller_llm_limit_decisions_total",
+    "Limit adjustments (increase, decrease_latency, decrease_error, hold)",
+    ("decision",),
+)
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial: float = LLM_CONCURRENCY_INITIAL,
+        minimum: int = LLM_CONCURRENCY_MIN,
+        maximum: int = LLM_CONCURRENCY_MAX,
+        target: float = LLM_LATENCY_TARGET,
+        decrease: float = LLM_LIMIT_DECREASE,
+        clock=time.monotonic,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial))
+        self.target = target
+        self.decrease = decrease
+        self.clock = clock
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._last_decrease = float("-inf")
+        LIMIT.set(round(self.limit, 2))
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one LLM slot for the body; its outcome and duration adjust the limit."""
+        await self._acquire()
+        started = self.clock()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self._release()
+            raise
+        except Exception:
+            self._adjust(started, ok=False)
+            self._release()
+            raise
+        else:
+            self._adjust(started, ok=True)
+            self._release()
+
+    async def _acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self._take()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        WAITING.set(len(self._waiters))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just as we were cancelled: pass it on
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+                WAITING.set(len(self._waiters))
+            raise
+
+    def _take(self):
+        self.in_flight += 1
+        IN_FLIGHT.set(self.in_flight)
+
+    def _release(self):
+        self.in_flight -= 1
+        IN_FLIGHT.set(self.in_flight)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self._take()
+            waiter.set_result(None)
+        WAITING.set(len(self._waiters))
+
+    def _adjust(self, started: float, ok: bool):
+        latency = self.clock() - started
+        if not ok or latency > self.target:
+            if started < self._last_decrease:
+                # Sent under the old limit; that overload was already acted on
+                DECISIONS.inc(decision="hold")
+                return
+            previous = self.limit
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self._last_decrease = self.clock()
+            DECISIONS.inc(decision="decrease_latency" if ok else "decrease_error")
+            logger.info(
+                "llm concurrency limit decreased",
+                extra={"limit": round(self.limit, 2), "previous": round(previous, 2), "latency": round(latency, 2), "ok": ok},
+            )
+        elif self.in_flight >= int(self.limit) and self.limit < self.maximum:
+            # Only grow a limit that is actually being used
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            DECISIONS.inc(decision="increase")
+        else:
+            DECISIONS.inc(decision="hold")
+        LIMIT.set(round(self.limit, 2))
+
+    def stats(self) -> dict:
+        return {
+            "llm_limit": round(self.limit, 2),
+            "llm_in_flight": self.in_flight,
+            "llm_waiting": len(self._waiters),
+        }
+
+
+limiter = AIMDLimiter()
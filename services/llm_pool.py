@@ -0,0 +1,336 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+from dotenv import load_dotenv
+
+from services.logging_utils import get_logger
+from services.metrics import Counter, Gauge, Histogram
+
+load_dotenv()
+
+# Comma-separated /classify URLs of llm-api instances. Falls back to LLM_API_URL.
+LLM_API_URLS = [
+    u.strip()
+    for u in os.getenv("LLM_API_URLS", "").split(",")
+    if u.strip()
+] or [os.getenv("LLM_API_URL", "http://192.168.2.125:8081/classify")]
+# Per-request timeout towards a single backend
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+# Send a duplicate request to a second backend if the first hasn't answered
+# after this many seconds. 0 = use the first backend's observed p95.
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+# Backends tried per message (first attempt + hedge/retry)
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))
+# Consecutive failures that open a backend's circuit, and how long it stays open
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "15"))
+# How long a message may wait for busy backends (503 + Retry-After) to free up
+LLM_BUSY_MAX_WAIT = float(os.getenv("LLM_BUSY_MAX_WAIT", "120"))
+
+# Latency samples needed before the p95 is trusted for hedging
+_MIN_SAMPLES_FOR_HEDGE = 20
+# Log per-backend stats every N health-check rounds
+_STATS_LOG_EVERY = 4
+
+logger = get_logger(__name__)
+
+BACKEND_REQUEST_SECONDS = Histogram(
+    "llm_backend_request_seconds", "Successful /classify round trips per backend", ("backend",)
+)
+BACKEND_ERRORS = Counter(
+    "llm_backend_errors_total", "Failed /classify requests per backend", ("backend",)
+)
+BACKEND_OUTSTANDING = Gauge(
+    "llm_backend_outstanding", "In-flight /classify requests per backend", ("backend",)
+)
+BACKEND_AVAILABLE = Gauge(
+    "llm_backend_available", "1 if the backend is healthy and its circuit is not open", ("backend",)
+)
+BACKEND_BUSY = Counter(
+    "llm_backend_busy_total", "Requests a backend turned away with a full queue", ("backend",)
+)
+HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests_total", "Requests duplicated onto a second backend", ()
+)
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+class BackendBusy(RuntimeError):
+    """The backend's queue is full; not a failure, try elsewhere or later."""
+
+    def __init__(self, backend: str, retry_after: float):
+        super().__init__(f"{backend} busy, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def _percentile(sorted_values: list, pct: float) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Backend:
+    """One llm-api instance plus its health, breaker and latency bookkeeping."""
+
+    def __init__(self, url: str):
+        self.url = url
+        if url.rstrip("/").endswith("/classify"):
+            self.health_url = url.rstrip("/")[: -len("/classify")] + "/health"
+        else:
+            self.health_url = url.rstrip("/") + "/health"
+        self.client = httpx.AsyncClient(timeout=LLM_TIMEOUT)
+
+        self.outstanding = 0
+        self.healthy = True
+        # Circuit breaker: closed -> open (after N failures) -> half_open (one trial)
+        self.breaker = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        # Set from a 503's Retry-After; the backend is skipped until then
+        self.busy_until = 0.0
+
+        self.latencies = deque(maxlen=500)
+        self.requests = 0
+        self.errors = 0
+
+    def available(self) -> bool:
+        if not self.healthy:
+            return False
+        if self.breaker == "open":
+            if time.monotonic() - self.opened_at < LLM_BREAKER_COOLDOWN:
+                return False
+            self.breaker = "half_open"
+        if self.breaker == "half_open":
+            # Let a single trial request through
+            return self.outstanding == 0
+        return True
+
+    def busy_for(self) -> float:
+        return max(0.0, self.busy_until - time.monotonic())
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        if self.breaker != "closed":
+            logger.info("llm backend circuit closed", extra={"backend": self.url})
+        self.breaker = "closed"
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.breaker == "half_open" or (
+            self.breaker == "closed" and self.consecutive_failures >= LLM_BREAKER_FAILURES
+        ):
+            self.breaker = "open"
+            self.opened_at = time.monotonic()
+            logger.warning(
+                "llm backend circuit opened",
+                extra={"backend": self.url, "failures": self.consecutive_failures},
+            )
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < _MIN_SAMPLES_FOR_HEDGE:
+            return None
+        return _percentile(sorted(self.latencies), 95)
+
+    def stats(self) -> dict:
+        samples = sorted(self.latencies)
+        return {
+            "backend": self.url,
+            "healthy": self.healthy,
+            "breaker": self.breaker,
+            "outstanding": self.outstanding,
+            "busy_for": round(self.busy_for(), 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "p50": _percentile(samples, 50),
+            "p95": _percentile(samples, 95),
+            "p99": _percentile(samples, 99),
+        }
+
+
+class LLMPool:
+    """
+    Routes classification requests across several llm-api backends:
+    least-outstanding-requests selection, active health checks,
+    per-backend circuit breakers and hedged retries.
+    """
+
+    def __init__(self, urls: list[str]):
+        self.backends = [Backend(u) for u in urls]
+        self._health_task = None
+
+    def pick(self, exclude: list | None = None) -> Backend | None:
+        exclude = exclude or []
+        candidates = [
+            b for b in self.backends if b not in exclude and b.available() and not b.busy_for()
+        ]
+        if not candidates:
+            return None
+        fewest = min(b.outstanding for b in candidates)
+        # Random tie-break so idle backends share load evenly
+        return random.choice([b for b in candidates if b.outstanding == fewest])
+
+    def _hedge_delay(self, backend: Backend) -> float | None:
+        if not LLM_HEDGE_ENABLED or LLM_MAX_ATTEMPTS < 2 or len(self.backends) < 2:
+            return None
+        if LLM_HEDGE_AFTER > 0:
+            return LLM_HEDGE_AFTER
+        return backend.p95()
+
+    async def _call(self, backend: Backend, payload: dict) -> dict:
+        backend.outstanding += 1
+        BACKEND_OUTSTANDING.set(backend.outstanding, backend=backend.url)
+        start = time.monotonic()
+        try:
+            # Lets llm-api drop the request once we've stopped waiting for it
+            resp = await backend.client.post(
+                backend.url, json=payload, headers={"X-Request-Timeout": str(LLM_TIMEOUT)}
+            )
+            if resp.status_code == 503 and "retry-after" in resp.headers:
+                retry_after = float(resp.headers["retry-after"])
+                backend.busy_until = time.monotonic() + retry_after
+                BACKEND_BUSY.inc(backend=backend.url)
+                raise BackendBusy(backend.url, retry_after)
+            resp.raise_for_status()
+            result = resp.json()
+        except (asyncio.CancelledError, BackendBusy):
+            # Lost a hedge race, or shed by a full queue - not the backend's fault
+            raise
+        except Exception:
+            backend.record_failure()
+            BACKEND_ERRORS.inc(backend=backend.url)
+            raise
+        else:
+            latency = time.monotonic() - start
+            backend.record_success(latency)
+            BACKEND_REQUEST_SECONDS.observe(latency, backend=backend.url)
+            return result
+        finally:
+            backend.outstanding -= 1
+            BACKEND_OUTSTANDING.set(backend.outstanding, backend=backend.url)
+
+    async def classify(self, payload: dict) -> dict:
+        """
+        Classify on the best backend. When every backend is busy, waits out
+        the shortest Retry-After and tries again, up to LLM_BUSY_MAX_WAIT.
+        """
+        self._ensure_health_checks()
+        waited = 0.0
+        while True:
+            try:
+                return await self._classify_once(payload)
+            except BackendBusy as exc:
+                delay = min(exc.retry_after, LLM_BUSY_MAX_WAIT - waited)
+                if delay <= 0:
+                    raise
+                logger.info("llm backends busy, waiting", extra={"retry_after": round(delay, 1)})
+                await asyncio.sleep(delay)
+                waited += delay
+
+    async def _classify_once(self, payload: dict) -> dict:
+        backend = self.pick()
+        if backend is None:
+            busy = [b.busy_for() for b in self.backends if b.available() and b.busy_for()]
+            if busy:
+                raise BackendBusy("all backends", min(busy))
+            raise NoBackendAvailable("no healthy LLM backends available")
+
+        tried = [backend]
+        tasks = {asyncio.create_task(self._call(backend, payload)): backend}
+        hedge_delay = self._hedge_delay(backend)
+        last_error = None
+
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=hedge_delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                if not done:
+                    # Slow primary: hedge onto another backend (once)
+                    hedge_delay = None
+                    extra = self.pick(exclude=tried)
+                    if extra and len(tried) < LLM_MAX_ATTEMPTS:
+                        logger.info(
+                            "hedging llm request",
+                            extra={"backend": tasks[next(iter(tasks))].url, "hedge": extra.url},
+                        )
+                        HEDGED_REQUESTS.inc()
+                        tried.append(extra)
+                        tasks[asyncio.create_task(self._call(extra, payload))] = extra
+                    continue
+
+                for task in done:
+                    failed = tasks.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as exc:
+                        last_error = exc
+                        logger.warning(
+                            "llm backend request failed",
+                            extra={"backend": failed.url, "error": repr(exc)},
+                        )
+
+                # Everything in flight failed: retry on a backend we haven't tried.
+                # Being shed by a busy backend doesn't use up an attempt.
+                busy = isinstance(last_error, BackendBusy)
+                if not tasks and (len(tried) < LLM_MAX_ATTEMPTS or busy):
+                    retry = self.pick(exclude=tried)
+                    if retry:
+                        tried.append(retry)
+                        tasks[asyncio.create_task(self._call(retry, payload))] = retry
+
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _ensure_health_checks(self):
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _check(self, backend: Backend):
+        try:
+            resp = await backend.client.get(backend.health_url, timeout=5.0)
+            healthy = resp.status_code == 200
+        except Exception:
+            healthy = False
+        if healthy != backend.healthy:
+            logger.warning(
+                "llm backend health changed",
+                extra={"backend": backend.url, "healthy": healthy},
+            )
+        backend.healthy = healthy
+
+    async def _health_loop(self):
+        rounds = 0
+        while True:
+            await asyncio.gather(*(self._check(b) for b in self.backends))
+            for b in self.backends:
+                BACKEND_AVAILABLE.set(int(b.available()), backend=b.url)
+            rounds += 1
+            if rounds % _STATS_LOG_EVERY == 0:
+                for stats in self.stats():
+                    logger.info("llm backend stats", extra=stats)
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+    def stats(self) -> list[dict]:
+        return [b.stats() for b in self.backends]
+
+
+pool = LLMPool(LLM_API_URLS)
@@ -1,13 +1,37 @@
+import atexit
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import sys
 from typing import Optional
 
+from services.metrics import Counter
+
 DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s | %(message)s"
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
 
+# Records waiting for the writer thread. When full, new records are dropped
+# (and counted) instead of blocking the event loop. 0 = write synchronously.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Keep only a fraction of below-WARNING records per logger, e.g.
+# "services.poller=0.1,httpx=0.05". Prefixes match child loggers.
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Log records discarded before being written, by reason (queue_full, sampled) and level.",
+    ("reason", "level"),
+)
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_RESERVED_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
 _configured = False
+_listener: Optional[logging.handlers.QueueListener] = None
 
 
 class JsonFormatter(logging.Formatter):
@@ -20,11 +44,83 @@ class JsonFormatter(logging.Formatter):
             "logger": record.name,
             "message": record.getMessage(),
         }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and key not in log:
+                log[key] = value
         if record.exc_info:
             log["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            log["exc_info"] = record.exc_text
         if record.stack_info:
             log["stack"] = self.formatStack(record.stack_info)
-        return json.dumps(log)
+        return json.dumps(log, default=str)
+
+
+def _parse_sample_rates(spec: str) -> dict:
+    rates = {}
+    for item in spec.split(","):
+        name, sep, rate = item.strip().partition("=")
+        if not sep:
+            continue
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class _SamplingFilter(logging.Filter):
+    """Keep a per-logger fraction of below-WARNING records; WARNING and up always pass."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}
+
+    def _rate_for(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            # Longest matching prefix wins
+            best = -1
+            for prefix, value in self.rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    rate, best = value, len(prefix)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate_for(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        LOG_RECORDS_DROPPED.inc(reason="sampled", level=record.levelname)
+        return False
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread. Formatting and the stdout write happen
+    on the QueueListener thread, so a slow journald never stalls the poller.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve %-args and tracebacks now (the objects may change later), but
+        # leave formatting to the listener's handler so extras survive.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason="queue_full", level=record.levelname)
 
 
 def _resolve_log_level() -> int:
@@ -39,13 +135,34 @@ def _resolve_formatter() -> logging.Formatter:
     return logging.Formatter(DEFAULT_FORMAT, DATE_FORMAT)
 
 
+def _stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        # Drains whatever is still queued before returning
+        _listener.stop()
+        _listener = None
+
+
 def configure_logging(force: bool = False) -> None:
-    global _configured
+    global _configured, _listener
     if _configured and not force:
         return
 
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(_resolve_formatter())
+    _stop_listener()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(_resolve_formatter())
+
+    if LOG_QUEUE_SIZE > 0:
+        handler = _NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+        _listener.start()
+    else:
+        handler = stream_handler
+
+    rates = _parse_sample_rates(LOG_SAMPLE_RATES)
+    if rates:
+        handler.addFilter(_SamplingFilter(rates))
 
     logging.basicConfig(
         level=_resolve_log_level(),
@@ -55,6 +172,9 @@ def configure_logging(force: bool = False) -> None:
     _configured = True
 
 
+atexit.register(_stop_listener)
+
+
 def get_logger(name: Optional[str] = None) -> logging.Logger:
     configure_logging()
     return logging.getLogger(name)
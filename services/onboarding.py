@@ -0,0 +1,188 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from services.graph_client import get_backfill_page
+from services.state import load_state, get_user_state, update_user_state
+from services.logging_utils import get_logger
+
+load_dotenv()
+
+# When a mailbox is first seen, only classify mail received in the last N days.
+# Older mail is skipped by the initial delta sync. 0 = classify the whole Inbox.
+ONBOARDING_WINDOW_DAYS = int(os.getenv("ONBOARDING_WINDOW_DAYS", "0"))
+# Optionally classify the skipped older mail in the background
+BACKFILL_ENABLED = os.getenv("BACKFILL_ENABLED", "false").lower() == "true"
+# Global cap on backfilled messages sent to the LLM per minute (all mailboxes)
+BACKFILL_RATE_PER_MIN = int(os.getenv("BACKFILL_RATE_PER_MIN", "10"))
+# Messages requested from Graph per backfill page
+BACKFILL_PAGE_SIZE = int(os.getenv("BACKFILL_PAGE_SIZE", "10"))
+
+logger = get_logger(__name__)
+
+
+class _RateBudget:
+    """
+    Token bucket for the backfill rate cap.
+    Pages are charged after they are fetched, so the balance may go negative;
+    the next cycle then waits until the debt is paid off.
+    """
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0
+        self.capacity = max(per_minute, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def available(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def spend(self, n: int):
+        self.tokens -= n
+
+
+_budget = _RateBudget(BACKFILL_RATE_PER_MIN)
+
+
+def _now_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def initial_sync_cutoff(user_id: str) -> str | None:
+    """
+    Return the receivedDateTime lower bound for a mailbox's first delta sync,
+    or None if the mailbox already has a deltaLink or onboarding mode is off.
+    """
+    if ONBOARDING_WINDOW_DAYS <= 0:
+        return None
+
+    if get_user_state(user_id).get("delta_link"):
+        return None
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ONBOARDING_WINDOW_DAYS)
+    return cutoff.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def record_onboarding(user_id: str, cutoff: str, initial_messages: int):
+    """Record that a mailbox finished its bounded initial sync."""
+    onboarding = {
+        "status": "backfilling" if BACKFILL_ENABLED else "live-only",
+        "window_days": ONBOARDING_WINDOW_DAYS,
+        "cutoff": cutoff,
+        "started_at": _now_iso(),
+        "initial_messages": initial_messages,
+        "backfill_processed": 0,
+        "backfill_next_link": None,
+        "completed_at": None,
+    }
+    update_user_state(user_id, {"onboarding": onboarding})
+
+    logger.info(
+        "mailbox onboarded",
+        extra={
+            "user_email": user_id,
+            "cutoff": cutoff,
+            "initial_messages": initial_messages,
+            "backfill": BACKFILL_ENABLED,
+        },
+    )
+
+
+def _update_onboarding(user_id: str, **fields) -> dict:
+    # Only the worker holding the mailbox's lease writes its onboarding state
+    onboarding = get_user_state(user_id).get("onboarding", {})
+    onboarding.update(fields)
+    update_user_state(user_id, {"onboarding": onboarding})
+    return onboarding
+
+
+def get_onboarding_progress() -> list[dict]:
+    """Per-mailbox onboarding/backfill progress, for the admin API."""
+    users_state = load_state().get("users", {})
+    progress = []
+    for user_id, user_state in sorted(users_state.items()):
+        onboarding = user_state.get("onboarding")
+        if not onboarding:
+            continue
+        entry = {k: v for k, v in onboarding.items() if k != "backfill_next_link"}
+        entry["user_email"] = user_id
+        progress.append(entry)
+    return progress
+
+
+async def run_backfill(process_page, mailboxes: list[str] | None = None) -> int:
+    """
+    Classify older mail for mailboxes still backfilling, within the global rate cap.
+
+    process_page(user_email, messages) is awaited for each fetched page.
+    mailboxes restricts the run to those mailboxes (e.g. the ones this worker owns).
+    Live delta traffic is always handled first; this runs after a poll cycle.
+    Returns the number of messages backfilled in this call.
+    """
+    if not BACKFILL_ENABLED:
+        return 0
+
+    total = 0
+    users_state = load_state().get("users", {})
+    pending = [
+        (user_id, user_state["onboarding"])
+        for user_id, user_state in users_state.items()
+        if user_state.get("onboarding", {}).get("status") == "backfilling"
+        and (mailboxes is None or user_id in mailboxes)
+    ]
+
+    for user_id, onboarding in pending:
+        next_link = onboarding.get("backfill_next_link")
+        processed = onboarding.get("backfill_processed", 0)
+
+        while _budget.available() >= 1:
+            try:
+                messages, next_link = await get_backfill_page(
+                    user_id,
+                    onboarding["cutoff"],
+                    next_link=next_link,
+                    top=BACKFILL_PAGE_SIZE,
+                )
+            except Exception:
+                logger.exception("backfill page fetch failed", extra={"user_email": user_id})
+                break
+
+            _budget.spend(len(messages))
+            if messages:
+                await process_page(user_id, messages)
+            processed += len(messages)
+            total += len(messages)
+
+            if next_link:
+                _update_onboarding(
+                    user_id,
+                    backfill_processed=processed,
+                    backfill_next_link=next_link,
+                )
+            else:
+                _update_onboarding(
+                    user_id,
+                    status="complete",
+                    backfill_processed=processed,
+                    backfill_next_link=None,
+                    completed_at=_now_iso(),
+                )
+
+            logger.info(
+                "backfill progress",
+                extra={
+                    "user_email": user_id,
+                    "backfill_processed": processed,
+                    "complete": next_link is None,
+                },
+            )
+
+            if not next_link:
+                break
+
+    return total
@@ -0,0 +1,267 @@
+"""
+Per-mailbox, per-group and per-domain quarantine policy.
+
+The policy file (POLICY_FILE, JSON) is compiled once at load into a dict of
+effective per-mailbox policies plus reversed-domain tries, so evaluating a
+message is a dict lookup and a walk over the sender domain's labels. Without
+a file, the defaults reproduce RISK_THRESHOLD / ORG_DOMAIN.
+
+{
+  "defaults": {
+    "spam_threshold": 80,
+    "phishing_threshold": 70,
+    "malicious_threshold": 70,
+    "internal_domains": ["contoso.com"],
+    "quarantine_internal": false,
+    "allow_domains": ["partner.com"],
+    "deny_senders": ["ceo@contoso-payroll.com"]
+  },
+  "groups": {
+    "executives": {"members": ["ceo@contoso.com"], "phishing_threshold": 40, "poll_interval": 10}
+  },
+  "mailboxes": {
+    "sales@contoso.com": {"spam_threshold": 90}
+  }
+}
+
+Settings merge defaults <- groups (in file order) <- mailbox. Thresholds,
+flags and poll_interval (a fixed poll cadence in seconds) override;
+allow/deny lists and internal_domains are combined. Domain entries also
+cover subdomains, and deny wins over allow.
+"""
+import json
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from services.logging_utils import get_logger
+
+load_dotenv()
+
+POLICY_FILE = os.getenv("POLICY_FILE", "")
+# Seconds between checks of the policy file's mtime
+POLICY_RELOAD_INTERVAL = float(os.getenv("POLICY_RELOAD_INTERVAL", "5"))
+
+_RISK_THRESHOLD = int(os.getenv("RISK_THRESHOLD", "60"))
+_ORG_DOMAIN = os.getenv("ORG_DOMAIN")
+
+DEFAULTS = {
+    "spam_threshold": _RISK_THRESHOLD,
+    "phishing_threshold": _RISK_THRESHOLD - 10,
+    "malicious_threshold": _RISK_THRESHOLD - 10,
+    "internal_domains": [_ORG_DOMAIN] if _ORG_DOMAIN else [],
+    # Internal senders are never auto-quarantined unless this is set
+    "quarantine_internal": False,
+    "allow_senders": [],
+    "allow_domains": [],
+    "deny_senders": [],
+    "deny_domains": [],
+    # Fixed poll interval in seconds (e.g. for VIPs); None = adaptive
+    "poll_interval": None,
+}
+_LIST_KEYS = ("internal_domains", "allow_senders", "allow_domains", "deny_senders", "deny_domains")
+
+logger = get_logger(__name__)
+
+
+class DomainTrie:
+    """
+    Domains stored by reversed labels ("mail.evil.com" -> com, evil, mail),
+    so a lookup walks the sender's labels once and matches any listed parent.
+    """
+
+    __slots__ = ("root",)
+    _END = ""
+
+    def __init__(self, domains=()):
+        self.root = {}
+        for d in domains:
+            self.add(d)
+
+    def add(self, domain: str):
+        node = self.root
+        for label in reversed(domain.strip().lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        node[self._END] = domain.strip().lower()
+
+    def match(self, domain: str) -> str | None:
+        """The listed domain covering `domain`, if any."""
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return None
+            if self._END in node:
+                return node[self._END]
+        return None
+
+    def __bool__(self):
+        return bool(self.root)
+
+
+class CompiledPolicy:
+    """Effective policy for one mailbox, with lists turned into sets and tries."""
+
+    __slots__ = (
+        "name", "thresholds", "quarantine_internal", "internal",
+        "allow_senders", "allow_domains", "deny_senders", "deny_domains", "poll_interval",
+    )
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.thresholds = {
+            "spam": int(settings["spam_threshold"]),
+            "phishing": int(settings["phishing_threshold"]),
+            "malicious": int(settings["malicious_threshold"]),
+        }
+        self.quarantine_internal = bool(settings["quarantine_internal"])
+        self.internal = DomainTrie(settings["internal_domains"])
+        self.allow_senders = frozenset(s.lower() for s in settings["allow_senders"])
+        self.allow_domains = DomainTrie(settings["allow_domains"])
+        self.deny_senders = frozenset(s.lower() for s in settings["deny_senders"])
+        self.deny_domains = DomainTrie(settings["deny_domains"])
+        poll_interval = settings["poll_interval"]
+        self.poll_interval = float(poll_interval) if poll_interval else None
+
+    def check_sender(self, sender: str) -> tuple[str | None, str | None]:
+        """
+        Allow/deny lists, checked before the LLM.
+        Returns ("allow" | "deny" | None, the entry that matched).
+        """
+        sender = (sender or "").lower()
+        domain = sender.rpartition("@")[2]
+        if sender in self.deny_senders:
+            return "deny", f"sender {sender}"
+        hit = self.deny_domains.match(domain) if domain else None
+        if hit:
+            return "deny", f"domain {hit}"
+        if sender in self.allow_senders:
+            return "allow", f"sender {sender}"
+        hit = self.allow_domains.match(domain) if domain else None
+        if hit:
+            return "allow", f"domain {hit}"
+        return None, None
+
+    def is_external(self, sender: str) -> bool:
+        # No internal domains configured: treat everything as external
+        if not self.internal:
+            return True
+        return self.internal.match((sender or "").lower().rpartition("@")[2]) is None
+
+    def decide(self, classification: str, risk: int, is_external: bool) -> tuple[bool, str]:
+        """Quarantine decision for an LLM verdict. Returns (quarantine, rule)."""
+        if classification == "safe":
+            return False, "classification=safe"
+        threshold = self.thresholds.get(classification)
+        if threshold is None:
+            return False, "unknown classification"
+        rule = f"{classification} & risk>={threshold}"
+        if not is_external and not self.quarantine_internal:
+            return False, rule
+        return risk >= threshold, rule
+
+
+def _merge(base: dict, override: dict) -> dict:
+    merged = dict(base)
+    for key, value in override.items():
+        if key == "members":
+            continue
+        if key in _LIST_KEYS:
+            merged[key] = list(merged.get(key, [])) + list(value)
+        elif key in DEFAULTS:
+            merged[key] = value
+        else:
+            logger.warning("ignoring unknown policy setting", extra={"setting": key})
+    return merged
+
+
+class PolicySet:
+    """All mailboxes' compiled policies; unknown mailboxes get the defaults."""
+
+    def __init__(self, config: dict):
+        defaults = _merge(DEFAULTS, config.get("defaults", {}))
+        self.default = CompiledPolicy("default", defaults)
+
+        groups = config.get("groups", {})
+        mailboxes = {m.lower(): s for m, s in config.get("mailboxes", {}).items()}
+        members = {}
+        for group in groups.values():
+            for m in group.get("members", []):
+                members.setdefault(m.lower(), []).append(group)
+
+        self.by_mailbox = {}
+        for mailbox in set(members) | set(mailboxes):
+            settings = defaults
+            for group in members.get(mailbox, []):
+                settings = _merge(settings, group)
+            settings = _merge(settings, mailboxes.get(mailbox, {}))
+            self.by_mailbox[mailbox] = CompiledPolicy(mailbox, settings)
+
+    def for_mailbox(self, mailbox: str) -> CompiledPolicy:
+        return self.by_mailbox.get((mailbox or "").lower(), self.default)
+
+    def pinned_intervals(self, mailboxes: list[str]) -> dict:
+        """mailbox -> fixed poll interval, for mailboxes whose policy sets one."""
+        pinned = {}
+        for mailbox in mailboxes:
+            interval = self.for_mailbox(mailbox).poll_interval
+            if interval:
+                pinned[mailbox] = interval
+        return pinned
+
+
+def load_policy(path: str = POLICY_FILE) -> PolicySet:
+    if not path:
+        return PolicySet({})
+    with open(path) as f:
+        return PolicySet(json.load(f))
+
+
+_lock = threading.Lock()
+_current = None
+_mtime = None
+_checked_at = 0.0
+
+
+def get_policy() -> PolicySet:
+    """
+    Current PolicySet, recompiled when POLICY_FILE changes on disk (checked
+    every POLICY_RELOAD_INTERVAL). A broken or missing file keeps the
+    previous policy.
+    """
+    global _current, _mtime, _checked_at
+    now = time.monotonic()
+    if _current is not None and now - _checked_at < POLICY_RELOAD_INTERVAL:
+        return _current
+
+    with _lock:
+        _checked_at = now
+        mtime = None
+        if POLICY_FILE:
+            try:
+                mtime = os.stat(POLICY_FILE).st_mtime_ns
+            except OSError:
+                if _current is not None:
+                    # Deleted or mid-replace: don't silently drop to the defaults
+                    if _mtime is not None:
+                        logger.warning("policy file missing; keeping previous policy", extra={"path": POLICY_FILE})
+                        # Reload once the file is back, whatever its mtime
+                        _mtime = None
+                    return _current
+                logger.warning("policy file missing", extra={"path": POLICY_FILE})
+        if _current is None or mtime != _mtime:
+            # Remember the mtime even on failure so a broken file is retried only once it changes
+            _mtime = mtime
+            try:
+                _current = load_policy(POLICY_FILE if mtime is not None else "")
+                logger.info(
+                    "policy loaded",
+                    extra={"path": POLICY_FILE or None, "mailboxes": len(_current.by_mailbox)},
+                )
+            except Exception:
+                logger.exception("policy reload failed; keeping previous policy")
+                if _current is None:
+                    _current = PolicySet({})
+    return _current
@@ -1,34 +1,128 @@
 import asyncio
 import os
+import time
 
 from dotenv import load_dotenv
 
 from services.graph_client import (
+    DELTA_BODY_MODE,
     get_delta_messages,
+    get_message_bodies,
     move_message,
     get_all_mail_users,
 )
 from services.db import init_db, log_quarantine_event
 from services.folders import ensure_quarantine_folder
 from services.llama_classifier import classify_with_llama
+from services.llm_limiter import limiter as llm_limiter
+from services.attachments import ATTACHMENT_INSPECTION_ENABLED, inspect_message_attachments
+from services import dedupe, evidence, policy, reputation, triage
 from services.logging_utils import get_logger
+from services.onboarding import (
+    initial_sync_cutoff,
+    record_onboarding,
+    run_backfill,
+)
+from services import retention, scheduler, sharding
+from services.metrics import Counter, Gauge, Histogram, start_metrics_server
+from services.tracing import MessageTrace
 
 load_dotenv()
 
 # Configurable knobs
-RISK_THRESHOLD = int(os.getenv("RISK_THRESHOLD", "60"))
-# If set, we'll treat messages from *@ORG_DOMAIN as internal (not auto-quarantined)
-ORG_DOMAIN = os.getenv("ORG_DOMAIN")  # e.g. "yourcompany.com"
-# Concurrency limit for processing messages per user
-MAX_CONCURRENT_MSGS = 5
+# Quarantine thresholds and internal domains (RISK_THRESHOLD, ORG_DOMAIN) are
+# read by services/policy.py, optionally overridden per mailbox by POLICY_FILE.
+# Messages of one mailbox processed at once (Graph calls, attachment checks).
+# LLM requests across all mailboxes are bounded by services/llm_limiter.py.
+MAX_CONCURRENT_MSGS = int(os.getenv("MAX_CONCURRENT_MSGS", "16"))
+# Mailboxes polled at the same time when several are due
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "4"))
+# Seconds between mailbox discovery / lease rebalancing (and backfill runs).
+# Per-mailbox poll intervals are adaptive, see services/scheduler.py.
+POLL_DISCOVERY_INTERVAL = float(os.getenv("POLL_DISCOVERY_INTERVAL", "60"))
+# Local Prometheus endpoint (http://127.0.0.1:9108/metrics); 0 disables it.
+# Give each sharded worker on a host its own port.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
 
 logger = get_logger(__name__)
 
-async def process_single_message(user_email: str, m: dict, quarantine_folder_id: str, semaphore: asyncio.Semaphore):
+DELTA_FETCH_SECONDS = Histogram(
+    "poller_delta_fetch_seconds", "Graph delta query time per mailbox", ("mailbox",)
+)
+ATTACHMENT_SECONDS = Histogram(
+    "poller_attachment_seconds", "Attachment listing and inspection per message with attachments", ("mailbox",)
+)
+BODY_FETCH_SECONDS = Histogram(
+    "poller_body_fetch_seconds", "Batched text body fetch per delta page (DELTA_BODY_MODE=lazy)", ("mailbox",)
+)
+LAZY_BODIES = Counter(
+    "poller_lazy_bodies_total",
+    "Lazy body outcomes: fetched, failed, or skipped because of policy, triage, internal, reputation",
+    ("mailbox", "result"),
+)
+TRIAGE_SECONDS = Histogram(
+    "poller_triage_seconds", "Local model batch scoring per delta page", ("mailbox",)
+)
+LLM_ROUND_TRIP_SECONDS = Histogram(
+    "poller_llm_round_trip_seconds", "URL analysis plus LLM classification per message", ("mailbox",)
+)
+GRAPH_MOVE_SECONDS = Histogram(
+    "poller_graph_move_seconds", "Graph move to AI-Quarantine", ("mailbox",)
+)
+DB_WRITE_SECONDS = Histogram(
+    "poller_db_write_seconds", "SQLite quarantine_events insert", ("mailbox",)
+)
+MESSAGE_SECONDS = Histogram(
+    "poller_message_seconds", "End-to-end processing time per message", ("mailbox",)
+)
+DETECTION_SECONDS = Histogram(
+    "poller_detection_latency_seconds",
+    "receivedDateTime to processed, per mailbox (new mail only)",
+    ("mailbox",),
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+MESSAGES_TOTAL = Counter(
+    "poller_messages_total",
+    "Processed messages by verdict and decision rule",
+    ("mailbox", "classification", "rule", "moved"),
+)
+MESSAGE_ERRORS = Counter(
+    "poller_message_errors_total", "Messages that failed processing", ("mailbox",)
+)
+QUEUE_DEPTH = Gauge(
+    "poller_queue_depth", "Messages waiting for a processing slot", ("mailbox",)
+)
+IN_FLIGHT = Gauge(
+    "poller_in_flight", "Messages currently being processed", ("mailbox",)
+)
+
+async def process_single_message(
+    user_email: str,
+    m: dict,
+    quarantine_folder_id: str,
+    semaphore: asyncio.Semaphore,
+    trace: MessageTrace | None = None,
+    first_tier: dict | None = None,
+    fingerprint: str | None = None,
+    assessment: dict | None = None,
+):
     """
     Process a single message with concurrency control.
+    trace carries span timings from the delta fetch; one is started here if omitted.
+    first_tier is the local model's confident verdict (see score_page), if any.
+    fingerprint (services/dedupe.py) marks the message processed once logged.
+    assessment is the sender's reputation.assess() result if load_bodies already made it.
     """
+    if trace is None:
+        trace = MessageTrace(m.get("receivedDateTime"))
+
+    QUEUE_DEPTH.inc(mailbox=user_email)
     async with semaphore:
+        QUEUE_DEPTH.dec(mailbox=user_email)
+        IN_FLIGHT.inc(mailbox=user_email)
+        trace.mark("started")
+        started = time.perf_counter()
         try:
             subject = m.get("subject")
             logger.info(
@@ -40,52 +134,104 @@ async def process_single_message(user_email: str, m: dict, quarantine_folder_id:
                 },
             )
 
-            # Classify with local Llama
-            score = await classify_with_llama(m)
-            risk = score.get("risk_score", 0) or 0
-            classification = (score.get("classification") or "unknown").lower()
-
-            # Normalize classification
-            if classification not in {"safe", "spam", "phishing", "malicious"}:
-                classification = "spam"  # fail-closed-ish but not too harsh
+            # Attachment metadata (and content, for containers) only when there are any
+            attachments = None
+            if ATTACHMENT_INSPECTION_ENABLED and m.get("hasAttachments"):
+                with ATTACHMENT_SECONDS.time(mailbox=user_email):
+                    attachments = await inspect_message_attachments(user_email, m)
 
-            # Determine if sender is external
             from_addr = (
                 (m.get("from", {}) or {})
                 .get("emailAddress", {})
                 .get("address", "")
             )
-            if ORG_DOMAIN:
-                is_external = not from_addr.lower().endswith(ORG_DOMAIN.lower())
+
+            # Per-mailbox policy (compiled; hot-reloaded when POLICY_FILE changes)
+            mailbox_policy = policy.get_policy().for_mailbox(user_email)
+            policy_action, policy_match = mailbox_policy.check_sender(from_addr)
+
+            # Sender / domain history from the reputation store (cached)
+            rep = {}
+            if reputation.REPUTATION_ENABLED and not policy_action:
+                rep = assessment if assessment is not None else reputation.assess(from_addr)
+            rep_decision = rep.get("decision")
+            if rep_decision == "skip" and attachments and attachments["warnings"]:
+                rep_decision = None
+
+            if policy_action == "deny":
+                # Blocked sender: quarantine without inference
+                score = {
+                    "risk_score": 100,
+                    "classification": "spam",
+                    "reasons": [f"Blocked by policy ({policy_match})"],
+                    "source": "policy",
+                }
+            elif policy_action == "allow":
+                score = {
+                    "risk_score": 0,
+                    "classification": "safe",
+                    "reasons": [f"Allowed by policy ({policy_match})"],
+                    "source": "policy",
+                }
+            elif rep_decision == "skip":
+                # Long-standing clean sender: no inference needed
+                score = {
+                    "risk_score": 0,
+                    "classification": "safe",
+                    "reasons": [f"Trusted by reputation: {rep['summary']}"],
+                    "source": "reputation",
+                }
+            elif first_tier and not (attachments and attachments["warnings"]):
+                # Confident local model verdict: no inference needed
+                score = first_tier
             else:
-                # If ORG_DOMAIN not set, treat everything as external for now
-                is_external = True
+                # Classify with local Llama
+                # Shared adaptive limit on LLM requests in flight
+                async with llm_limiter.slot():
+                    with LLM_ROUND_TRIP_SECONDS.time(mailbox=user_email):
+                        score = await classify_with_llama(m, attachments, rep.get("summary"))
+            trace.mark("classified")
+            risk = score.get("risk_score", 0) or 0
+            classification = (score.get("classification") or "unknown").lower()
+
+            # Normalize classification
+            if classification not in {"safe", "spam", "phishing", "malicious"}:
+                classification = "spam"  # fail-closed-ish but not too harsh
+
+            # Internal senders (policy internal_domains, incl. subdomains) are left alone
+            is_external = mailbox_policy.is_external(from_addr)
 
             # NEW: decision logic
             moved = False
-            quarantine_reason = None
+            evidence_hash = None
 
-            # We never quarantine "safe" emails, regardless of risk_score
-            if classification == "safe":
+            if policy_action:
+                # Explicit deny applies to internal senders too
+                quarantine = policy_action == "deny"
+                quarantine_reason = f"policy {policy_action}"
+            elif classification == "safe":
+                # We never quarantine "safe" emails, regardless of risk_score
                 quarantine = False
-                quarantine_reason = "classification=safe"
+                quarantine_reason = {"reputation": "reputation skip", "triage": "local model"}.get(
+                    score.get("source"), "classification=safe"
+                )
+            elif rep_decision == "escalate":
+                # Sender or domain with a mostly-bad recent history
+                quarantine = is_external
+                quarantine_reason = f"{classification} & reputation escalate"
+                # Reputation made this call; keep it out of reputation and training
+                score = {**score, "source": "reputation"}
             else:
-                # For spam: use threshold
-                if classification == "spam":
-                    quarantine = is_external and risk >= RISK_THRESHOLD
-                    quarantine_reason = f"spam & risk>={RISK_THRESHOLD}"
-                # For phishing/malicious: more aggressive
-                elif classification in {"phishing", "malicious"}:
-                    # Even if risk is low, treat as dangerous
-                    quarantine = is_external and (risk >= (RISK_THRESHOLD - 10))
-                    quarantine_reason = f"{classification} & risk>={RISK_THRESHOLD - 10}"
-                else:
-                    quarantine = False
-                    quarantine_reason = "unknown classification"
+                # Per-mailbox thresholds; phishing/malicious default 10 points lower
+                quarantine, quarantine_reason = mailbox_policy.decide(classification, risk, is_external)
 
             if quarantine:
-                await move_message(user_email, m["id"], quarantine_folder_id)
+                with GRAPH_MOVE_SECONDS.time(mailbox=user_email):
+                    await move_message(user_email, m["id"], quarantine_folder_id)
                 moved = True
+                trace.mark("moved")
+                # Text snapshot for the dashboard preview, shared across a campaign's recipients
+                evidence_hash = await asyncio.to_thread(evidence.save_message, m)
                 logger.warning(
                     "moved message to AI-Quarantine",
                     extra={
@@ -111,47 +257,279 @@ async def process_single_message(user_email: str, m: dict, quarantine_folder_id:
                 )
 
             # Log decision in SQLite, tagged with this mailbox
-            log_quarantine_event(user_email, m, score, moved)
+            trace.mark("logged")
+            with DB_WRITE_SECONDS.time(mailbox=user_email):
+                log_quarantine_event(
+                    user_email, m, score, moved, trace=trace.to_record(),
+                    fingerprint=fingerprint, evidence_hash=evidence_hash,
+                )
+
+            MESSAGES_TOTAL.inc(
+                mailbox=user_email,
+                classification=classification,
+                rule=quarantine_reason,
+                moved=str(moved).lower(),
+            )
+            MESSAGE_SECONDS.observe(time.perf_counter() - started, mailbox=user_email)
+            detection_ms = trace.detection_ms()
+            if detection_ms is not None:
+                DETECTION_SECONDS.observe(detection_ms / 1000, mailbox=user_email)
 
         except Exception:
+            MESSAGE_ERRORS.inc(mailbox=user_email)
             logger.exception(
                 "error processing message",
                 extra={"user_email": user_email, "message_id": m.get("id")},
             )
+        finally:
+            IN_FLIGHT.dec(mailbox=user_email)
+
+
+def score_page(user_email: str, messages: list) -> list:
+    """Local model verdicts for a page of messages, scored as one batch."""
+    if not triage.TRIAGE_ENABLED:
+        return [None] * len(messages)
+    with TRIAGE_SECONDS.time(mailbox=user_email):
+        return triage.predict_messages(messages)
+
+
+def _body_not_needed(mailbox_policy, m: dict, first_tier: dict | None, assessed: dict) -> str | None:
+    """
+    Why a message can be decided without its full body (None = fetch it).
+    A reputation assessment made here is stored in assessed[message id].
+    """
+    sender = ((m.get("from") or {}).get("emailAddress") or {}).get("address", "")
+    if mailbox_policy.check_sender(sender)[0]:
+        return "policy"
+    # The internal-sender rule never quarantines, whatever the verdict
+    if not mailbox_policy.quarantine_internal and not mailbox_policy.is_external(sender):
+        return "internal"
+    # Attachment warnings override the shortcuts below, so keep those messages whole
+    if m.get("hasAttachments"):
+        return None
+    if first_tier:
+        return "triage"
+    if reputation.REPUTATION_ENABLED:
+        assessed[m["id"]] = reputation.assess(sender)
+        if assessed[m["id"]].get("decision") == "skip":
+            return "reputation"
+    return None
+
+
+async def load_bodies(user_email: str, messages: list, first_tier: list) -> dict:
+    """
+    DELTA_BODY_MODE=lazy: add plain-text bodies, fetched with $batch, to the
+    messages that go on to URL analysis and the LLM. The rest keep only
+    their bodyPreview. Returns the reputation assessments made on the way,
+    by message id, so process_single_message doesn't repeat them.
+    """
+    assessed = {}
+    if DELTA_BODY_MODE != "lazy":
+        return assessed
+    mailbox_policy = policy.get_policy().for_mailbox(user_email)
+    wanted = []
+    for m, verdict in zip(messages, first_tier):
+        # Delta links created in full mode still carry the body
+        if "body" in m:
+            continue
+        reason = _body_not_needed(mailbox_policy, m, verdict, assessed)
+        if reason:
+            LAZY_BODIES.inc(mailbox=user_email, result=reason)
+        else:
+            wanted.append(m)
+    if not wanted:
+        return assessed
+
+    started = time.perf_counter()
+    with BODY_FETCH_SECONDS.time(mailbox=user_email):
+        bodies = await get_message_bodies(user_email, [m["id"] for m in wanted])
+    for m in wanted:
+        body = bodies.get(m["id"])
+        if body:
+            m["body"] = body
+        # A failed fetch falls back to bodyPreview
+        LAZY_BODIES.inc(mailbox=user_email, result="fetched" if body else "failed")
+    logger.info(
+        "fetched message bodies",
+        extra={
+            "user_email": user_email,
+            "fetched": len(bodies),
+            "skipped": len(messages) - len(wanted),
+            "body_bytes": sum(len(b.get("content") or "") for b in bodies.values()),
+            "seconds": round(time.perf_counter() - started, 3),
+        },
+    )
+    return assessed
 
 
-async def process_user(user_id_or_email: str):
+async def process_user(user_id_or_email: str) -> int | None:
     """
     Process new/changed messages for a single mailbox.
 
     user_id_or_email is used both as:
       - the identifier for Graph (/users/{user_id_or_email}/...)
       - the user_email stored in the DB
+
+    Returns the number of messages the delta returned (None if skipped).
     """
     user_email = user_id_or_email
 
-    messages = await get_delta_messages(user_id_or_email)
+    # Another worker may have taken the mailbox over since the cycle started
+    if not sharding.still_owned(user_email):
+        logger.info("mailbox lease lost - skipping", extra={"user_email": user_email})
+        return None
+
+    # First sync of a new mailbox: bound it to the onboarding window
+    cutoff = initial_sync_cutoff(user_id_or_email)
+    with DELTA_FETCH_SECONDS.time(mailbox=user_email):
+        messages = await get_delta_messages(user_id_or_email, received_after=cutoff)
+    fetched_at = time.time()
     logger.info(
         "delta returned %d messages",
         len(messages),
         extra={"user_email": user_email},
     )
+    if cutoff:
+        record_onboarding(user_id_or_email, cutoff, len(messages))
 
-    if not messages:
-        return
+    # Drop re-entries of messages already classified (flag changes, releases)
+    fresh = dedupe.filter_new(user_email, messages) if messages else []
+    if not fresh:
+        return 0
+    messages = [m for m, _ in fresh]
 
     # Ensure / cache quarantine folder for this mailbox
     quarantine_folder_id = await ensure_quarantine_folder(user_id_or_email)
 
-    # Limit concurrent processing to avoid overwhelming LLM or Graph
+    # Limit concurrent processing per mailbox to avoid overwhelming Graph
     semaphore = asyncio.Semaphore(MAX_CONCURRENT_MSGS)
-    
+    first_tier = score_page(user_email, messages)
+    assessed = await load_bodies(user_email, messages, first_tier)
+
     tasks = [
-        process_single_message(user_email, m, quarantine_folder_id, semaphore)
-        for m in messages
+        process_single_message(
+            user_email,
+            m,
+            quarantine_folder_id,
+            semaphore,
+            trace=MessageTrace(m.get("receivedDateTime"), fetched_at),
+            first_tier=verdict,
+            fingerprint=fp,
+            assessment=assessed.get(m["id"]),
+        )
+        for (m, fp), verdict in zip(fresh, first_tier)
     ]
-    
+
     await asyncio.gather(*tasks)
+    return len(messages)
+
+
+async def process_backfill_page(user_email: str, messages: list):
+    """
+    Classify a page of pre-onboarding mail.
+    Runs one message at a time so backfill never competes with live traffic.
+    """
+    fresh = dedupe.filter_new(user_email, messages) if messages else []
+    if not fresh:
+        return
+    quarantine_folder_id = await ensure_quarantine_folder(user_email)
+    semaphore = asyncio.Semaphore(1)
+    first_tier = score_page(user_email, [m for m, _ in fresh])
+    assessed = await load_bodies(user_email, [m for m, _ in fresh], first_tier)
+    for (m, fp), verdict in zip(fresh, first_tier):
+        # Old mail: only processing time is meaningful, not detection latency
+        trace = MessageTrace(None)
+        await process_single_message(
+            user_email,
+            m,
+            quarantine_folder_id,
+            semaphore,
+            trace=trace,
+            first_tier=verdict,
+            fingerprint=fp,
+            assessment=assessed.get(m["id"]),
+        )
+
+
+async def discover_mailboxes(busy=frozenset()) -> list[str]:
+    """
+    Mail-enabled users, narrowed to the ones leased to this worker when
+    sharding. Leases on `busy` mailboxes (polls in flight) are kept.
+    """
+    all_users = await get_all_mail_users()
+    user_emails = [u["mail"] for u in all_users if u.get("mail")]
+
+    logger.info("discovered %d mail-enabled users", len(user_emails))
+
+    # With sharding, only the mailboxes leased to this worker
+    return sharding.claim_mailboxes(user_emails, busy)
+
+
+async def run_cycle():
+    """One polling pass over every mailbox this worker owns (ignores the schedule)."""
+    user_emails = await discover_mailboxes()
+
+    for user_email in user_emails:
+        await process_user(user_email)
+
+    # Low-priority classification of older mail for new mailboxes
+    await run_backfill(process_backfill_page, mailboxes=user_emails)
+
+
+async def poll_mailbox(schedule: scheduler.MailboxScheduler, user_email: str, semaphore: asyncio.Semaphore):
+    """Poll one due mailbox, then let the scheduler pick its next poll time."""
+    async with semaphore:
+        new_messages = None
+        try:
+            new_messages = await process_user(user_email)
+        except Exception:
+            logger.exception("mailbox poll failed", extra={"user_email": user_email})
+        finally:
+            schedule.record(user_email, new_messages)
+
+
+async def run_scheduled(schedule: scheduler.MailboxScheduler):
+    """
+    Poll each owned mailbox when its adaptive interval is up, rediscovering
+    mailboxes (and running backfill) every POLL_DISCOVERY_INTERVAL seconds.
+    """
+    semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+    in_flight = set()
+    user_emails = []
+    next_discovery = 0.0
+    backfill_due = False
+
+    while True:
+        now = time.monotonic()
+        if now >= next_discovery:
+            next_discovery = now + POLL_DISCOVERY_INTERVAL
+            try:
+                user_emails = await discover_mailboxes(busy=schedule.polling)
+                schedule.sync(user_emails, policy.get_policy().pinned_intervals(user_emails))
+                logger.info("poll schedule", extra={**schedule.summary(), **llm_limiter.stats()})
+                backfill_due = True
+                await dedupe.maybe_prune()
+            except Exception:
+                logger.exception("mailbox discovery failed")
+
+        # Backfill once per discovery period, between live polls
+        if backfill_due and not in_flight:
+            backfill_due = False
+            try:
+                await run_backfill(process_backfill_page, mailboxes=user_emails)
+            except Exception:
+                logger.exception("backfill error")
+
+        for user_email in schedule.pop_due():
+            task = asyncio.create_task(poll_mailbox(schedule, user_email, semaphore))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        wait = next_discovery - time.monotonic()
+        due_in = schedule.next_due_in()
+        if due_in is not None:
+            wait = min(wait, due_in)
+        await asyncio.sleep(max(wait, 0.05))
 
 
 async def main():
@@ -159,23 +537,27 @@ async def main():
     init_db()
     logger.info("AI Email Poller started - using delta-based polling")
 
-    while True:
-        try:
-            # Discover all mail-enabled users each cycle.
-            # For larger tenants, you can cache this and refresh periodically.
-            all_users = await get_all_mail_users()
-            user_emails = [u["mail"] for u in all_users if u.get("mail")]
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_ADDR)
+        logger.info("metrics endpoint listening", extra={"port": METRICS_PORT})
 
-            logger.info("discovered %d mail-enabled users", len(user_emails))
+    lease_task = None
+    if sharding.SHARDING_ENABLED:
+        logger.info("sharding enabled", extra={"worker_id": sharding.WORKER_ID})
+        lease_task = asyncio.create_task(sharding.keep_leases_alive())
 
-            for user_email in user_emails:
-                await process_user(user_email)
-
-        except Exception:
-            logger.exception("poller loop error")
+    retention_task = None
+    if retention.RETENTION_ENABLED:
+        retention_task = asyncio.create_task(retention.run_retention_forever())
 
-        # Sleep between polling cycles
-        await asyncio.sleep(60)
+    try:
+        await run_scheduled(scheduler.MailboxScheduler())
+    finally:
+        if lease_task:
+            lease_task.cancel()
+        if retention_task:
+            retention_task.cancel()
+        sharding.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import asyncio
+from collections import defaultdict
+
+from services.db import set_release_state
+from services.folders import ensure_quarantine_folder
+from services.graph_client import get_inbox_folder_id, move_messages
+from services.logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+
+async def _move_events(events: list[dict], destination) -> dict:
+    """
+    Move each event's message in its own mailbox, batched per mailbox.
+    destination is an async callable user_email -> folder ID.
+    Returns {event_id: new message id or None if the move failed}.
+    """
+    by_user = defaultdict(list)
+    for e in events:
+        by_user[e["user_email"]].append(e)
+
+    async def move_for_user(user_email: str, user_events: list[dict]) -> dict:
+        try:
+            folder_id = await destination(user_email)
+            moved = await move_messages(
+                user_email,
+                [e["message_id"] for e in user_events],
+                folder_id,
+            )
+        except Exception:
+            logger.exception("bulk move failed", extra={"user_email": user_email})
+            return {e["id"]: None for e in user_events}
+        return {e["id"]: moved.get(e["message_id"]) for e in user_events}
+
+    results = {}
+    for outcome in await asyncio.gather(
+        *(move_for_user(user, user_events) for user, user_events in by_user.items())
+    ):
+        results.update(outcome)
+    return results
+
+
+def _summarize(action: str, events: list[dict], results: dict) -> dict:
+    done = {event_id: new_id for event_id, new_id in results.items() if new_id}
+    failed = sorted(event_id for event_id, new_id in results.items() if not new_id)
+    if done:
+        set_release_state(done, released=(action == "release"))
+    logger.info(
+        "bulk action finished",
+        extra={"action": action, "requested": len(events), "moved": len(done), "failed": len(failed)},
+    )
+    return {"action": action, "requested": len(events), "moved": len(done), "failed": failed}
+
+
+async def release_events(events: list[dict]) -> dict:
+    """Move quarantined messages back to each owner's Inbox and mark them released."""
+    results = await _move_events(events, get_inbox_folder_id)
+    return _summarize("release", events, results)
+
+
+async def requarantine_events(events: list[dict]) -> dict:
+    """Move released messages back to each owner's AI-Quarantine folder."""
+    results = await _move_events(events, ensure_quarantine_folder)
+    return _summarize("requarantine", events, results)
@@ -0,0 +1,160 @@
+"""
+Sender and domain reputation as a fast-path signal.
+
+sender_reputation is maintained by services/db.py on every logged message
+and every admin release / re-quarantine. This module keeps a TTL'd LRU in
+front of it for per-message lookups and turns a record into a decision:
+
+- "skip": a long-standing sender with a clean record; the LLM call is skipped.
+- "escalate": a sender or domain whose recent mail is mostly bad; any
+  non-safe verdict is quarantined regardless of RISK_THRESHOLD.
+
+Usage:
+    python -m services.reputation --rebuild
+    python -m services.reputation --show someone@example.com
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from services.db import get_reputation, init_db, rebuild_reputation
+from services.metrics import Counter
+
+REPUTATION_ENABLED = os.getenv("REPUTATION_ENABLED", "true").lower() == "true"
+REPUTATION_CACHE_SIZE = int(os.getenv("REPUTATION_CACHE_SIZE", "50000"))
+REPUTATION_CACHE_TTL = float(os.getenv("REPUTATION_CACHE_TTL", "300"))
+# Skip the LLM for senders with at least this many messages and a clean record.
+# Off by default: the From address is not authenticated here, so a spoofed
+# trusted sender would also be skipped.
+REPUTATION_SKIP_ENABLED = os.getenv("REPUTATION_SKIP_ENABLED", "false").lower() == "true"
+REPUTATION_SKIP_MIN_MESSAGES = int(os.getenv("REPUTATION_SKIP_MIN_MESSAGES", "50"))
+# Escalate when this share of a sender's / domain's decayed history is bad
+REPUTATION_ESCALATE_RATIO = float(os.getenv("REPUTATION_ESCALATE_RATIO", "0.8"))
+REPUTATION_ESCALATE_MIN_SCORE = float(os.getenv("REPUTATION_ESCALATE_MIN_SCORE", "3"))
+
+REPUTATION_LOOKUPS = Counter(
+    "reputation_lookups_total", "Reputation lookups by cache result (hit, miss).", ("result",)
+)
+REPUTATION_DECISIONS = Counter(
+    "reputation_decisions_total", "Reputation fast-path decisions (skip, escalate, none).", ("decision",)
+)
+
+
+class _TTLCache:
+    """LRU with a per-entry TTL; thread-safe since lookups can come from worker threads."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_cache = _TTLCache(REPUTATION_CACHE_SIZE, REPUTATION_CACHE_TTL)
+
+
+def lookup(sender: str) -> dict:
+    """{"sender": record | None, "domain": record | None}, cached."""
+    key = (sender or "").strip().lower()
+    cached = _cache.get(key)
+    if cached is not None:
+        REPUTATION_LOOKUPS.inc(result="hit")
+        return cached
+    REPUTATION_LOOKUPS.inc(result="miss")
+    record = get_reputation(key)
+    _cache.put(key, record)
+    return record
+
+
+def _bad_ratio(record: dict | None) -> float:
+    if not record:
+        return 0.0
+    total = record["bad_score"] + record["good_score"]
+    return record["bad_score"] / total if total else 0.0
+
+
+def _describe(label: str, record: dict | None) -> str | None:
+    if not record:
+        return None
+    return (
+        f"{label} {record['key']} seen {record['total']} times since {(record['first_seen'] or '?')[:10]}: "
+        f"{record['quarantined']} quarantined, {record['phishing'] + record['malicious']} phishing/malicious, "
+        f"{record['released']} released as false positives"
+    )
+
+
+def assess(sender: str) -> dict:
+    """
+    Reputation decision for a sender address.
+    Returns {"decision": "skip" | "escalate" | None, "summary": str | None,
+    "sender": record, "domain": record}.
+    """
+    record = lookup(sender)
+    s, d = record["sender"], record["domain"]
+    decision = None
+
+    for r in (s, d):
+        if r and r["bad_score"] >= REPUTATION_ESCALATE_MIN_SCORE and _bad_ratio(r) >= REPUTATION_ESCALATE_RATIO:
+            decision = "escalate"
+            break
+    else:
+        if (
+            REPUTATION_SKIP_ENABLED
+            and s
+            and s["total"] >= REPUTATION_SKIP_MIN_MESSAGES
+            # Never quarantined, or every quarantine was released by an admin
+            and s["quarantined"] <= s["released"]
+            and s["phishing"] + s["malicious"] == 0
+            and _bad_ratio(d) < 0.5
+        ):
+            decision = "skip"
+
+    REPUTATION_DECISIONS.inc(decision=decision or "none")
+    summary = "; ".join(x for x in (_describe("Sender", s), _describe("Domain", d)) if x) or None
+    return {"decision": decision, "summary": summary, "sender": s, "domain": d}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--rebuild", action="store_true", help="recompute reputation from quarantine_events")
+    group.add_argument("--show", metavar="SENDER", help="print a sender's reputation and decision")
+    args = parser.parse_args()
+
+    init_db()
+    if args.rebuild:
+        started = time.perf_counter()
+        replayed = rebuild_reputation()
+        print(f"replayed {replayed} events in {time.perf_counter() - started:.1f}s")
+    else:
+        print(json.dumps(assess(args.show), indent=2))
+
+
+if __name__ == "__main__":
+    main()
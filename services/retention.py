@@ -0,0 +1,242 @@
+"""
+Retention for quarantine_events.
+
+Events older than their classification's retention period are moved into
+monthly archive databases (data/archive/quarantine-YYYY-MM.db, keyed by
+created_at) with the full row stored as zlib-compressed JSON, and counted
+into daily_stats so dashboard totals survive. Freed pages are then handed
+back with short incremental_vacuum steps instead of one long VACUUM.
+Evidence snapshots (services/evidence.py) no live event references are
+deleted at the end of each run.
+
+Usage:
+    python -m services.retention run
+    python -m services.retention query --sender someone@example.com --from 2025-01 --to 2025-03
+    python -m services.retention vacuum [--full]
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime, timedelta
+
+from services import db, evidence
+from services.logging_utils import get_logger
+
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "false").lower() == "true"
+# Days to keep each classification in the live database; "default" covers the
+# rest. 0 keeps that classification forever.
+RETENTION_DAYS = os.getenv(
+    "RETENTION_DAYS", "safe=30,spam=90,phishing=365,malicious=365,default=180"
+)
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+# Rows per write transaction; keeps each lock on the live file short
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# Pages freed per incremental_vacuum step (4 KiB each by default)
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(db.DB_DIR, "archive")
+
+# Columns kept uncompressed in the archive so queries can filter on them
+_INDEXED_COLUMNS = ("id", "created_at", "user_email", "sender", "classification", "moved", "released")
+
+logger = get_logger(__name__)
+
+
+def parse_retention_days(spec: str) -> dict:
+    days = {}
+    for item in spec.split(","):
+        name, sep, value = item.strip().partition("=")
+        if not sep:
+            continue
+        try:
+            days[name.strip().lower()] = int(value)
+        except ValueError:
+            logger.warning("ignoring bad RETENTION_DAYS entry", extra={"entry": item})
+    return days
+
+
+def _cutoff(days: int, now: datetime) -> str:
+    """ISO cutoff comparable with created_at; "" (nothing is older) keeps forever."""
+    if days <= 0:
+        return ""
+    return (now - timedelta(days=days)).isoformat() + "Z"
+
+
+def _archive_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"quarantine-{month}.db")
+
+
+def _open_archive(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=db.DB_BUSY_TIMEOUT)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_events (
+            id INTEGER PRIMARY KEY,
+            created_at TEXT,
+            user_email TEXT,
+            sender TEXT,
+            classification TEXT,
+            moved INTEGER,
+            released INTEGER,
+            payload BLOB NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_sender ON archived_events (sender)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_user ON archived_events (user_email)")
+    return conn
+
+
+def archive_rows(rows: list[dict]):
+    """Write full quarantine_events rows into their monthly archive files."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_month = {}
+    for row in rows:
+        by_month.setdefault((row.get("created_at") or "unknown")[:7], []).append(row)
+
+    for month, month_rows in by_month.items():
+        conn = _open_archive(_archive_path(month))
+        # OR IGNORE: a crash between archiving and the live delete just
+        # re-archives the same IDs on the next run
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO archived_events
+                (id, created_at, user_email, sender, classification, moved, released, payload)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    *(row.get(c) for c in _INDEXED_COLUMNS),
+                    zlib.compress(json.dumps(row, separators=(",", ":")).encode(), 6),
+                )
+                for row in month_rows
+            ],
+        )
+        conn.commit()
+        conn.close()
+
+
+def run_retention(now: datetime | None = None) -> dict:
+    """Archive expired events in small batches, then vacuum the freed pages."""
+    now = now or datetime.utcnow()
+    days = parse_retention_days(RETENTION_DAYS)
+    default_cutoff = _cutoff(days.pop("default", 0), now)
+    cutoffs = {name: _cutoff(d, now) for name, d in days.items()}
+
+    archived = 0
+    while True:
+        n = db.take_expired_events(cutoffs, default_cutoff, RETENTION_BATCH_SIZE, archive_rows)
+        archived += n
+        if n < RETENTION_BATCH_SIZE:
+            break
+
+    free_pages = None
+    if db.get_auto_vacuum_mode() == 2:
+        while True:
+            free_pages = db.incremental_vacuum(RETENTION_VACUUM_PAGES)
+            if free_pages == 0:
+                break
+    else:
+        logger.warning(
+            "database is not in incremental auto_vacuum mode; "
+            "run `python -m services.retention vacuum --full` once to convert it"
+        )
+
+    evidence_removed = evidence.gc()["removed"]
+
+    logger.info(
+        "retention run finished",
+        extra={"archived": archived, "free_pages": free_pages, "evidence_removed": evidence_removed},
+    )
+    return {"archived": archived, "free_pages": free_pages, "evidence_removed": evidence_removed}
+
+
+async def run_retention_forever():
+    """Background task for the poller: one retention run every RETENTION_INTERVAL_SECONDS."""
+    while True:
+        try:
+            await asyncio.to_thread(run_retention)
+        except Exception:
+            logger.exception("retention run failed")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+
+def query_archive(
+    from_month: str | None = None,
+    to_month: str | None = None,
+    sender: str | None = None,
+    user_email: str | None = None,
+    classification: str | None = None,
+    limit: int = 100,
+) -> list[dict]:
+    """
+    Search archived events (newest month first). Months are "YYYY-MM".
+    Returns the original quarantine_events rows, with reasons decoded.
+    """
+    clauses, params = [], []
+    if sender:
+        clauses.append("sender = ? COLLATE NOCASE")
+        params.append(sender)
+    if user_email:
+        clauses.append("user_email = ? COLLATE NOCASE")
+        params.append(user_email)
+    if classification:
+        clauses.append("classification = ?")
+        params.append(classification)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    results = []
+    for path in sorted(glob.glob(_archive_path("*")), reverse=True):
+        month = os.path.basename(path)[len("quarantine-"):-len(".db")]
+        if (from_month and month < from_month) or (to_month and month > to_month):
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        rows = conn.execute(
+            f"SELECT payload FROM archived_events {where} ORDER BY created_at DESC LIMIT ?",
+            (*params, limit - len(results)),
+        ).fetchall()
+        conn.close()
+        for (payload,) in rows:
+            event = json.loads(zlib.decompress(payload))
+            event["reasons"] = json.loads(event["reasons"]) if event.get("reasons") else []
+            results.append(event)
+        if len(results) >= limit:
+            break
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("run", help="archive expired events now")
+    query = sub.add_parser("query", help="search the archive")
+    query.add_argument("--from", dest="from_month", help="YYYY-MM")
+    query.add_argument("--to", dest="to_month", help="YYYY-MM")
+    query.add_argument("--sender")
+    query.add_argument("--user")
+    query.add_argument("--classification")
+    query.add_argument("--limit", type=int, default=100)
+    vacuum = sub.add_parser("vacuum", help="return free pages to the OS")
+    vacuum.add_argument("--full", action="store_true", help="one-off VACUUM that enables incremental auto_vacuum")
+    args = parser.parse_args()
+
+    db.init_db()
+    if args.command == "run":
+        print(json.dumps(run_retention()))
+    elif args.command == "query":
+        for event in query_archive(
+            args.from_month, args.to_month, args.sender, args.user, args.classification, args.limit
+        ):
+            print(json.dumps(event))
+    elif args.full:
+        db.convert_to_incremental_vacuum()
+        print("converted to incremental auto_vacuum")
+    else:
+        print(json.dumps({"free_pages": db.incremental_vacuum(RETENTION_VACUUM_PAGES)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Per-mailbox poll scheduling.
+
+Each mailbox has its own next-poll time in a heap. After every poll its
+interval is recomputed from an EWMA of its arrival rate (aiming for about
+POLL_TARGET_MESSAGES new messages per poll) and its streak of empty deltas
+(each empty poll stretches the interval by POLL_BACKOFF), clamped to
+[POLL_MIN_INTERVAL, POLL_MAX_INTERVAL]. Busy shared mailboxes converge on the
+minimum; dormant ones drift out to the maximum. A policy "poll_interval"
+(e.g. for an executives group) pins a mailbox to a fixed cadence.
+"""
+import heapq
+import os
+import time
+
+from services.logging_utils import get_logger
+from services.metrics import Counter, Gauge
+
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "15"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "900"))
+# Interval for a mailbox the scheduler knows nothing about yet
+POLL_INITIAL_INTERVAL = float(os.getenv("POLL_INITIAL_INTERVAL", "60"))
+# Interval growth per consecutive empty delta
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "1.5"))
+# New messages we'd like each poll to find; lower = faster polling of busy mailboxes
+POLL_TARGET_MESSAGES = float(os.getenv("POLL_TARGET_MESSAGES", "2"))
+# Weight of the latest poll in the arrival-rate average
+POLL_RATE_ALPHA = float(os.getenv("POLL_RATE_ALPHA", "0.3"))
+
+logger = get_logger(__name__)
+
+POLLS_TOTAL = Counter(
+    "poller_polls_total", "Delta polls per mailbox by result (messages, empty)", ("mailbox", "result")
+)
+POLL_INTERVAL = Gauge(
+    "poller_poll_interval_seconds", "Current poll interval per mailbox", ("mailbox",)
+)
+POLLS_PER_MINUTE = Gauge(
+    "poller_polls_per_minute", "Effective poll rate per mailbox (60 / interval)", ("mailbox",)
+)
+ARRIVAL_RATE = Gauge(
+    "poller_arrival_rate_per_minute", "Smoothed new-message rate per mailbox", ("mailbox",)
+)
+
+
+class MailboxState:
+    __slots__ = ("interval", "rate", "empty_streak", "last_poll", "pinned", "due")
+
+    def __init__(self, now: float):
+        self.interval = POLL_INITIAL_INTERVAL
+        self.rate = 0.0  # messages per second
+        self.empty_streak = 0
+        self.last_poll = None
+        self.pinned = None
+        self.due = now
+
+
+class MailboxScheduler:
+    """
+    Heap of (due time, mailbox). Entries for mailboxes that were rescheduled
+    or dropped are left in the heap and skipped when popped.
+
+    A mailbox is "polling" from pop_due() until record(). It has no heap entry
+    in that time and gets none from sync(), so it is never polled twice at once.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.mailboxes: dict[str, MailboxState] = {}
+        self.polling: set[str] = set()
+        # Polling mailboxes sync() dropped; forgotten once their poll is recorded
+        self._dropped: set[str] = set()
+        self._heap: list[tuple[float, str]] = []
+
+    def sync(self, mailboxes: list[str], pinned: dict | None = None):
+        """
+        Track exactly `mailboxes` (e.g. those this worker owns). New ones are
+        due immediately. pinned maps mailbox -> fixed interval.
+        """
+        now = self.clock()
+        pinned = pinned or {}
+        wanted = set(mailboxes)
+        for mailbox in list(self.mailboxes):
+            if mailbox not in wanted:
+                if mailbox in self.polling:
+                    self._dropped.add(mailbox)
+                else:
+                    self._forget(mailbox)
+        for mailbox in mailboxes:
+            self._dropped.discard(mailbox)
+            state = self.mailboxes.get(mailbox)
+            if state is None:
+                state = self.mailboxes[mailbox] = MailboxState(now)
+                heapq.heappush(self._heap, (now, mailbox))
+            interval = pinned.get(mailbox)
+            if interval != state.pinned:
+                state.pinned = interval
+                # A newly pinned (or unpinned) mailbox shouldn't wait out its old
+                # interval; one being polled picks the pin up in record()
+                if interval is not None and mailbox not in self.polling and state.due > now + interval:
+                    self._schedule(mailbox, state, now + interval)
+
+    def _forget(self, mailbox: str):
+        del self.mailboxes[mailbox]
+        POLL_INTERVAL.remove(mailbox=mailbox)
+        POLLS_PER_MINUTE.remove(mailbox=mailbox)
+        ARRIVAL_RATE.remove(mailbox=mailbox)
+
+    def _schedule(self, mailbox: str, state: MailboxState, due: float):
+        state.due = due
+        heapq.heappush(self._heap, (due, mailbox))
+
+    def pop_due(self) -> list[str]:
+        """Mailboxes whose poll is due, earliest first."""
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, mailbox = heapq.heappop(self._heap)
+            state = self.mailboxes.get(mailbox)
+            # Stale entry: dropped, or rescheduled to a different time
+            if state is None or state.due != when:
+                continue
+            state.due = float("inf")
+            self.polling.add(mailbox)
+            due.append(mailbox)
+        return due
+
+    def next_due_in(self) -> float | None:
+        """Seconds until the earliest live heap entry (None if nothing is scheduled)."""
+        while self._heap:
+            when, mailbox = self._heap[0]
+            state = self.mailboxes.get(mailbox)
+            if state is not None and state.due == when:
+                return max(0.0, when - self.clock())
+            heapq.heappop(self._heap)
+        return None
+
+    def record(self, mailbox: str, new_messages: int | None):
+        """
+        Reschedule after a poll. new_messages is None when the poll failed or
+        was skipped; the mailbox is then retried at its current interval.
+        """
+        self.polling.discard(mailbox)
+        if mailbox in self._dropped:
+            self._dropped.discard(mailbox)
+            self._forget(mailbox)
+            return
+        state = self.mailboxes.get(mailbox)
+        if state is None:
+            return
+        now = self.clock()
+
+        if new_messages is not None:
+            POLLS_TOTAL.inc(mailbox=mailbox, result="messages" if new_messages else "empty")
+            if state.last_poll is not None:
+                elapsed = max(now - state.last_poll, 1e-3)
+                state.rate = POLL_RATE_ALPHA * (new_messages / elapsed) + (1 - POLL_RATE_ALPHA) * state.rate
+            state.last_poll = now
+
+            if new_messages:
+                state.empty_streak = 0
+                interval = POLL_TARGET_MESSAGES / state.rate if state.rate else state.interval
+            else:
+                state.empty_streak += 1
+                interval = state.interval * POLL_BACKOFF
+                if state.rate:
+                    # Don't back off past the point where the usual traffic would pile up
+                    interval = min(interval, max(state.interval, POLL_TARGET_MESSAGES / state.rate))
+            state.interval = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, interval))
+
+        interval = state.pinned if state.pinned is not None else state.interval
+        self._schedule(mailbox, state, now + interval)
+
+        POLL_INTERVAL.set(interval, mailbox=mailbox)
+        POLLS_PER_MINUTE.set(round(60 / interval, 3), mailbox=mailbox)
+        ARRIVAL_RATE.set(round(state.rate * 60, 3), mailbox=mailbox)
+
+    def summary(self) -> dict:
+        """Aggregate view for the periodic log line."""
+        states = self.mailboxes.values()
+        if not states:
+            return {"mailboxes": 0}
+        adaptive = [s.interval for s in states if s.pinned is None]
+        return {
+            "mailboxes": len(states),
+            "polls_per_minute": round(sum(60 / (s.pinned or s.interval) for s in states), 1),
+            "at_min_interval": sum(1 for i in adaptive if i <= POLL_MIN_INTERVAL),
+            "at_max_interval": sum(1 for i in adaptive if i >= POLL_MAX_INTERVAL),
+            "pinned": len(states) - len(adaptive),
+        }
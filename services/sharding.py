@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+import socket
+
+from dotenv import load_dotenv
+
+from services.db import heartbeat_worker, sync_leases, holds_lease, retire_worker
+from services.logging_utils import get_logger
+
+load_dotenv()
+
+# Split mailboxes across several poller processes sharing QUARANTINE_DB_PATH
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "false").lower() == "true"
+# Must be unique per process; defaults to host + pid
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# A worker that misses heartbeats for this long is considered dead and its
+# mailboxes are picked up by the others. Hosts need roughly synced clocks.
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "120"))
+
+logger = get_logger(__name__)
+
+_live_workers: list[str] = []
+
+
+def _weight(worker_id: str, mailbox: str) -> int:
+    # Stable across processes (unlike hash()), so all workers agree
+    digest = hashlib.md5(f"{worker_id}|{mailbox}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def preferred_owner(mailbox: str, workers: list[str]) -> str:
+    """
+    Rendezvous hashing: every worker computes the same owner for a mailbox,
+    and a worker joining or leaving only moves ~1/N of the mailboxes.
+    """
+    return max(workers, key=lambda w: _weight(w, mailbox))
+
+
+def claim_mailboxes(mailboxes: list[str], busy=frozenset()) -> list[str]:
+    """
+    Heartbeat, then return the subset of `mailboxes` this worker owns for this cycle.
+
+    Mailboxes that hash to another live worker are handed over by dropping our
+    lease; the new owner takes them once the lease is free. Ones in `busy`
+    (still being polled here) keep their lease until a later call, so the new
+    owner can't poll them at the same time. A mailbox whose previous owner
+    died is claimed once that owner's lease expires.
+    """
+    global _live_workers
+
+    if not SHARDING_ENABLED:
+        return mailboxes
+
+    workers = heartbeat_worker(WORKER_ID, LEASE_TTL_SECONDS)
+    if WORKER_ID not in workers:
+        workers = sorted(workers + [WORKER_ID])
+
+    if workers != _live_workers:
+        logger.info(
+            "worker set changed - rebalancing",
+            extra={"worker_id": WORKER_ID, "workers": workers},
+        )
+        _live_workers = workers
+
+    wanted, unwanted, handing_over = [], [], []
+    for mailbox in mailboxes:
+        if preferred_owner(mailbox, workers) == WORKER_ID:
+            wanted.append(mailbox)
+        elif mailbox in busy:
+            handing_over.append(mailbox)
+        else:
+            unwanted.append(mailbox)
+
+    owned = sync_leases(WORKER_ID, wanted + handing_over, unwanted, LEASE_TTL_SECONDS)
+    # Renewed only to finish the current poll; not polled again
+    owned = [mailbox for mailbox in owned if mailbox not in handing_over]
+    logger.info(
+        "claimed %d of %d mailboxes",
+        len(owned),
+        len(mailboxes),
+        extra={"worker_id": WORKER_ID, "workers": len(workers), "waiting": len(wanted) - len(owned)},
+    )
+    return owned
+
+
+def still_owned(mailbox: str) -> bool:
+    """Re-check ownership right before processing a mailbox."""
+    if not SHARDING_ENABLED:
+        return True
+    return holds_lease(WORKER_ID, mailbox)
+
+
+async def keep_leases_alive():
+    """
+    Background task: heartbeat every third of the TTL so long poll cycles
+    never let our leases lapse while we are still working on them.
+    """
+    while True:
+        await asyncio.sleep(LEASE_TTL_SECONDS / 3)
+        try:
+            heartbeat_worker(WORKER_ID, LEASE_TTL_SECONDS)
+        except Exception:
+            logger.exception("lease heartbeat failed", extra={"worker_id": WORKER_ID})
+
+
+def shutdown():
+    """Release all leases so other workers take over immediately."""
+    if SHARDING_ENABLED:
+        retire_worker(WORKER_ID)
+        logger.info("released mailbox leases", extra={"worker_id": WORKER_ID})
@@ -1,21 +1,72 @@
+import fcntl
 import json
 import os
+from contextlib import contextmanager
 from threading import Lock
 
-STATE_FILE = os.path.join(os.path.dirname(__file__), "..", "state.json")
+# Shared by every poller worker on a host (or on a shared volume across hosts)
+STATE_FILE = os.getenv("STATE_FILE") or os.path.join(os.path.dirname(__file__), "..", "state.json")
 _state_lock = Lock()
 
+
+@contextmanager
+def _locked(exclusive: bool):
+    """
+    Hold the in-process lock plus an flock on a sidecar file, so
+    read-modify-write cycles from other worker processes can't interleave.
+    """
+    with _state_lock:
+        with open(STATE_FILE + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read() -> dict:
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _write(state: dict):
+    # Write to a temp file and rename so readers never see a partial file
+    tmp_path = f"{STATE_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_FILE)
+
+
 def load_state() -> dict:
     if not os.path.exists(STATE_FILE):
         return {}
-    with _state_lock:
-        try:
-            with open(STATE_FILE, "r") as f:
-                return json.load(f)
-        except Exception:
-            return {}
+    with _locked(exclusive=False):
+        return _read()
 
 def save_state(state: dict):
-    with _state_lock:
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f)
\ No newline at end of file
+    with _locked(exclusive=True):
+        _write(state)
+
+
+def get_user_state(user_id: str) -> dict:
+    return load_state().get("users", {}).get(user_id, {})
+
+
+def update_user_state(user_id: str, updates: dict) -> dict:
+    """
+    Merge `updates` into one mailbox's state under an exclusive lock.
+    Prefer this over load_state/save_state when several workers share the file:
+    it only touches this mailbox's keys, so concurrent updates to other
+    mailboxes are not lost.
+    Returns the mailbox's updated state.
+    """
+    with _locked(exclusive=True):
+        state = _read()
+        users_state = state.setdefault("users", {})
+        user_state = users_state.setdefault(user_id, {})
+        user_state.update(updates)
+        _write(state)
+        return user_state
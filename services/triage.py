@@ -0,0 +1,450 @@
+"""
+Local first-tier classifier trained from past verdicts.
+
+Messages are turned into hashed features (sender address and domain, subject
+and bodyPreview words and word pairs) and scored by a multinomial logistic
+regression in NumPy. A whole delta page is scored with one gather and one
+segmented sum, so the cost per message is a few microseconds. The poller only
+accepts confident predictions (TRIAGE_CONFIDENCE) for TRIAGE_CLASSES; every
+other message still goes to the LLM.
+
+Training labels come from quarantine_events: LLM verdicts, with admin
+releases relabelled as safe. Models are versioned files in TRIAGE_MODEL_DIR
+(triage-v0001.npz, ...) and only used once promoted.
+
+Usage:
+    python -m services.triage train [--promote]
+    python -m services.triage eval [--version N] [--after-id ID]
+    python -m services.triage list
+    python -m services.triage promote N
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from services.db import BASE_DIR, init_db, iter_training_rows
+from services.logging_utils import get_logger
+from services.metrics import Counter
+
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "false").lower() == "true"
+TRIAGE_MODEL_DIR = os.getenv("TRIAGE_MODEL_DIR") or os.path.join(BASE_DIR, "data", "models")
+# Minimum predicted probability for the poller to skip the LLM
+TRIAGE_CONFIDENCE = float(os.getenv("TRIAGE_CONFIDENCE", "0.97"))
+# Verdicts the local model may issue on its own. Phishing/malicious go to
+# the LLM by default so admins get its reasons for anything dangerous.
+TRIAGE_CLASSES = {
+    c.strip().lower() for c in os.getenv("TRIAGE_CLASSES", "safe,spam").split(",") if c.strip()
+}
+# Training weight of admin releases relative to LLM verdicts: they are
+# corrections of exactly the mistakes the model should not repeat
+TRIAGE_RELEASE_WEIGHT = float(os.getenv("TRIAGE_RELEASE_WEIGHT", "5"))
+# Seconds between checks for a newly promoted model
+TRIAGE_RELOAD_INTERVAL = float(os.getenv("TRIAGE_RELOAD_INTERVAL", "60"))
+
+CLASSES = ("safe", "spam", "phishing", "malicious")
+N_FEATURES = 1 << 18
+# Words per field; bodyPreview is ~255 chars anyway
+MAX_TOKENS = 120
+CURRENT_FILE = "triage-current"
+
+logger = get_logger(__name__)
+
+TRIAGE_DECISIONS = Counter(
+    "triage_decisions_total", "Local model results by outcome (accepted, uncertain).", ("result",)
+)
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9'$€£%]*")
+
+
+def _hash(feature: str) -> int:
+    # crc32 is stable across processes, unlike hash()
+    return zlib.crc32(feature.encode()) & (N_FEATURES - 1)
+
+
+def _words(prefix: str, text: str | None) -> list[str]:
+    tokens = _TOKEN_RE.findall((text or "").lower())[:MAX_TOKENS]
+    feats = [f"{prefix}:{t}" for t in tokens]
+    feats += [f"{prefix}2:{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return feats
+
+
+def featurize(sender: str | None, subject: str | None, body: str | None) -> np.ndarray:
+    """Sorted unique hashed feature indices for one message (never empty)."""
+    sender = (sender or "").lower()
+    domain = sender.rpartition("@")[2]
+    feats = [f"s:{sender}", f"d:{domain}", f"tld:{domain.rpartition('.')[2]}"]
+    feats += _words("t", subject)
+    feats += _words("b", body)
+    return np.unique(np.fromiter((_hash(f) for f in feats), dtype=np.int64, count=len(feats)))
+
+
+def vectorize(docs) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (sender, subject, body) tuples -> CSR-style (indices, indptr). Rows are
+    binary and L2-normalised at scoring time.
+    """
+    rows = [featurize(*d) for d in docs]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=indptr[1:])
+    indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    return indices, indptr
+
+
+def _logits(weights: np.ndarray, bias: np.ndarray, indices: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    # Every row has at least the sender features, so reduceat never sees an empty segment
+    sums = np.add.reduceat(weights[indices], indptr[:-1], axis=0)
+    scale = 1.0 / np.sqrt(np.diff(indptr))
+    return sums * scale[:, None] + bias
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    z = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return z / z.sum(axis=1, keepdims=True)
+
+
+class TriageModel:
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, meta: dict):
+        self.weights = weights
+        self.bias = bias
+        self.meta = meta
+        self.version = meta.get("version")
+
+    def predict_proba(self, docs) -> np.ndarray:
+        """(n, len(CLASSES)) probabilities for (sender, subject, body) tuples."""
+        indices, indptr = vectorize(docs)
+        if len(indptr) == 1:
+            return np.zeros((0, len(CLASSES)))
+        return _softmax(_logits(self.weights, self.bias, indices, indptr))
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path, weights=self.weights, bias=self.bias, meta=np.array(json.dumps(self.meta))
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "TriageModel":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["weights"], data["bias"], json.loads(str(data["meta"])))
+
+
+# ---------- training ----------
+
+def train(
+    docs: list,
+    labels: np.ndarray,
+    sample_weight: np.ndarray | None = None,
+    epochs: int = 8,
+    batch_size: int = 256,
+    learning_rate: float = 0.5,
+    l2: float = 1e-6,
+    seed: int = 1337,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Multinomial logistic regression with sparse Adagrad updates: only the
+    feature rows present in a minibatch are touched.
+    labels are indices into CLASSES.
+    """
+    indices, indptr = vectorize(docs)
+    n, k = len(labels), len(CLASSES)
+    counts = np.diff(indptr)
+    scale = 1.0 / np.sqrt(counts)
+    if sample_weight is None:
+        sample_weight = np.ones(n)
+
+    weights = np.zeros((N_FEATURES, k), dtype=np.float32)
+    bias = np.log(np.bincount(labels, minlength=k) + 1.0)
+    bias -= bias.mean()
+    grad_sq = np.full((N_FEATURES, k), 1e-8, dtype=np.float32)
+    bias_sq = np.full(k, 1e-8)
+    onehot = np.eye(k)[labels]
+    rng = np.random.default_rng(seed)
+
+    for _ in range(epochs):
+        order = rng.permutation(n)
+        for start in range(0, n, batch_size):
+            rows = order[start:start + batch_size]
+            # Gather this minibatch's CSR slice
+            starts, ends = indptr[rows], indptr[rows + 1]
+            b_counts = ends - starts
+            b_ptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(b_counts, out=b_ptr[1:])
+            b_idx = indices[np.repeat(starts - b_ptr[:-1], b_counts) + np.arange(b_ptr[-1])]
+
+            probs = _softmax(_logits(weights, bias, b_idx, b_ptr))
+            w = sample_weight[rows]
+            delta = (probs - onehot[rows]) * (w / w.sum())[:, None]
+
+            # Per-nonzero gradient, summed per unique feature
+            contrib = np.repeat(delta * scale[rows][:, None], b_counts, axis=0)
+            feats, inverse = np.unique(b_idx, return_inverse=True)
+            grad = np.zeros((len(feats), k))
+            np.add.at(grad, inverse, contrib)
+            grad += l2 * weights[feats]
+
+            grad_sq[feats] += grad ** 2
+            weights[feats] -= learning_rate * grad / np.sqrt(grad_sq[feats])
+            bias_grad = delta.sum(axis=0)
+            bias_sq += bias_grad ** 2
+            bias -= learning_rate * bias_grad / np.sqrt(bias_sq)
+
+    return weights, bias
+
+
+def evaluate(model: TriageModel, docs: list, labels: np.ndarray, thresholds=(0.8, 0.9, 0.95, 0.97, 0.99)) -> dict:
+    """Accuracy, per-class precision/recall, confusion matrix and confidence-gating coverage."""
+    n, k = len(labels), len(CLASSES)
+    if not n:
+        return {"rows": 0}
+    probs = model.predict_proba(docs)
+    predicted = probs.argmax(axis=1)
+    confidence = probs.max(axis=1)
+
+    confusion = np.zeros((k, k), dtype=np.int64)
+    np.add.at(confusion, (labels, predicted), 1)
+    per_class = {}
+    for i, name in enumerate(CLASSES):
+        tp = confusion[i, i]
+        per_class[name] = {
+            "support": int(confusion[i].sum()),
+            "precision": round(float(tp / confusion[:, i].sum()), 4) if confusion[:, i].sum() else None,
+            "recall": round(float(tp / confusion[i].sum()), 4) if confusion[i].sum() else None,
+        }
+
+    safe = CLASSES.index("safe")
+    gating = []
+    for t in thresholds:
+        covered = confidence >= t
+        hits = covered.sum()
+        gating.append({
+            "confidence": t,
+            # Share of messages that would skip the LLM
+            "coverage": round(float(hits / n), 4),
+            "accuracy": round(float((predicted[covered] == labels[covered]).mean()), 4) if hits else None,
+            # Threats the model would have confidently passed as safe
+            "missed_threats": int((covered & (predicted == safe) & (labels != safe)).sum()),
+        })
+
+    return {
+        "rows": int(n),
+        "accuracy": round(float((predicted == labels).mean()), 4),
+        "classes": per_class,
+        "confusion": {"labels": list(CLASSES), "matrix": confusion.tolist()},
+        "gating": gating,
+    }
+
+
+def load_training_data(after_id: int = 0) -> tuple[list, np.ndarray, np.ndarray, list]:
+    """(docs, labels, sample weights, event ids) from quarantine_events."""
+    docs, labels, weights, ids = [], [], [], []
+    class_index = {c: i for i, c in enumerate(CLASSES)}
+    for event_id, sender, subject, body_preview, label, released in iter_training_rows(after_id):
+        if label not in class_index:
+            continue
+        docs.append((sender, subject, body_preview))
+        labels.append(class_index[label])
+        ids.append(event_id)
+        weights.append(TRIAGE_RELEASE_WEIGHT if released else 1.0)
+    return docs, np.array(labels, dtype=np.int64), np.array(weights), ids
+
+
+# ---------- model files ----------
+
+def _model_path(version: int) -> str:
+    return os.path.join(TRIAGE_MODEL_DIR, f"triage-v{version:04d}.npz")
+
+
+def list_versions() -> list[int]:
+    if not os.path.isdir(TRIAGE_MODEL_DIR):
+        return []
+    found = (re.fullmatch(r"triage-v(\d+)\.npz", f) for f in os.listdir(TRIAGE_MODEL_DIR))
+    return sorted(int(m.group(1)) for m in found if m)
+
+
+def current_version() -> int | None:
+    try:
+        with open(os.path.join(TRIAGE_MODEL_DIR, CURRENT_FILE)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def promote(version: int):
+    if not os.path.exists(_model_path(version)):
+        raise FileNotFoundError(_model_path(version))
+    tmp = os.path.join(TRIAGE_MODEL_DIR, CURRENT_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(f"{version}\n")
+    os.replace(tmp, os.path.join(TRIAGE_MODEL_DIR, CURRENT_FILE))
+
+
+def train_and_save(holdout: float = 0.2, epochs: int = 8, after_id: int = 0) -> TriageModel:
+    """
+    Train on the oldest (1 - holdout) of the labelled events, evaluate on the
+    newest, then refit on everything and save as the next version.
+    """
+    docs, labels, weights, ids = load_training_data(after_id)
+    if len(docs) < 100:
+        raise ValueError(f"only {len(docs)} labelled events; need at least 100")
+
+    # Time-ordered split: the model is judged on mail newer than what it saw
+    split = int(len(docs) * (1 - holdout))
+    started = time.perf_counter()
+    w, b = train(docs[:split], labels[:split], weights[:split], epochs=epochs)
+    report = evaluate(TriageModel(w, b, {}), docs[split:], labels[split:])
+
+    w, b = train(docs, labels, weights, epochs=epochs)
+    version = (list_versions() or [0])[-1] + 1
+    model = TriageModel(
+        w.astype(np.float32),
+        b,
+        {
+            "version": version,
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "classes": list(CLASSES),
+            "n_features": N_FEATURES,
+            "training_rows": len(docs),
+            "event_id_range": [ids[0], ids[-1]],
+            "holdout_from_event_id": ids[split] if split < len(ids) else None,
+            "epochs": epochs,
+            "train_seconds": round(time.perf_counter() - started, 1),
+            "holdout_report": report,
+        },
+    )
+    os.makedirs(TRIAGE_MODEL_DIR, exist_ok=True)
+    model.save(_model_path(version))
+    logger.info("trained local model", extra={"version": version, "rows": len(docs)})
+    return model
+
+
+# ---------- serving ----------
+
+_lock = threading.Lock()
+_model = None
+_loaded_version = None
+_checked_at = 0.0
+
+
+def get_model() -> TriageModel | None:
+    """The promoted model, reloaded when triage-current changes."""
+    global _model, _loaded_version, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < TRIAGE_RELOAD_INTERVAL and _checked_at:
+        return _model
+    with _lock:
+        _checked_at = now
+        version = current_version()
+        if version != _loaded_version:
+            _loaded_version = version
+            try:
+                _model = TriageModel.load(_model_path(version)) if version else None
+                logger.info("local model loaded", extra={"version": version})
+            except Exception:
+                logger.exception("local model load failed; keeping previous model")
+    return _model
+
+
+def predict_messages(messages: list[dict]) -> list[dict | None]:
+    """
+    Score a page of Graph messages in one batch. Each result is a verdict dict
+    (risk_score, classification, reasons, source) when the model is confident
+    enough to skip the LLM, else None.
+    """
+    model = get_model() if TRIAGE_ENABLED else None
+    if model is None or not messages:
+        return [None] * len(messages)
+
+    docs = [
+        (
+            ((m.get("from") or {}).get("emailAddress") or {}).get("address"),
+            m.get("subject"),
+            m.get("bodyPreview"),
+        )
+        for m in messages
+    ]
+    probs = model.predict_proba(docs)
+    results = []
+    for row in probs:
+        best = int(row.argmax())
+        classification = CLASSES[best]
+        if row[best] < TRIAGE_CONFIDENCE or classification not in TRIAGE_CLASSES:
+            TRIAGE_DECISIONS.inc(result="uncertain")
+            results.append(None)
+            continue
+        TRIAGE_DECISIONS.inc(result="accepted")
+        results.append({
+            "risk_score": int(round(100 * (1 - row[0]))),
+            "classification": classification,
+            "reasons": [f"Local model v{model.version}: {classification} ({row[best]:.1%} confidence)"],
+            "source": "triage",
+        })
+    return results
+
+
+def _print_report(report: dict):
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_train = sub.add_parser("train", help="train the next model version from quarantine_events")
+    p_train.add_argument("--holdout", type=float, default=0.2, help="newest share of events held out for evaluation")
+    p_train.add_argument("--epochs", type=int, default=8)
+    p_train.add_argument("--after-id", type=int, default=0, help="only train on events after this id")
+    p_train.add_argument("--promote", action="store_true", help="make the new version the one the poller uses")
+    p_eval = sub.add_parser("eval", help="evaluate a model against stored labels")
+    p_eval.add_argument("--version", type=int, help="defaults to the promoted version")
+    p_eval.add_argument(
+        "--after-id",
+        type=int,
+        help="only score events after this id (default: the newest event the model was trained on)",
+    )
+    sub.add_parser("list", help="list model versions")
+    p_promote = sub.add_parser("promote", help="switch the poller to a model version")
+    p_promote.add_argument("version", type=int)
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "train":
+        model = train_and_save(args.holdout, args.epochs, args.after_id)
+        if args.promote:
+            promote(model.version)
+        _print_report({"version": model.version, "promoted": args.promote, **model.meta["holdout_report"]})
+    elif args.command == "eval":
+        version = args.version or current_version() or (list_versions() or [None])[-1]
+        if version is None:
+            parser.error("no model trained yet")
+        model = TriageModel.load(_model_path(version))
+        after_id = args.after_id
+        if after_id is None:
+            # The saved weights were refit on every row up to event_id_range[1],
+            # holdout included; only newer events are unseen
+            trained_to = (model.meta.get("event_id_range") or [None, None])[1]
+            after_id = trained_to or model.meta.get("holdout_from_event_id") or 0
+        docs, labels, _, _ = load_training_data(after_id)
+        if not docs:
+            parser.error(f"no labelled events after id {after_id} to evaluate on; pass --after-id")
+        _print_report({"version": version, "after_id": after_id, **evaluate(model, docs, labels)})
+    elif args.command == "list":
+        current = current_version()
+        for version in list_versions():
+            meta = TriageModel.load(_model_path(version)).meta
+            report = meta.get("holdout_report", {})
+            print(
+                f"{'*' if version == current else ' '} v{version:04d}  {meta.get('created_at', '?')[:19]}  "
+                f"rows={meta.get('training_rows')}  holdout_accuracy={report.get('accuracy')}"
+            )
+    else:
+        promote(args.version)
+        print(f"promoted v{args.version:04d}")
+
+
+if __name__ == "__main__":
+    main()